@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Account Cache for Banking System
+Bounded LRU of customer accounts keyed by username and account number
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Configuration
+ACCOUNT_CACHE_SIZE = int(os.environ.get('BANK_ACCOUNT_CACHE_SIZE', '10000'))  # accounts kept in memory
+# Safety net for writers outside this process (CLI tools); our own writes update entries immediately
+ACCOUNT_CACHE_TTL = float(os.environ.get('BANK_ACCOUNT_CACHE_TTL', '60'))  # seconds
+
+
+class AccountCache:
+    def __init__(self, max_entries=ACCOUNT_CACHE_SIZE, ttl=ACCOUNT_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # username -> account dict (least recently used first)
+        self._by_account = {}  # account_number -> username
+        self._write_seq = 0
+        self._last_write = {}  # username -> write sequence of its latest committed balance
+        self._forgotten_before = 0  # writes older than this are no longer tracked in _last_write
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def snapshot(self):
+        """Take before reading an account from SQLite; pass to put() afterwards"""
+        with self._lock:
+            return self._write_seq
+
+    def get(self, username=None, account_number=None):
+        """
+        Get a cached account by username or account number
+
+        Returns:
+            dict: Copy of the account (username, name, account_number, balance) or None
+        """
+        with self._lock:
+            if username is None:
+                username = self._by_account.get(int(account_number)) if str(account_number).isdigit() else None
+            entry = self._entries.get(username) if username is not None else None
+
+            if entry is None or time.monotonic() - entry['loaded_at'] > self.ttl:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(username)
+            self.hits += 1
+            return {key: value for key, value in entry.items() if key != 'loaded_at'}
+
+    def put(self, account, seq):
+        """
+        Cache an account read from SQLite
+
+        Skipped if a balance write for the account committed after `seq` was
+        taken, since the row read may predate it.
+        """
+        username = account['username']
+        with self._lock:
+            if seq < self._forgotten_before or self._last_write.get(username, -1) > seq:
+                return
+
+            old = self._entries.pop(username, None)
+            if old is not None:
+                self._by_account.pop(old['account_number'], None)
+
+            self._entries[username] = {
+                'username': username,
+                'name': account['name'],
+                'account_number': account['account_number'],
+                'balance': account['balance'],
+                'loaded_at': time.monotonic()
+            }
+            self._by_account[account['account_number']] = username
+
+            while len(self._entries) > self.max_entries:
+                _, evicted = self._entries.popitem(last=False)
+                self._by_account.pop(evicted['account_number'], None)
+
+    def update_balances(self, balances):
+        """Write-through of committed balances (username -> balance)"""
+        with self._lock:
+            for username, balance in balances.items():
+                self._write_seq += 1
+                self._last_write[username] = self._write_seq
+                entry = self._entries.get(username)
+                if entry is not None:
+                    entry['balance'] = balance
+                    entry['loaded_at'] = time.monotonic()
+
+            # Bound the write log; in-flight reads older than this point simply won't be cached
+            if len(self._last_write) > self.max_entries * 4:
+                self._last_write.clear()
+                self._forgotten_before = self._write_seq
+
+    def invalidate(self, username):
+        """Drop an account (e.g. after it is deleted)"""
+        with self._lock:
+            self._write_seq += 1
+            self._last_write[username] = self._write_seq
+            entry = self._entries.pop(username, None)
+            if entry is not None:
+                self._by_account.pop(entry['account_number'], None)
+
+    def clear(self):
+        """Drop every cached account"""
+        with self._lock:
+            self._write_seq += 1
+            self._entries.clear()
+            self._by_account.clear()
+            self._last_write.clear()
+            self._forgotten_before = self._write_seq
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+
+# Global instance
+account_cache = AccountCache()
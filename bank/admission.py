@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""
+Admission Control for Banking System
+Per-endpoint concurrency limits that adapt to latency, and 429 load shedding
+
+Each money endpoint (deposit, add_money, transfer, withdraw) has a limit on
+requests in progress at once. A request over the limit waits briefly for a
+slot; if the waiting line is already as long as the limit, the wait runs out,
+or the group commit writer has a backlog of BANK_ADMISSION_MAX_WRITE_QUEUE
+writes, it gets 429 with a Retry-After instead of piling up behind SQLite
+locks and chain waits.
+
+The limit follows latency (a gradient limiter): while recent latency stays near
+the endpoint's long-run latency the limit creeps up, and when requests start
+queueing inside (latency climbs) it shrinks in proportion. Limits are per
+process.
+"""
+
+import math
+import os
+import threading
+import time
+from functools import wraps
+
+from flask import jsonify
+
+from metrics import metrics
+
+# Configuration
+ADMISSION_ENABLED = os.environ.get('BANK_ADMISSION', '1') != '0'
+ADMISSION_INITIAL_LIMIT = int(os.environ.get('BANK_ADMISSION_LIMIT', '32'))  # requests in progress per endpoint
+ADMISSION_MIN_LIMIT = 4
+ADMISSION_MAX_LIMIT = int(os.environ.get('BANK_ADMISSION_MAX_LIMIT', '256'))
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get('BANK_ADMISSION_QUEUE_MS', '500')) / 1000  # seconds a request may wait for a slot
+ADMISSION_MAX_WRITE_QUEUE = int(os.environ.get('BANK_ADMISSION_MAX_WRITE_QUEUE', '2048'))  # queued writes before shedding
+LATENCY_TOLERANCE = 1.5  # recent latency up to this multiple of the long-run latency counts as healthy
+RETRY_AFTER_MAX = 30  # seconds
+
+SHED = metrics.counter('bank_admission_shed_total', 'Requests answered 429 by admission control',
+                       ['endpoint', 'reason'])
+
+
+class AdaptiveLimit:
+    """Concurrency limit of one endpoint"""
+
+    def __init__(self, name, initial=ADMISSION_INITIAL_LIMIT, min_limit=ADMISSION_MIN_LIMIT,
+                 max_limit=ADMISSION_MAX_LIMIT):
+        self.name = name
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.in_flight = 0
+        self.waiting = 0
+        self.short_latency = None  # EWMA over the last few requests
+        self.long_latency = None  # EWMA over hundreds of requests: the unloaded latency
+        self.admitted = 0
+        self.shed = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, timeout=ADMISSION_QUEUE_TIMEOUT):
+        """Take a slot, waiting up to `timeout` seconds; False if the request should be shed"""
+        with self._cond:
+            if self.in_flight >= int(self.limit):
+                if timeout <= 0 or self.waiting >= int(self.limit):
+                    self.shed += 1
+                    return False
+                deadline = time.monotonic() + timeout
+                self.waiting += 1
+                try:
+                    while self.in_flight >= int(self.limit):
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self.shed += 1
+                            return False
+                        self._cond.wait(remaining)
+                finally:
+                    self.waiting -= 1
+            self.in_flight += 1
+            self.admitted += 1
+            return True
+
+    def release(self, seconds):
+        """Give the slot back and feed the request's latency into the limit"""
+        with self._cond:
+            self.in_flight -= 1
+            self._observe(seconds)
+            self._cond.notify_all()
+
+    def _observe(self, seconds):
+        if self.short_latency is None:
+            self.short_latency = self.long_latency = seconds
+            return
+        self.short_latency += 0.2 * (seconds - self.short_latency)
+        self.long_latency += 0.01 * (seconds - self.long_latency)
+        # After an overload the long-run figure is inflated; let it come back down quickly
+        if self.long_latency > 2 * self.short_latency:
+            self.long_latency *= 0.95
+
+        gradient = max(0.5, min(1.0, LATENCY_TOLERANCE * self.long_latency / max(self.short_latency, 1e-6)))
+        # sqrt(limit) of headroom lets the limit probe upwards while latency is healthy
+        target = self.limit * gradient + math.sqrt(self.limit)
+        self.limit = max(self.min_limit, min(self.max_limit, 0.9 * self.limit + 0.1 * target))
+
+    def retry_after(self):
+        """Seconds a shed client should wait: roughly the time to work through the line"""
+        latency = self.short_latency or 1
+        return max(1, min(RETRY_AFTER_MAX, math.ceil(latency * (self.waiting + 1) / max(1, int(self.limit)))))
+
+    def stats(self):
+        return {
+            'limit': int(self.limit),
+            'in_flight': self.in_flight,
+            'waiting': self.waiting,
+            'admitted': self.admitted,
+            'shed': self.shed,
+            'latency_ms': round(self.short_latency * 1000, 1) if self.short_latency is not None else None,
+            'baseline_ms': round(self.long_latency * 1000, 1) if self.long_latency is not None else None
+        }
+
+
+class AdmissionControl:
+    def __init__(self, enabled=ADMISSION_ENABLED, max_write_queue=ADMISSION_MAX_WRITE_QUEUE):
+        self.enabled = enabled
+        self.max_write_queue = max_write_queue
+        # fn() -> writes waiting in the group commit queue(s); set by the app
+        self.backlog = None
+        self.backlog_shed = 0
+        self._limits = {}
+        self._lock = threading.Lock()
+
+    def limit_for(self, endpoint):
+        with self._lock:
+            if endpoint not in self._limits:
+                self._limits[endpoint] = AdaptiveLimit(endpoint)
+            return self._limits[endpoint]
+
+    def admit(self, endpoint, timeout=ADMISSION_QUEUE_TIMEOUT):
+        """
+        Decide on one request
+
+        Returns:
+            tuple: (limit, None) when admitted (call limit.release(seconds) when
+                done), or (None, retry_after_seconds) when the request is shed
+        """
+        limit = self.limit_for(endpoint)
+        if self.backlog and self.backlog() >= self.max_write_queue:
+            self.backlog_shed += 1
+            limit.shed += 1
+            SHED.inc(endpoint, 'write_queue')
+            return None, 1
+        if not limit.acquire(timeout):
+            SHED.inc(endpoint, 'concurrency')
+            return None, limit.retry_after()
+        return limit, None
+
+    @staticmethod
+    def busy_response(retry_after):
+        response = jsonify({
+            'success': False,
+            'message': f'Server busy, please retry in {retry_after}s',
+            'retry_after': retry_after
+        })
+        response.status_code = 429
+        response.headers['Retry-After'] = str(retry_after)
+        return response
+
+    def guard(self, endpoint):
+        """Decorate a Flask view so it runs under the endpoint's concurrency limit"""
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return view(*args, **kwargs)
+                limit, retry_after = self.admit(endpoint)
+                if limit is None:
+                    return self.busy_response(retry_after)
+                started = time.perf_counter()
+                try:
+                    return view(*args, **kwargs)
+                finally:
+                    limit.release(time.perf_counter() - started)
+            return wrapper
+        return decorator
+
+    def stats(self):
+        with self._lock:
+            limits = dict(self._limits)
+        return {
+            'enabled': self.enabled,
+            'backlog_shed': self.backlog_shed,
+            'endpoints': {endpoint: limit.stats() for endpoint, limit in limits.items()}
+        }
+
+
+# Global instance
+admission = AdmissionControl()
+
+metrics.gauge('bank_admission_limit', 'Current concurrency limit per endpoint',
+              lambda: {(endpoint,): limit['limit'] for endpoint, limit in admission.stats()['endpoints'].items()},
+              ['endpoint'])
+metrics.gauge('bank_admission_in_flight', 'Requests in progress per endpoint',
+              lambda: {(endpoint,): limit['in_flight'] for endpoint, limit in admission.stats()['endpoints'].items()},
+              ['endpoint'])
@@ -1,77 +1,152 @@
-from flask import Flask, jsonify, request, render_template_string, send_from_directory, make_response
+from flask import Flask, Response, jsonify, request, render_template_string, send_from_directory, make_response
 from flask_cors import CORS
 import os
 import sqlite3
 import hashlib
 import io
+import itertools
 import csv
+import tempfile
+import time
+import uuid
 from datetime import datetime
 from customer import Customer
 from bank import Bank
 from register import SignUp, SignIn
 from blockchain_integration import blockchain
+from webhook_dispatcher import dispatcher, WebhookDispatcher
+from chain_outbox import chain_outbox, ChainOutbox
+from group_commit import writer, MutationRejected
+from account_cache import account_cache
+from response_cache import response_cache
+from donation_analytics import donation_analytics, GROUPS
+import ledger
+import ledger_archive
+import ledger_export
+from backup_database import backup_scheduler
+from sharding import shards
+from read_routing import reads
+from admission import admission
+from idempotency import idempotency
+from metrics import metrics, instrument_flask
+from sql_trace import sql_trace
 import random
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all domains
+instrument_flask(app)  # Request counts and latency for /metrics
+
+# Largest number of items accepted by the batch endpoints
+MAX_BATCH_ITEMS = 5000
+# Rows fetched per chunk by streaming exports
+EXPORT_FETCH_SIZE = 1000
+# Seconds a stopping worker keeps delivering queued notifications and chain recordings
+DRAIN_SECONDS = float(os.environ.get('BANK_DRAIN_SECONDS', '10'))
 
 # Database setup
-def get_db_connection():
-    db_path = os.path.join(os.path.dirname(__file__), 'bank.db')
-    conn = sqlite3.connect(db_path)
+def account_db_path(username=None, account_number=None):
+    """bank.db, or the shard holding the given account when accounts are sharded"""
+    shard = shards.shard_for(username, account_number) if shards.enabled and (username or account_number) else None
+    return shards.shard_path(shard) if shard is not None else os.path.join(os.path.dirname(__file__), 'bank.db')
+
+def get_db_connection(username=None, account_number=None, db_path=None):
+    conn = sql_trace.connect(db_path or account_db_path(username, account_number), timeout=30)
     conn.row_factory = sqlite3.Row
     return conn
 
+def get_read_connection(username=None):
+    """Pooled read-only connection (see read_routing.py); close() hands it back"""
+    conn = reads.connect(account_db_path(username))
+    if conn.replica:
+        response_cache.bypass()
+    return conn
+
+def chain_outboxes():
+    """Every chain outbox: bank.db's plus, when sharded, each shard's"""
+    return list(dict.fromkeys([chain_outbox] + shards.outboxes()))
+
+def admin_body():
+    """Fields of a POST body (JSON or form); the admin password never comes from the logged query string"""
+    return request.get_json(silent=True) or request.form
+
+def admin_denied(data):
+    """401 reply unless `data` carries the admin password, else None"""
+    if data.get('admin_password') != "admin123":  # Replace with actual admin password or better auth
+        return jsonify({'success': False, 'message': 'Invalid admin credentials'}), 401
+    return None
+
 def init_db():
-    """Initialize the database with the customers table"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS customers
-        (username TEXT NOT NULL,
-        password TEXT NOT NULL,
-        name TEXT NOT NULL,
-        age INTEGER NOT NULL,
-        city TEXT NOT NULL,
-        balance INTEGER NOT NULL,
-        account_number INTEGER NOT NULL,
-        status INTEGER NOT NULL)
-    ''')
-    conn.commit()
-    conn.close()
+    """Initialize the database with the customers table (in bank.db and every shard)"""
+    for db_path in dict.fromkeys([shards.db_path] + shards.paths()):
+        conn = sql_trace.connect(db_path)
+        cursor = conn.cursor()
+        # WAL lets readers run alongside the group commit writer
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS customers
+            (username TEXT NOT NULL,
+            password TEXT NOT NULL,
+            name TEXT NOT NULL,
+            age INTEGER NOT NULL,
+            city TEXT NOT NULL,
+            balance INTEGER NOT NULL,
+            account_number INTEGER NOT NULL,
+            status INTEGER NOT NULL)
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_customers_username ON customers (username)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_customers_account_number ON customers (account_number)")
+        WebhookDispatcher.init_queue(cursor)
+        ChainOutbox.init_outbox(cursor)
+        ledger_archive.init_catalog(cursor)
+        if db_path == shards.db_path:
+            idempotency.init_table(cursor)
+        if shards.enabled:
+            if db_path == shards.db_path:
+                shards.init_coordinator(cursor)
+            else:
+                shards.init_participant(cursor)
+        conn.commit()
+        conn.close()
 
 # Migrate existing transaction tables to include cause column
 def migrate_transaction_tables():
     """Add cause column to existing transaction tables"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        for shard in range(shards.count):
+            conn = shards.connect(shard)
+            cursor = conn.cursor()
         
-        # Get all existing users
-        cursor.execute("SELECT username FROM customers")
-        users = cursor.fetchall()
+            # Get all existing users
+            cursor.execute("SELECT username FROM customers")
+            users = cursor.fetchall()
         
-        for user in users:
-            username = user['username']
-            table_name = f"{username}_transaction"
+            for user in users:
+                username = user['username']
+                table_name = f"{username}_transaction"
             
-            try:
-                # Check if table exists and if cause column exists
-                cursor.execute(f"PRAGMA table_info({table_name})")
-                columns = [column[1] for column in cursor.fetchall()]
+                try:
+                    # Check if table exists and if cause column exists
+                    cursor.execute(f"PRAGMA table_info({table_name})")
+                    columns = [column[1] for column in cursor.fetchall()]
+                
+                    if 'cause' not in columns and len(columns) > 0:
+                        # Add cause column to existing table
+                        cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN cause VARCHAR(50)")
+                        print(f"✅ Added cause column to {table_name}")
                 
-                if 'cause' not in columns and len(columns) > 0:
-                    # Add cause column to existing table
-                    cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN cause VARCHAR(50)")
-                    print(f"✅ Added cause column to {table_name}")
+                    if len(columns) > 0:
+                        # Intern causes and descriptors, then make sure indexes and triggers are in place
+                        if ledger.encode_ledger(cursor, username):
+                            print(f"✅ Re-encoded {table_name}")
+                        ledger.create_ledger(cursor, username)
                     
-            except sqlite3.OperationalError as e:
-                # Table might not exist yet, which is fine
-                print(f"⚠️ Could not migrate {table_name}: {e}")
-                continue
+                except sqlite3.OperationalError as e:
+                    # Table might not exist yet, which is fine
+                    print(f"⚠️ Could not migrate {table_name}: {e}")
+                    continue
         
-        conn.commit()
-        conn.close()
+            conn.commit()
+            conn.close()
         print("🎉 Transaction table migration completed!")
         
     except Exception as e:
@@ -80,6 +155,74 @@ def migrate_transaction_tables():
 # Initialize database on startup
 init_db()
 migrate_transaction_tables()
+if shards.enabled:
+    # Settle cross-shard transfers a crash left half done before taking new ones
+    recovered = shards.recover()
+    if recovered['aborted'] or recovered['completed']:
+        print(f"🔁 Cross-shard transfers recovered: {recovered['completed']} completed, {recovered['aborted']} aborted")
+    if recovered['blocked']:
+        print(f"🚨 {recovered['blocked']} cross-shard transfer(s) BLOCKED: a replayed debit exceeds the balance")
+    response_cache.path_for = lambda username: shards.shard_path(shards.shard_for(username=username) or 0)
+    donation_analytics.db_paths = shards.paths()
+    backup_scheduler.shard_paths = shards.paths()
+
+# Writes waiting for a group commit; the money endpoints shed load when it backs up
+admission.backlog = lambda: (max(shards.writer(shard).queue_depth() for shard in range(shards.count))
+                             if shards.enabled else writer.queue_depth())
+
+# Queue depths for /metrics, read when Prometheus scrapes
+metrics.gauge('bank_group_commit_queue_depth', 'Mutations waiting for a group commit, per database',
+              lambda: ({(os.path.basename(shards.shard_path(shard)),): shards.writer(shard).queue_depth()
+                        for shard in range(shards.count)}
+                       if shards.enabled else {('bank.db',): writer.queue_depth()}),
+              ['database'])
+metrics.gauge('bank_notification_queue_depth', 'Withdrawal notifications waiting for delivery',
+              lambda: (sum(shards.dispatcher(shard).queue_depth() for shard in range(shards.count))
+                       if shards.enabled else dispatcher.queue_depth()))
+metrics.gauge('bank_chain_outbox_depth', 'Chain recordings waiting in the outbox',
+              lambda: sum(outbox.queue_depth() for outbox in chain_outboxes()))
+
+def start_background_services(leader=True):
+    """
+    Start the background threads of this process
+
+    Queue drainers lease their rows, so every worker process may run them.
+    Backups and replica refreshes must run once per host: only in the `leader`.
+    """
+    # Deliver queued withdrawal notifications and chain recordings in the background
+    dispatcher.start()
+    shards.start()
+    chain_outbox.start()
+    # Share this process's counters with the other workers when BANK_METRICS_DIR is set
+    metrics.start()
+    if leader:
+        # Periodic online snapshots of bank.db (BANK_BACKUP_INTERVAL_HOURS=0 turns them off)
+        backup_scheduler.start()
+        # Keep the read replica fresh when BANK_READ_REPLICA is set
+        reads.start()
+
+def stop_background_services(drain_seconds=DRAIN_SECONDS):
+    """Commit queued writes, deliver what is due for up to `drain_seconds`, then stop the threads"""
+    writer.stop()
+    shards.stop()
+    dispatcher.stop()
+    chain_outbox.stop()
+    backup_scheduler.stop()
+    reads.stop()
+
+    # Anything left stays queued in the database for the next start
+    dispatchers = [shards.dispatcher(shard) for shard in range(shards.count)] if shards.enabled else [dispatcher]
+    deadline = time.monotonic() + drain_seconds
+    while time.monotonic() < deadline:
+        delivered = [queue.dispatch_due() for queue in dispatchers]
+        recorded = [outbox.record_due() for outbox in chain_outboxes()]
+        if not (any(delivered) or any(recorded)):
+            break
+    metrics.stop()
+
+# serve.py starts them in each worker process after the fork instead
+if not os.environ.get('BANK_DEFER_SERVICES'):
+    start_background_services()
 
 # Serve static files
 @app.route('/')
@@ -90,6 +233,11 @@ def index():
 def serve_static(filename):
     return send_from_directory('.', filename)
 
+@app.route('/metrics')
+def prometheus_metrics():
+    """Counters, latency histograms and queue depths in the Prometheus text format"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 # API Routes
 @app.route('/api/signup', methods=['POST'])
 def api_signup():
@@ -108,44 +256,52 @@ def api_signup():
         if age < 18:
             return jsonify({'success': False, 'message': 'You must be at least 18 years old'}), 400
 
-        # Check if username already exists
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT username FROM customers WHERE username = ?", (username,))
-        if cursor.fetchone():
-            conn.close()
-            return jsonify({'success': False, 'message': 'Username already exists'}), 400
-
-        # Generate unique account number
-        while True:
-            account_number = random.randint(10000000, 99999999)
-            cursor.execute("SELECT account_number FROM customers WHERE account_number = ?", (account_number,))
-            if not cursor.fetchone():
-                break
+        if shards.enabled:
+            # The directory in bank.db keeps usernames and account numbers unique across shards
+            while True:
+                account_number = random.randint(10000000, 99999999)
+                if shards.register(username, account_number) is not None:
+                    break
+                if shards.lookup(username=username):
+                    return jsonify({'success': False, 'message': 'Username already exists'}), 400
+            conn = get_db_connection(username=username)
+            cursor = conn.cursor()
+        else:
+            # Check if username already exists
+            conn = get_db_connection()
+            cursor = conn.cursor()
+            cursor.execute("SELECT username FROM customers WHERE username = ?", (username,))
+            if cursor.fetchone():
+                conn.close()
+                return jsonify({'success': False, 'message': 'Username already exists'}), 400
+
+            # Generate unique account number
+            while True:
+                account_number = random.randint(10000000, 99999999)
+                cursor.execute("SELECT account_number FROM customers WHERE account_number = ?", (account_number,))
+                if not cursor.fetchone():
+                    break
                 
         # Hash the password before storing it
         hashed_password = hashlib.sha256(password.encode()).hexdigest()
 
-        # Create customer
-        cursor.execute("""
-            INSERT INTO customers (username, password, name, age, city, balance, account_number, status)
-            VALUES (?, ?, ?, ?, ?, 0, ?, 1)
-        """, (username, hashed_password, name, age, city, account_number))
-        
-        # Create transaction table for user
-        cursor.execute(f"""
-            CREATE TABLE IF NOT EXISTS {username}_transaction (
-                timedate VARCHAR(30),
-                account_number INTEGER,
-                transaction_type VARCHAR(30),
-                amount INTEGER,
-                donor_id VARCHAR(64),
-                cause VARCHAR(50)
-            )
-        """)
-        
-        conn.commit()
-        conn.close()
+        try:
+            # Create customer
+            cursor.execute("""
+                INSERT INTO customers (username, password, name, age, city, balance, account_number, status)
+                VALUES (?, ?, ?, ?, ?, 0, ?, 1)
+            """, (username, hashed_password, name, age, city, account_number))
+
+            # Create transaction ledger for user
+            ledger.create_ledger(cursor, username)
+            conn.commit()
+        except Exception:
+            if shards.enabled:
+                # Release the directory entry so the username can be tried again
+                shards.unregister(username)
+            raise
+        finally:
+            conn.close()
 
         return jsonify({
             'success': True, 
@@ -166,7 +322,7 @@ def api_signin():
         if not all([username, password]):
             return jsonify({'success': False, 'message': 'Username and password are required'}), 400
 
-        conn = get_db_connection()
+        conn = get_db_connection(username=username)
         cursor = conn.cursor()
         cursor.execute("SELECT * FROM customers WHERE username = ?", (username,))
         user = cursor.fetchone()
@@ -206,24 +362,112 @@ def api_balance():
         if not username:
             return jsonify({'success': False, 'message': 'Username is required'}), 400
 
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT balance FROM customers WHERE username = ?", (username,))
-        result = cursor.fetchone()
-        conn.close()
+        # Served from the write-through account cache; SQLite is only read on a miss
+        account = account_cache.get(username=username)
+        if account is None:
+            conn = get_read_connection(username)
+            account = ledger.load_account(conn.cursor(), username=username, cache=not conn.replica)
+            conn.close()
 
-        if not result:
+        if not account:
             return jsonify({'success': False, 'message': 'User not found'}), 404
 
         return jsonify({
             'success': True,
-            'balance': result['balance']
+            'balance': account['balance']
         })
 
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)}), 500
 
+@app.route('/api/balances', methods=['POST'])
+def api_balances():
+    """Get balances for many accounts in one call"""
+    try:
+        data = request.json
+        if not data:
+            return jsonify({'success': False, 'message': 'No JSON data provided'}), 400
+
+        usernames = data.get('usernames') or []
+        account_numbers = data.get('account_numbers') or []
+        include_last_transaction = bool(data.get('include_last_transaction'))
+
+        if not isinstance(usernames, list) or not isinstance(account_numbers, list):
+            return jsonify({'success': False, 'message': 'usernames and account_numbers must be lists'}), 400
+
+        if not usernames and not account_numbers:
+            return jsonify({'success': False, 'message': 'Provide usernames or account_numbers'}), 400
+
+        if len(usernames) + len(account_numbers) > MAX_BATCH_ITEMS:
+            return jsonify({'success': False, 'message': f'At most {MAX_BATCH_ITEMS} accounts per request'}), 400
+
+        if not all(str(number).isdigit() for number in account_numbers):
+            return jsonify({'success': False, 'message': 'Account numbers must be numeric'}), 400
+        account_numbers = [int(number) for number in account_numbers]
+
+        by_username = {}
+        by_account = {}
+        balances = []
+        # One round of queries per database holding accounts (just bank.db unless sharded)
+        for shard in range(shards.count):
+            conn = shards.connect(shard)
+            cursor = conn.cursor()
+            try:
+                shard_usernames = ledger.fetch_accounts(cursor, 'username', usernames) if usernames else {}
+                shard_accounts = ledger.fetch_accounts(cursor, 'account_number', account_numbers) if account_numbers else {}
+                by_username.update(shard_usernames)
+                by_account.update(shard_accounts)
+
+                accounts = {row['username']: row for row in list(shard_usernames.values()) + list(shard_accounts.values())}
+                for username, row in accounts.items():
+                    entry = {
+                        'username': username,
+                        'account_number': row['account_number'],
+                        'balance': row['balance']
+                    }
+                    if include_last_transaction:
+                        try:
+                            cursor.execute(f"SELECT MAX(timedate) AS last_date FROM {username}_transaction")
+                            entry['last_transaction_date'] = cursor.fetchone()['last_date']
+                            if entry['last_transaction_date'] is None:
+                                # Everything may have been archived
+                                cursor.execute("SELECT MAX(last_timedate) AS last_date FROM ledger_archives WHERE username = ?",
+                                               (username,))
+                                entry['last_transaction_date'] = cursor.fetchone()['last_date']
+                        except sqlite3.OperationalError:
+                            # Table doesn't exist yet
+                            entry['last_transaction_date'] = None
+                    balances.append(entry)
+            finally:
+                conn.close()
+
+        return jsonify({
+            'success': True,
+            'balances': balances,
+            'not_found': {
+                'usernames': [username for username in dict.fromkeys(usernames) if username not in by_username],
+                'account_numbers': [number for number in dict.fromkeys(account_numbers) if number not in by_account]
+            }
+        })
+
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+# Mutations of the money endpoints, shared with the asyncio server (async_app.py)
+def deposit_mutation(username, account_number, amount, donor_id, cause):
+    def apply_deposit(txn):
+        # Update balance
+        new_balance = ledger.credit(txn, username, amount)
+
+        # Add transaction record
+        ledger.insert_entries(txn.cursor, [
+            ledger.new_entry(username, account_number, 'Amount Deposit', amount, donor_id, cause)
+        ])
+        return new_balance
+    return apply_deposit
+
 @app.route('/api/deposit', methods=['POST'])
+@admission.guard('deposit')
 def api_deposit():
     try:
         data = request.json
@@ -236,31 +480,14 @@ def api_deposit():
         if not all([username, amount, account_number]) or amount <= 0:
             return jsonify({'success': False, 'message': 'Invalid input data'}), 400
 
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Get current balance
-        cursor.execute("SELECT balance FROM customers WHERE username = ?", (username,))
-        current_balance = cursor.fetchone()['balance']
-        
-        # Update balance
-        new_balance = current_balance + amount
-        cursor.execute("UPDATE customers SET balance = ? WHERE username = ?", (new_balance, username))
-        
         # Store donor_id directly without hashing
         donor_id_value = None
         if donor_id:
             donor_id_value = str(donor_id)  # Convert to string if it's not already
-        
-        # Add transaction record
-        from datetime import datetime
-        cursor.execute(f"""
-            INSERT INTO {username}_transaction (timedate, account_number, transaction_type, amount, donor_id, cause)
-            VALUES (?, ?, 'Amount Deposit', ?, ?, ?)
-        """, (str(datetime.now()), account_number, amount, donor_id_value, cause))
-        
-        conn.commit()
-        conn.close()
+
+        # Committed together with concurrent requests by the group commit writer (of the account's shard)
+        new_balance = shards.writer(shards.shard_for(username=username)).execute(
+            deposit_mutation(username, account_number, amount, donor_id_value, cause))
 
         # 🔗 BLOCKCHAIN INTEGRATION: Record deposit on blockchain
         blockchain_result = None
@@ -301,10 +528,31 @@ def api_deposit():
             }
         })
 
+    except MutationRejected as e:
+        return jsonify({'success': False, 'message': e.message, **e.details}), e.status_code
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)}), 500
 
+def withdraw_mutation(username, account_number, amount, donor_id, cause, notification_payload, shard):
+    def apply_withdraw(txn):
+        cursor = txn.cursor
+        if not ledger.resolve_account(cursor, username=username):
+            raise MutationRejected('User not found', 404)
+
+        # Update balance; rejected if it does not cover the amount
+        new_balance = ledger.debit(txn, username, amount)
+
+        # Add transaction record
+        ledger.insert_entries(cursor, [
+            ledger.new_entry(username, account_number, 'Amount Withdraw', amount, donor_id, cause)
+        ])
+        notification_id = WebhookDispatcher.enqueue(cursor, notification_payload)
+        txn.after_commit(shards.dispatcher(shard).notify)
+        return new_balance, shards.notification_id(shard, notification_id)
+    return apply_withdraw
+
 @app.route('/api/withdraw', methods=['POST'])
+@admission.guard('withdraw')
 def api_withdraw():
     try:
         data = request.json
@@ -317,96 +565,36 @@ def api_withdraw():
         if not all([username, amount, account_number]) or amount <= 0:
             return jsonify({'success': False, 'message': 'Invalid input data'}), 400
 
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Get current balance
-        cursor.execute("SELECT balance FROM customers WHERE username = ?", (username,))
-        current_balance = cursor.fetchone()['balance']
-        
-        if amount > current_balance:
-            conn.close()
-            return jsonify({'success': False, 'message': 'Insufficient balance'}), 400
-        
-        # Update balance
-        new_balance = current_balance - amount
-        cursor.execute("UPDATE customers SET balance = ? WHERE username = ?", (new_balance, username))
-        
         # Store donor_id directly without hashing
         donor_id_value = None
         if donor_id:
             donor_id_value = str(donor_id)  # Convert to string if it's not already
-            
-        # Add transaction record
-        from datetime import datetime
-        cursor.execute(f"""
-            INSERT INTO {username}_transaction (timedate, account_number, transaction_type, amount, donor_id, cause)
-            VALUES (?, ?, 'Amount Withdraw', ?, ?, ?)
-        """, (str(datetime.now()), account_number, amount, donor_id_value, cause))
-        
-        conn.commit()
-        conn.close()
 
-        # � SEND NOTIFICATION TO WEBSITE INSTEAD OF IMMEDIATE BLOCKCHAIN RECORDING
-        notification_result = None
-        notification_sent = False
-        
-        try:
-            import requests
-            
-            # Generate unique transaction ID for tracking
-            bank_transaction_id = f"BANK_WD_{int(datetime.now().timestamp())}_{username}_{amount}"
-            
-            # Send withdrawal notification to website backend
-            notification_payload = {
-                'account_number': account_number,
-                'amount': amount,
-                'transaction_id': bank_transaction_id,
-                'bank_reference': f"REF_{username}_{int(datetime.now().timestamp())}",
-                'cause': cause or "Cash Withdrawal",
-                'description': f"Cash withdrawal of ₹{amount} by {username} from account {account_number}",
-                'withdrawal_type': 'CASH_WITHDRAWAL'
-            }
-            
-            print(f"🔔 Sending withdrawal notification to website:")
-            print(f"   Account: {account_number}")
-            print(f"   Amount: ₹{amount}")
-            print(f"   Transaction ID: {bank_transaction_id}")
-            print(f"   Cause: {cause or 'Cash Withdrawal'}")
-            
-            # Send notification to website backend
-            website_response = requests.post(
-                'http://localhost:5000/api/bank/withdrawal-notification',
-                json=notification_payload,
-                headers={'Content-Type': 'application/json'},
-                timeout=5
-            )
-            
-            if website_response.status_code in [200, 201]:
-                notification_result = website_response.json()
-                notification_sent = True
-                print(f"✅ Withdrawal notification sent successfully to website")
-                print(f"   NGO will have limited time to upload documents")
-                print(f"   Website transaction ID: {notification_result.get('data', {}).get('transaction_id', 'N/A')}")
-            else:
-                print(f"⚠️ Failed to send notification to website: {website_response.status_code}")
-                notification_result = {
-                    'success': False,
-                    'error': f"Website returned {website_response.status_code}: {website_response.text}"
-                }
-                
-        except requests.exceptions.RequestException as req_error:
-            print(f"❌ Network error sending notification: {req_error}")
-            notification_result = {
-                'success': False,
-                'error': f"Network error: {str(req_error)}"
-            }
-        except Exception as notification_error:
-            print(f"❌ Error sending withdrawal notification: {notification_error}")
-            notification_result = {
-                'success': False,
-                'error': str(notification_error)
-            }
+        # 🔔 QUEUE NOTIFICATION TO WEBSITE INSTEAD OF IMMEDIATE BLOCKCHAIN RECORDING
+        # Generate unique transaction ID for tracking
+        bank_transaction_id = f"BANK_WD_{int(datetime.now().timestamp())}_{username}_{amount}"
+
+        # The notification is committed together with the withdrawal and delivered
+        # by the webhook dispatcher, so the website being down cannot lose it
+        notification_payload = {
+            'account_number': account_number,
+            'amount': amount,
+            'transaction_id': bank_transaction_id,
+            'bank_reference': f"REF_{username}_{int(datetime.now().timestamp())}",
+            'cause': cause or "Cash Withdrawal",
+            'description': f"Cash withdrawal of ₹{amount} by {username} from account {account_number}",
+            'withdrawal_type': 'CASH_WITHDRAWAL'
+        }
+
+        shard = shards.shard_for(username=username)
+        new_balance, notification_id = shards.writer(shard).execute(
+            withdraw_mutation(username, account_number, amount, donor_id_value, cause, notification_payload, shard))
+
+        print(f"🔔 Withdrawal notification queued for website:")
+        print(f"   Account: {account_number}")
+        print(f"   Amount: ₹{amount}")
+        print(f"   Transaction ID: {bank_transaction_id}")
+        print(f"   Notification ID: {notification_id}")
 
         return jsonify({
             'success': True,
@@ -414,17 +602,74 @@ def api_withdraw():
             'new_balance': new_balance,
             'withdrawal_details': {
                 'bank_transaction_id': bank_transaction_id,
-                'notification_sent': notification_sent,
-                'website_response': notification_result,
-                'ngo_deadline_info': notification_result.get('data') if notification_result and notification_result.get('success') else None
+                'notification_sent': False,
+                'notification_queued': True,
+                'notification_id': notification_id,
+                'website_response': None,
+                'ngo_deadline_info': None
             },
             'next_steps': "NGO must upload supporting documents within the specified time limit for blockchain recording"
         })
 
+    except MutationRejected as e:
+        return jsonify({'success': False, 'message': e.message, **e.details}), e.status_code
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+@app.route('/api/withdrawal-notifications/<int:notification_id>', methods=['GET'])
+def api_withdrawal_notification(notification_id):
+    """Get the delivery state of a queued withdrawal notification"""
+    try:
+        shard, local_id = shards.split_notification_id(notification_id)
+        notification = shards.dispatcher(shard).get_notification(local_id)
+        if not notification:
+            return jsonify({'success': False, 'message': 'Notification not found'}), 404
+        notification['id'] = notification_id
+
+        website_response = notification['website_response']
+        return jsonify({
+            'success': True,
+            'notification': notification,
+            'ngo_deadline_info': website_response.get('data') if isinstance(website_response, dict) and website_response.get('success') else None
+        })
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)}), 500
 
+def transfer_mutation(sender_username, sender_account, receiver_account, amount, sender_donor_id, cause):
+    def apply_transfer(txn):
+        cursor = txn.cursor
+
+        if not ledger.resolve_account(cursor, username=sender_username):
+            raise MutationRejected('Sender not found', 404)
+
+        # Check if receiver exists
+        receiver_data = ledger.resolve_account(cursor, account_number=receiver_account)
+        if not receiver_data:
+            raise MutationRejected('Receiver account not found', 404)
+
+        if receiver_account == int(sender_account):
+            raise MutationRejected('Cannot transfer to your own account')
+
+        receiver_username = receiver_data['username']
+
+        # Update balances; the debit is rejected if it does not cover the amount
+        new_sender_balance = ledger.debit(txn, sender_username, amount)
+        ledger.credit(txn, receiver_username, amount)
+
+        # Add transaction records; the receiver sees the sender's account number as the donor
+        current_time = str(datetime.now())
+        ledger.insert_entries(cursor, [
+            ledger.new_entry(sender_username, sender_account, f'Fund Transfer -> {receiver_account}',
+                             amount, sender_donor_id, cause, current_time),
+            ledger.new_entry(receiver_username, receiver_account, f'Fund Transfer From {sender_account}',
+                             amount, sender_account, cause, current_time)
+        ])
+        return new_sender_balance
+    return apply_transfer
+
 @app.route('/api/transfer', methods=['POST'])
+@idempotency.keyed('transfer')
+@admission.guard('transfer')
 def api_transfer():
     try:
         data = request.json
@@ -438,73 +683,22 @@ def api_transfer():
         if not all([sender_username, receiver_account, amount, sender_account]) or amount <= 0:
             return jsonify({'success': False, 'message': 'Invalid input data'}), 400
 
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Get sender's current balance
-        cursor.execute("SELECT balance FROM customers WHERE username = ?", (sender_username,))
-        sender_data = cursor.fetchone()
-        if not sender_data:
-            conn.close()
-            return jsonify({'success': False, 'message': 'Sender not found'}), 404
-            
-        sender_balance = sender_data['balance']
-        
-        if amount > sender_balance:
-            conn.close()
-            return jsonify({'success': False, 'message': 'Insufficient balance'}), 400
-        
-        # Check if receiver exists
-        cursor.execute("SELECT username, balance FROM customers WHERE account_number = ?", (receiver_account,))
-        receiver_data = cursor.fetchone()
-        if not receiver_data:
-            conn.close()
-            return jsonify({'success': False, 'message': 'Receiver account not found'}), 404
-        
-        if receiver_account == int(sender_account):
-            conn.close()
-            return jsonify({'success': False, 'message': 'Cannot transfer to your own account'}), 400
-        
-        receiver_username = receiver_data['username']
-        receiver_balance = receiver_data['balance']
-        
-        # Update balances
-        new_sender_balance = sender_balance - amount
-        new_receiver_balance = receiver_balance + amount
-        
-        cursor.execute("UPDATE customers SET balance = ? WHERE username = ?", (new_sender_balance, sender_username))
-        cursor.execute("UPDATE customers SET balance = ? WHERE username = ?", (new_receiver_balance, receiver_username))
-        
-        # Process donor IDs for sender and receiver
-        sender_donor_id = None
-        receiver_donor_id = None
-        
         # For sender's transaction, use the original donor_id if provided
+        sender_donor_id = None
         if donor_id:
             sender_donor_id = str(donor_id)
-        
-        # For receiver's transaction, use the sender's account number as the donor
-        # This ensures the recipient knows who sent the money
-        receiver_donor_id = str(sender_account)
-            
-        # Add transaction records
-        from datetime import datetime
-        current_time = str(datetime.now())
-        
-        # Sender transaction
-        cursor.execute(f"""
-            INSERT INTO {sender_username}_transaction (timedate, account_number, transaction_type, amount, donor_id, cause)
-            VALUES (?, ?, 'Fund Transfer -> {receiver_account}', ?, ?, ?)
-        """, (current_time, sender_account, amount, sender_donor_id, cause))
-        
-        # Receiver transaction
-        cursor.execute(f"""
-            INSERT INTO {receiver_username}_transaction (timedate, account_number, transaction_type, amount, donor_id, cause)
-            VALUES (?, ?, 'Fund Transfer From {sender_account}', ?, ?, ?)
-        """, (current_time, receiver_account, amount, receiver_donor_id, cause))
-        
-        conn.commit()
-        conn.close()
+
+        sender = shards.lookup(username=sender_username)
+        receiver = shards.lookup(account_number=receiver_account)
+        if sender and receiver and sender[2] != receiver[2]:
+            if receiver_account == int(sender_account):
+                raise MutationRejected('Cannot transfer to your own account')
+            # Accounts on different shards: two-phase commit through the coordinator log
+            new_sender_balance = shards.transfer((sender_username, sender_account, sender[2]), receiver,
+                                                 amount, sender_donor_id, cause)
+        else:
+            new_sender_balance = shards.writer(sender[2] if sender else None).execute(
+                transfer_mutation(sender_username, sender_account, receiver_account, amount, sender_donor_id, cause))
 
         # 🔗 BLOCKCHAIN INTEGRATION: Record transfer on blockchain
         blockchain_result = None
@@ -581,10 +775,212 @@ def api_transfer():
             }
         })
 
+    except MutationRejected as e:
+        return jsonify({'success': False, 'message': e.message, **e.details}), e.status_code
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+@app.route('/api/transfer/bulk', methods=['POST'])
+def api_transfer_bulk():
+    """Pay many beneficiaries from one account in a single all-or-nothing transaction"""
+    try:
+        data = request.json
+        if not data:
+            return jsonify({'success': False, 'message': 'No JSON data provided'}), 400
+
+        sender_username = data.get('username')
+        sender_account = data.get('account_number')
+        transfers = data.get('transfers')
+        default_cause = data.get('cause')
+
+        if not all([sender_username, sender_account]) or not str(sender_account).isdigit():
+            return jsonify({'success': False, 'message': 'Username and account number are required'}), 400
+
+        if not isinstance(transfers, list) or not transfers:
+            return jsonify({'success': False, 'message': 'A non-empty list of transfers is required'}), 400
+
+        if len(transfers) > MAX_BATCH_ITEMS:
+            return jsonify({'success': False, 'message': f'At most {MAX_BATCH_ITEMS} transfers per request'}), 400
+
+        sender_account = int(sender_account)
+
+        # Validate every item before touching the database
+        results = []
+        for index, item in enumerate(transfers):
+            receiver_account = item.get('receiver_account') if isinstance(item, dict) else None
+            amount = item.get('amount') if isinstance(item, dict) else None
+            result = {'index': index, 'receiver_account': receiver_account, 'amount': amount}
+            results.append(result)
+
+            if not receiver_account or not str(receiver_account).isdigit():
+                result.update(success=False, message='Invalid receiver account')
+            elif not isinstance(amount, int) or isinstance(amount, bool) or amount <= 0:
+                result.update(success=False, message='Amount must be a positive whole number')
+            elif int(receiver_account) == sender_account:
+                result.update(success=False, message='Cannot transfer to your own account')
+            else:
+                result['receiver_account'] = int(receiver_account)
+
+        def reject_invalid():
+            """Fail the whole run if any item is invalid"""
+            if any('success' in result for result in results):
+                for result in results:
+                    result.setdefault('success', False)
+                    result.setdefault('message', 'Not applied')
+                raise MutationRejected('No transfers were made because some items are invalid',
+                                       details={'results': results})
+
+        def payout_records(receiver_usernames):
+            """(result, sender's entry, receiver's entry) of every transfer, plus the run's chain recordings"""
+            records = []
+            operations = []
+            current_time = str(datetime.now())
+            for item, result in zip(transfers, results):
+                receiver_account = result['receiver_account']
+                amount = result['amount']
+                cause = item.get('cause') or default_cause
+
+                # Sender keeps the original donor_id, the receiver sees the sender's account as donor
+                sender_entry = ledger.new_entry(sender_username, sender_account, f'Fund Transfer -> {receiver_account}',
+                                                amount, item.get('donor_id'), cause, current_time)
+                receiver_entry = ledger.new_entry(receiver_usernames[receiver_account], receiver_account,
+                                                  f'Fund Transfer From {sender_account}', amount, sender_account,
+                                                  cause, current_time)
+                records.append((result, sender_entry, receiver_entry))
+
+                operations.append({
+                    'operation': 'spending',
+                    'ngo_account': sender_account,
+                    'counterparty_id': f"transfer_to_{receiver_account}",
+                    'cause': cause or "Fund Transfer (Outgoing)",
+                    'amount': amount
+                })
+                operations.append({
+                    'operation': 'donation',
+                    'ngo_account': receiver_account,
+                    'counterparty_id': sender_entry['donor_id'] or f"transfer_from_{sender_account}",
+                    'cause': cause or "Fund Transfer (Incoming)",
+                    'amount': amount
+                })
+            return records, operations
+
+        def bulk_transfer_mutation(outbox):
+            def apply_bulk_transfer(txn):
+                cursor = txn.cursor
+                cursor.execute("SELECT account_number, balance FROM customers WHERE username = ?", (sender_username,))
+                sender_data = cursor.fetchone()
+                if not sender_data or sender_data['account_number'] != sender_account:
+                    raise MutationRejected('Sender not found', 404)
+
+                # Resolve all receivers with one indexed query
+                receivers = ledger.fetch_accounts(cursor, 'account_number',
+                                                  [r['receiver_account'] for r in results if 'success' not in r])
+                for result in results:
+                    if 'success' not in result and result['receiver_account'] not in receivers:
+                        result.update(success=False, message='Receiver account not found')
+                reject_invalid()
+
+                # One balance check for the whole payout run
+                total = sum(result['amount'] for result in results)
+                if total > sender_data['balance']:
+                    raise MutationRejected(
+                        f'Insufficient balance: payout total ₹{total} exceeds balance ₹{sender_data["balance"]}')
+
+                records, operations = payout_records({number: receiver['username']
+                                                      for number, receiver in receivers.items()})
+                balances = {sender_username: sender_data['balance'] - total}
+                entries = []
+                for result, sender_entry, receiver_entry in records:
+                    receiver_username = receiver_entry['username']
+                    balances[receiver_username] = balances.get(
+                        receiver_username, receivers[result['receiver_account']]['balance']) + result['amount']
+                    entries.append(sender_entry)
+                    entries.append(receiver_entry)
+
+                ledger.apply_balances(txn, balances)
+                ledger.insert_entries(cursor, entries)
+                batch_id = ChainOutbox.enqueue_batch(cursor, operations)
+                txn.after_commit(outbox.notify)
+                return balances[sender_username], batch_id, records, len(operations)
+            return apply_bulk_transfer
+
+        sender = shards.lookup(username=sender_username)
+        receivers = {}
+        if sender:
+            receivers = {result['receiver_account']: shards.lookup(account_number=result['receiver_account'])
+                         for result in results if 'success' not in result}
+
+        if sender and any(receiver and receiver[2] != sender[2] for receiver in receivers.values()):
+            # Receivers on other shards: one two-phase commit through the coordinator log
+            if sender[1] != sender_account:
+                raise MutationRejected('Sender not found', 404)
+            for result in results:
+                if 'success' not in result and not receivers[result['receiver_account']]:
+                    result.update(success=False, message='Receiver account not found')
+            reject_invalid()
+
+            records, operations = payout_records({number: receiver[0] for number, receiver in receivers.items()})
+            try:
+                new_balance, batch_id = shards.transfer_many(sender, [
+                    (receivers[result['receiver_account']], result['amount'], sender_entry, receiver_entry)
+                    for result, sender_entry, receiver_entry in records
+                ], operations)
+            except MutationRejected as e:
+                # The debit of the whole run is the only balance check
+                total = sum(result['amount'] for result in results)
+                raise MutationRejected(f'{e.message}: payout total ₹{total} exceeds the balance', e.status_code)
+            queued = len(operations)
+        else:
+            shard = sender[2] if sender else None
+            new_balance, batch_id, records, queued = shards.writer(shard).execute(
+                bulk_transfer_mutation(shards.outbox(shard)))
+
+        for result, _, _ in records:
+            result.update(success=True, message=f'₹{result["amount"]} transferred to account {result["receiver_account"]}')
+        total = sum(result['amount'] for result in results)
+        print(f"💸 Bulk payout from {sender_account}: {len(transfers)} transfers, ₹{total}, chain batch {batch_id}")
+
+        return jsonify({
+            'success': True,
+            'message': f'₹{total} paid to {len(transfers)} beneficiaries',
+            'total_amount': total,
+            'new_balance': new_balance,
+            'results': results,
+            'blockchain': {
+                'queued': queued,
+                'batch_id': batch_id
+            }
+        })
+
+    except MutationRejected as e:
+        return jsonify({'success': False, 'message': e.message, **e.details}), e.status_code
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)}), 500
 
+def add_money_mutation(account_number, amount, donor_id, cause):
+    def apply_add_money(txn):
+        cursor = txn.cursor
+
+        # Find user by account number (served from the account cache when warm)
+        user = ledger.resolve_account(cursor, account_number=account_number)
+        if not user:
+            raise MutationRejected('Account not found', 404)
+
+        username = user['username']
+
+        # Update balance
+        new_balance = ledger.credit(txn, username, amount)
+
+        # Add transaction record
+        ledger.insert_entries(cursor, [
+            ledger.new_entry(username, account_number, 'Donation Received', amount, donor_id, cause)
+        ])
+        return new_balance
+    return apply_add_money
+
 @app.route('/api/add_money', methods=['POST'])
+@idempotency.keyed('add_money')
+@admission.guard('add_money')
 def api_add_money():
     try:
         data = request.json
@@ -602,37 +998,13 @@ def api_add_money():
         if amount <= 0:
             return jsonify({'success': False, 'message': 'Amount must be greater than zero'}), 400
 
-        # Find user by account number
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT username, balance FROM customers WHERE account_number = ?", (account_number,))
-        user = cursor.fetchone()
-
-        if not user:
-            conn.close()
-            return jsonify({'success': False, 'message': 'Account not found'}), 404
-
-        username = user['username']
-        current_balance = user['balance']
-        
-        # Update balance
-        new_balance = current_balance + amount
-        cursor.execute("UPDATE customers SET balance = ? WHERE username = ?", (new_balance, username))
-        
         # Store donor_id directly without hashing
         donor_id_value = None
         if donor_id:
             donor_id_value = str(donor_id)  # Convert to string if it's not already
-        
-        # Add transaction record
-        from datetime import datetime
-        cursor.execute(f"""
-            INSERT INTO {username}_transaction (timedate, account_number, transaction_type, amount, donor_id, cause)
-            VALUES (?, ?, 'Donation Received', ?, ?, ?)
-        """, (str(datetime.now()), account_number, amount, donor_id_value, cause))
-        
-        conn.commit()
-        conn.close()
+
+        new_balance = shards.writer(shards.shard_for(account_number=account_number)).execute(
+            add_money_mutation(account_number, amount, donor_id_value, cause))
 
         # 🔗 BLOCKCHAIN INTEGRATION: Record donation on blockchain
         blockchain_result = None
@@ -677,10 +1049,140 @@ def api_add_money():
             }
         })
 
+    except MutationRejected as e:
+        return jsonify({'success': False, 'message': e.message, **e.details}), e.status_code
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+@app.route('/api/add_money/batch', methods=['POST'])
+def api_add_money_batch():
+    """Credit many donations in one transaction (per shard) and queue their blockchain recording as one batch"""
+    try:
+        data = request.json
+        if not data:
+            return jsonify({'success': False, 'message': 'No JSON data provided'}), 400
+
+        donations = data.get('donations')
+        if not isinstance(donations, list) or not donations:
+            return jsonify({'success': False, 'message': 'A non-empty list of donations is required'}), 400
+
+        if len(donations) > MAX_BATCH_ITEMS:
+            return jsonify({'success': False, 'message': f'At most {MAX_BATCH_ITEMS} donations per batch'}), 400
+
+        # Validate every item before touching the database
+        results = []
+        valid = []
+        for index, item in enumerate(donations):
+            account_number = item.get('account_number') if isinstance(item, dict) else None
+            amount = item.get('amount') if isinstance(item, dict) else None
+            result = {'index': index, 'account_number': account_number, 'amount': amount}
+            results.append(result)
+
+            if not account_number or not amount:
+                result.update(success=False, message='Account number and amount are required')
+            elif not str(account_number).isdigit():
+                result.update(success=False, message='Invalid account number')
+            elif not isinstance(amount, int) or isinstance(amount, bool) or amount <= 0:
+                result.update(success=False, message='Amount must be a positive whole number')
+            else:
+                valid.append((index, int(account_number), item))
+
+        def donations_mutation(items, outbox, batch_id):
+            def apply_donations(txn):
+                cursor = txn.cursor
+
+                # Resolve all accounts with one indexed query
+                accounts = ledger.fetch_accounts(cursor, 'account_number',
+                                                 [account_number for _, account_number, _ in items])
+
+                balances = {}
+                entries = []
+                operations = []
+                for index, account_number, item in items:
+                    user = accounts.get(account_number)
+                    if not user:
+                        results[index].update(success=False, message='Account not found')
+                        continue
+
+                    username = user['username']
+                    amount = item['amount']
+                    donor_id = item.get('donor_id')
+                    cause = item.get('cause')
+
+                    balances[username] = balances.get(username, user['balance']) + amount
+                    entry = ledger.new_entry(username, account_number, 'Donation Received', amount, donor_id, cause)
+                    entries.append(entry)
+                    operations.append({
+                        'operation': 'donation',
+                        'ngo_account': account_number,
+                        'counterparty_id': entry['donor_id'] or "ANONYMOUS",
+                        'cause': cause or "general",
+                        'amount': amount
+                    })
+                    results[index].update(success=True, message=f'₹{amount} added to account {account_number}',
+                                          new_balance=balances[username])
+
+                if entries:
+                    ledger.apply_balances(txn, balances)
+                    ledger.insert_entries(cursor, entries)
+                    ChainOutbox.enqueue_batch(cursor, operations, batch_id)
+                    txn.after_commit(outbox.notify)
+                return len(entries)
+            return apply_donations
+
+        # One transaction per shard; their chain recordings share one batch id
+        by_shard = {}
+        for entry in valid:
+            by_shard.setdefault(shards.shard_of(entry[1]), []).append(entry)
+
+        batch_id = uuid.uuid4().hex
+        succeeded = 0
+        errors = []
+        for shard, items in sorted(by_shard.items()):
+            try:
+                succeeded += shards.writer(shard).execute(donations_mutation(items, shards.outbox(shard), batch_id))
+            except Exception as e:
+                errors.append(e)
+                for index, _, _ in items:
+                    results[index].update(success=False, message=f'Not applied: {e}')
+        if errors and len(errors) == len(by_shard):
+            raise errors[0]
+        if not succeeded:
+            batch_id = None
+
+        print(f"💰 Batch donation ingest: {succeeded}/{len(donations)} credited, chain batch {batch_id}")
+
+        return jsonify({
+            'success': True,
+            'message': f'{succeeded} of {len(donations)} donations credited',
+            'processed': len(donations),
+            'succeeded': succeeded,
+            'failed': len(donations) - succeeded,
+            'results': results,
+            'blockchain': {
+                'queued': succeeded,
+                'batch_id': batch_id
+            }
+        })
+
+    except MutationRejected as e:
+        return jsonify({'success': False, 'message': e.message, **e.details}), e.status_code
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+@app.route('/api/chain-batches/<batch_id>', methods=['GET'])
+def api_chain_batch(batch_id):
+    """Get the blockchain recording state of a queued batch"""
+    try:
+        batch = ChainOutbox.merge_batches(batch_id, [outbox.get_batch(batch_id) for outbox in chain_outboxes()])
+        if not batch:
+            return jsonify({'success': False, 'message': 'Batch not found'}), 404
+        return jsonify({'success': True, 'batch': batch})
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)}), 500
 
 @app.route('/api/transactions', methods=['POST'])
+@response_cache.conditional('transactions')
 def api_transactions():
     try:
         data = request.json
@@ -692,7 +1194,7 @@ def api_transactions():
         if not username:
             return jsonify({'success': False, 'message': 'Username is required'}), 400
 
-        conn = get_db_connection()
+        conn = get_read_connection(username)
         cursor = conn.cursor()
         
         try:
@@ -708,7 +1210,7 @@ def api_transactions():
                     'amount': trans['amount'],
                     'donor_id': trans['donor_id'],  # Added donor_id to response
                     'cause': trans['cause'] if 'cause' in trans.keys() else None,  # Add cause to response
-                    'transaction_direction': 'credit' if 'Deposit' in trans['transaction_type'] or 'From' in trans['transaction_type'] or 'Received' in trans['transaction_type'] else 'debit'
+                    'transaction_direction': ledger.transaction_direction(trans['transaction_type'])
                 })
             
             conn.close()
@@ -727,6 +1229,7 @@ def api_transactions():
         return jsonify({'success': False, 'message': str(e)}), 500
 
 @app.route('/api/epassbook', methods=['POST'])
+@response_cache.conditional('epassbook')
 def api_epassbook():
     try:
         data = request.json
@@ -741,6 +1244,10 @@ def api_epassbook():
         start_date = data.get('start_date')
         end_date = data.get('end_date')
         transaction_type = data.get('transaction_type')  # Can be 'deposit', 'withdraw', 'transfer' or None for all
+        cause = data.get('cause')
+        min_amount = data.get('min_amount')
+        max_amount = data.get('max_amount')
+        donor_id = data.get('donor_id')
         page = int(data.get('page', 1))
         per_page = int(data.get('per_page', 20))  # Default 20 transactions per page
         export_format = data.get('export_format')  # 'csv' for CSV export
@@ -751,64 +1258,26 @@ def api_epassbook():
         if per_page < 1 or per_page > 100:  # Limit max per_page to 100
             per_page = 20
             
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        try:
+            where_sql, filter_params = ledger.passbook_filters(
+                start_date, end_date, transaction_type, cause, min_amount, max_amount, donor_id)
+        except ValueError as e:
+            return jsonify({'success': False, 'message': str(e)}), 400
+
+        conn = get_read_connection(username)
         
         try:
-            # Start building the query with parameters
-            query = f"SELECT * FROM {username}_transaction WHERE 1=1"
-            params = []
-            
-            # Add date filters if provided
-            if start_date:
-                query += " AND timedate >= ?"
-                params.append(start_date)
-            
-            if end_date:
-                query += " AND timedate <= ?"
-                params.append(end_date)
-            
-            # Add transaction type filter if provided
-            if transaction_type:
-                if transaction_type.lower() == 'deposit':
-                    query += " AND transaction_type LIKE '%Deposit%'"
-                elif transaction_type.lower() == 'withdraw':
-                    query += " AND transaction_type LIKE '%Withdraw%'"
-                elif transaction_type.lower() == 'transfer':
-                    query += " AND transaction_type LIKE '%Transfer%'"
-            
-            # Add ordering and pagination
-            offset = (page - 1) * per_page
-            query += " ORDER BY timedate DESC LIMIT ? OFFSET ?"
-            params.extend([per_page, offset])
-            
-            # Execute the query
-            cursor.execute(query, params)
-            transactions = cursor.fetchall()
-            
-            # Get total count for pagination
-            count_query = f"SELECT COUNT(*) as total FROM {username}_transaction WHERE 1=1"
-            count_params = []
-            
-            # Add the same filters to count query
-            if start_date:
-                count_query += " AND timedate >= ?"
-                count_params.append(start_date)
-            
-            if end_date:
-                count_query += " AND timedate <= ?"
-                count_params.append(end_date)
-            
-            if transaction_type:
-                if transaction_type.lower() == 'deposit':
-                    count_query += " AND transaction_type LIKE '%Deposit%'"
-                elif transaction_type.lower() == 'withdraw':
-                    count_query += " AND transaction_type LIKE '%Withdraw%'"
-                elif transaction_type.lower() == 'transfer':
-                    count_query += " AND transaction_type LIKE '%Transfer%'"
-            
-            cursor.execute(count_query, count_params)
-            total_count = cursor.fetchone()['total']
+            # Archived periods are only read when the date range reaches them
+            history = ledger_archive.ArchivedLedger(conn, username, start_date, end_date)
+            try:
+                # Filters run on the ledger table's indexes; the page is merged across archives
+                offset = (page - 1) * per_page
+                transactions = list(history.rows(where_sql, filter_params, limit=per_page, offset=offset))
+
+                # Get total count for pagination with the same filters
+                total_count = history.count(where_sql, filter_params)
+            finally:
+                history.close()
             total_pages = (total_count + per_page - 1) // per_page  # Ceiling division
             
             # Format the transaction data
@@ -822,7 +1291,7 @@ def api_epassbook():
                     'donor_id': trans['donor_id'],
                     'cause': trans['cause'] if 'cause' in trans.keys() else None,  # Add cause to response
                     # Add additional useful data
-                    'transaction_direction': 'credit' if 'Deposit' in trans['transaction_type'] or 'From' in trans['transaction_type'] or 'Received' in trans['transaction_type'] else 'debit'
+                    'transaction_direction': ledger.transaction_direction(trans['transaction_type'])
                 })
             
             # Check if we need to export to CSV
@@ -882,7 +1351,129 @@ def api_epassbook():
     except Exception as e:
         return jsonify({'success': False, 'message': f'Error processing request: {str(e)}'}), 500
 
+@app.route('/api/epassbook/export', methods=['GET', 'POST'])
+def api_epassbook_export():
+    """Stream the full filtered passbook history as CSV"""
+    try:
+        # Accept JSON, the passbook's hidden form, or a plain download link
+        data = request.get_json(silent=True) or request.form or request.args
+        username = data.get('username')
+        if not username:
+            return jsonify({'success': False, 'message': 'Username is required'}), 400
+
+        try:
+            where_sql, params = ledger.passbook_filters(
+                data.get('start_date'), data.get('end_date'), data.get('transaction_type'),
+                data.get('cause'), data.get('min_amount'), data.get('max_amount'), data.get('donor_id'))
+        except ValueError as e:
+            return jsonify({'success': False, 'message': str(e)}), 400
+
+        conn = get_db_connection(username=username)
+        history = None
+        try:
+            history = ledger_archive.ArchivedLedger(conn, username, data.get('start_date'), data.get('end_date'))
+            # Run the query before responding so a missing table is still a clean 404
+            transactions = history.rows(where_sql, params)
+        except sqlite3.OperationalError as e:
+            if history is not None:
+                history.close()
+            conn.close()
+            return jsonify({'success': False, 'message': f'Database operation error: {str(e)}'}), 404
+
+        def generate():
+            # Rows are read and written a chunk at a time, so memory stays flat for any history length
+            try:
+                output = io.StringIO()
+                csv_writer = csv.writer(output)
+                csv_writer.writerow(['Date & Time', 'Account Number', 'Transaction Type', 'Amount', 'Direction', 'Reference ID', 'Cause'])
+
+                while True:
+                    rows = list(itertools.islice(transactions, EXPORT_FETCH_SIZE))
+                    if not rows:
+                        break
+                    for trans in rows:
+                        csv_writer.writerow([
+                            trans['timedate'],
+                            trans['account_number'],
+                            trans['transaction_type'],
+                            trans['amount'],
+                            ledger.transaction_direction(trans['transaction_type']),
+                            trans['donor_id'] or 'N/A',
+                            trans['cause'] or 'N/A'
+                        ])
+                    yield output.getvalue()
+                    output.seek(0)
+                    output.truncate(0)
+
+                yield output.getvalue()
+            finally:
+                history.close()
+                conn.close()
+
+        current_date = datetime.now().strftime("%Y-%m-%d")
+        response = Response(generate(), mimetype='text/csv')
+        response.headers["Content-Disposition"] = f"attachment; filename=ePassbook_{username}_{current_date}_full.csv"
+        return response
+
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'Error processing request: {str(e)}'}), 500
+
+@app.route('/api/ledger/export', methods=['POST'])
+def api_ledger_export():
+    """Export the ledger of all (or selected) accounts as a columnar file for analytics"""
+    try:
+        data = admin_body()
+        # The export spans every account
+        denied = admin_denied(data)
+        if denied:
+            return denied
+
+        usernames = data.get('usernames')
+        if isinstance(usernames, str):
+            usernames = [name.strip() for name in usernames.split(',') if name.strip()]
+
+        fmt = data.get('format', 'auto')
+        if fmt not in ('auto', 'parquet', 'arrow', 'npz'):
+            return jsonify({'success': False, 'message': 'format must be auto, parquet, arrow or npz'}), 400
+        if fmt == 'auto':
+            fmt = 'parquet' if ledger_export.pa is not None else 'npz'
+        if fmt != 'npz' and ledger_export.pa is None:
+            return jsonify({'success': False, 'message': 'pyarrow is not installed; use format npz'}), 400
+
+        extension = {'parquet': '.parquet', 'arrow': '.arrow', 'npz': '.npz'}[fmt]
+        fd, path = tempfile.mkstemp(prefix='ledger_', suffix=extension)
+        os.close(fd)
+        try:
+            result = ledger_export.export_ledger(path, usernames, data.get('start_date'), data.get('end_date'), fmt,
+                                                 db_paths=shards.paths())
+        except Exception:
+            os.remove(path)
+            raise
+
+        def generate():
+            # The file was written in chunks; send it the same way and remove it afterwards
+            try:
+                with open(path, 'rb') as export_file:
+                    while True:
+                        block = export_file.read(1024 * 1024)
+                        if not block:
+                            break
+                        yield block
+            finally:
+                os.remove(path)
+
+        current_date = datetime.now().strftime("%Y-%m-%d")
+        response = Response(generate(), mimetype='application/octet-stream')
+        response.headers["Content-Disposition"] = f"attachment; filename=ledger_{current_date}{extension}"
+        response.headers["Content-Length"] = str(os.path.getsize(path))
+        response.headers["X-Export-Rows"] = str(result['rows'])
+        return response
+
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'Error processing request: {str(e)}'}), 500
+
 @app.route('/api/epassbook/summary', methods=['POST'])
+@response_cache.conditional('epassbook_summary')
 def api_epassbook_summary():
     try:
         data = request.json
@@ -897,13 +1488,12 @@ def api_epassbook_summary():
         start_date = data.get('start_date')
         end_date = data.get('end_date')
         
-        conn = get_db_connection()
+        conn = get_read_connection(username)
         cursor = conn.cursor()
         
         try:
             # Get basic account details
-            cursor.execute("SELECT name, account_number, balance FROM customers WHERE username = ?", (username,))
-            account_info = cursor.fetchone()
+            account_info = ledger.resolve_account(cursor, username=username, cache=not conn.replica)
             
             if not account_info:
                 conn.close()
@@ -921,48 +1511,65 @@ def api_epassbook_summary():
                 where_clause += " AND timedate <= ?"
                 params.append(end_date)
             
-            # Get total deposits
-            cursor.execute(f"""
-                SELECT COALESCE(SUM(amount), 0) as total 
-                FROM {username}_transaction 
-                WHERE {where_clause} AND (
-                    transaction_type LIKE '%Deposit%' OR 
-                    transaction_type LIKE '%From%' OR 
-                    transaction_type LIKE '%Received%'
-                )
-            """, params)
-            total_deposits = cursor.fetchone()['total']
+            # Archived periods are only read when the date range reaches them; each part is
+            # summarised on its own connection and the figures are added up
+            total_deposits = 0
+            total_withdrawals = 0
+            counts = dict.fromkeys(['total_transactions', 'deposit_count', 'withdrawal_count', 'transfer_count'], 0)
+            first_dates = []
+            last_dates = []
+            history = ledger_archive.ArchivedLedger(conn, username, start_date, end_date)
+            try:
+                for part, transactions in history.views():
+                    cursor = part.cursor()
+
+                    # Get total deposits
+                    cursor.execute(f"""
+                        SELECT COALESCE(SUM(amount), 0) as total 
+                        FROM {transactions} 
+                        WHERE {where_clause} AND (
+                            transaction_type LIKE '%Deposit%' OR 
+                            transaction_type LIKE '%From%' OR 
+                            transaction_type LIKE '%Received%'
+                        )
+                    """, params)
+                    total_deposits += cursor.fetchone()['total']
             
-            # Get total withdrawals
-            cursor.execute(f"""
-                SELECT COALESCE(SUM(amount), 0) as total 
-                FROM {username}_transaction 
-                WHERE {where_clause} AND (
-                    transaction_type LIKE '%Withdraw%' OR 
-                    transaction_type LIKE '%Transfer ->%'
-                )
-            """, params)
-            total_withdrawals = cursor.fetchone()['total']
+                    # Get total withdrawals
+                    cursor.execute(f"""
+                        SELECT COALESCE(SUM(amount), 0) as total 
+                        FROM {transactions} 
+                        WHERE {where_clause} AND (
+                            transaction_type LIKE '%Withdraw%' OR 
+                            transaction_type LIKE '%Transfer ->%'
+                        )
+                    """, params)
+                    total_withdrawals += cursor.fetchone()['total']
             
-            # Get transaction counts
-            cursor.execute(f"""
-                SELECT 
-                    COUNT(*) as total_transactions,
-                    SUM(CASE WHEN transaction_type LIKE '%Deposit%' THEN 1 ELSE 0 END) as deposit_count,
-                    SUM(CASE WHEN transaction_type LIKE '%Withdraw%' THEN 1 ELSE 0 END) as withdrawal_count,
-                    SUM(CASE WHEN transaction_type LIKE '%Transfer%' THEN 1 ELSE 0 END) as transfer_count
-                FROM {username}_transaction 
-                WHERE {where_clause}
-            """, params)
-            counts = cursor.fetchone()
+                    # Get transaction counts
+                    cursor.execute(f"""
+                        SELECT 
+                            COUNT(*) as total_transactions,
+                            SUM(CASE WHEN transaction_type LIKE '%Deposit%' THEN 1 ELSE 0 END) as deposit_count,
+                            SUM(CASE WHEN transaction_type LIKE '%Withdraw%' THEN 1 ELSE 0 END) as withdrawal_count,
+                            SUM(CASE WHEN transaction_type LIKE '%Transfer%' THEN 1 ELSE 0 END) as transfer_count
+                        FROM {transactions} 
+                        WHERE {where_clause}
+                    """, params)
+                    for key, value in zip(counts, cursor.fetchone()):
+                        counts[key] += value or 0
             
-            # Get first transaction date
-            cursor.execute(f"SELECT MIN(timedate) as first_date FROM {username}_transaction WHERE {where_clause}", params)
-            first_transaction = cursor.fetchone()['first_date']
+                    # Get first transaction date
+                    cursor.execute(f"SELECT MIN(timedate) as first_date FROM {transactions} WHERE {where_clause}", params)
+                    first_dates.append(cursor.fetchone()['first_date'])
             
-            # Get most recent transaction
-            cursor.execute(f"SELECT MAX(timedate) as last_date FROM {username}_transaction WHERE {where_clause}", params)
-            last_transaction = cursor.fetchone()['last_date']
+                    # Get most recent transaction
+                    cursor.execute(f"SELECT MAX(timedate) as last_date FROM {transactions} WHERE {where_clause}", params)
+                    last_dates.append(cursor.fetchone()['last_date'])
+            finally:
+                history.close()
+            first_transaction = min((date for date in first_dates if date), default=None)
+            last_transaction = max((date for date in last_dates if date), default=None)
             
             conn.close()
             
@@ -1003,6 +1610,162 @@ def api_epassbook_summary():
     except Exception as e:
         return jsonify({'success': False, 'message': f'Error processing request: {str(e)}'}), 500
 
+@app.route('/api/donors/<donor_id>/donations', methods=['GET'])
+def api_donor_donations(donor_id):
+    """Everything one donor gave across all NGO accounts, newest first, with per-cause totals"""
+    try:
+        try:
+            page = int(request.args.get('page', 1))
+            per_page = int(request.args.get('per_page', 20))
+        except ValueError:
+            return jsonify({'success': False, 'message': 'page and per_page must be numbers'}), 400
+
+        # Validate pagination parameters
+        if page < 1:
+            page = 1
+        if per_page < 1 or per_page > 100:  # Limit max per_page to 100
+            per_page = 20
+
+        paths = shards.paths()
+        # Across shards each shard's first page * per_page rows are merged before the page is cut
+        fetch, skip = (per_page, (page - 1) * per_page) if len(paths) == 1 else (page * per_page, 0)
+        donations = []
+        by_cause = {}
+        for db_path in paths:
+            conn = get_db_connection(db_path=db_path)
+            cursor = conn.cursor()
+            try:
+                cursor.execute("""
+                    SELECT d.timedate, d.username, d.account_number, d.transaction_type, d.amount, d.cause,
+                           c.name AS ngo_name, c.account_number AS ngo_account_number
+                    FROM donor_index AS d
+                    LEFT JOIN customers AS c ON c.username = d.username
+                    WHERE d.donor_id = ?
+                    ORDER BY d.timedate DESC
+                    LIMIT ? OFFSET ?
+                """, (donor_id, fetch, skip))
+                donations += [{
+                    'timedate': row['timedate'],
+                    'ngo_username': row['username'],
+                    'ngo_name': row['ngo_name'],
+                    'ngo_account_number': row['ngo_account_number'],
+                    'transaction_type': row['transaction_type'],
+                    'amount': row['amount'],
+                    'cause': row['cause']
+                } for row in cursor.fetchall()]
+
+                cursor.execute("""
+                    SELECT cause, COUNT(*) AS donations, SUM(amount) AS amount
+                    FROM donor_index WHERE donor_id = ?
+                    GROUP BY cause
+                """, (donor_id,))
+                for row in cursor.fetchall():
+                    totals = by_cause.setdefault(row['cause'], {'cause': row['cause'], 'donations': 0, 'amount': 0})
+                    totals['donations'] += row['donations']
+                    totals['amount'] += row['amount'] or 0
+            except sqlite3.OperationalError:
+                # No account of this database has been migrated yet, so there is no donor index
+                pass
+            finally:
+                conn.close()
+
+        if len(paths) > 1:
+            donations.sort(key=lambda donation: donation['timedate'], reverse=True)
+            donations = donations[(page - 1) * per_page:page * per_page]
+        by_cause = sorted(by_cause.values(), key=lambda row: row['amount'], reverse=True)
+
+        total_count = sum(row['donations'] for row in by_cause)
+        total_pages = (total_count + per_page - 1) // per_page
+        return jsonify({
+            'success': True,
+            'donor_id': donor_id,
+            'donations': donations,
+            'totals': {
+                'donations': total_count,
+                'amount': sum(row['amount'] or 0 for row in by_cause),
+                'by_cause': by_cause
+            },
+            'pagination': {
+                'total_records': total_count,
+                'total_pages': total_pages,
+                'current_page': page,
+                'per_page': per_page,
+                'has_next': page < total_pages,
+                'has_prev': page > 1
+            }
+        })
+
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'Error processing request: {str(e)}'}), 500
+
+@app.route('/api/analytics/donations', methods=['POST'])
+def api_donation_analytics():
+    """Platform-wide donation totals per cause/city/month, percentiles and top donors/NGOs"""
+    try:
+        data = admin_body()
+        # The report names donors and NGOs of every account
+        denied = admin_denied(data)
+        if denied:
+            return denied
+
+        group_by = [group.strip() for group in str(data.get('group_by', ','.join(GROUPS))).split(',') if group.strip()]
+        unknown = [group for group in group_by if group not in GROUPS]
+        if unknown:
+            return jsonify({'success': False, 'message': f"group_by must be any of: {', '.join(GROUPS)}"}), 400
+
+        try:
+            top_n = int(data.get('top', 10))
+        except (TypeError, ValueError):
+            return jsonify({'success': False, 'message': 'top must be a number'}), 400
+        if not 0 <= top_n <= 1000:
+            return jsonify({'success': False, 'message': 'top must be between 0 and 1000'}), 400
+
+        report = donation_analytics.report(
+            group_by,
+            top_n,
+            cause=data.get('cause'),
+            start_month=data.get('start_month'),
+            end_month=data.get('end_month')
+        )
+        return jsonify({'success': True, **report})
+
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'Error processing request: {str(e)}'}), 500
+
+@app.route('/api/admin/sql-trace', methods=['POST'])
+def api_sql_trace():
+    """Heaviest SQL fingerprints and recent slow queries of this process (needs BANK_SQL_TRACE=1)"""
+    try:
+        data = admin_body()
+        # Statements name every account's tables
+        denied = admin_denied(data)
+        if denied:
+            return denied
+
+        try:
+            top_n = int(data.get('top', 20))
+        except (TypeError, ValueError):
+            return jsonify({'success': False, 'message': 'top must be a number'}), 400
+        if not 0 <= top_n <= 1000:
+            return jsonify({'success': False, 'message': 'top must be between 0 and 1000'}), 400
+        order = data.get('order', 'total')
+
+        try:
+            statements = sql_trace.top(top_n, order)
+        except ValueError as e:
+            return jsonify({'success': False, 'message': str(e)}), 400
+        report = {
+            **sql_trace.stats(),
+            'statements': statements,
+            'slow_queries': sql_trace.slow_queries()
+        }
+        if str(data.get('reset', '')).lower() in ('1', 'true', 'yes'):
+            sql_trace.reset()
+        return jsonify({'success': True, **report})
+
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'Error processing request: {str(e)}'}), 500
+
 @app.route('/api/delete_user', methods=['POST'])
 def api_delete_user():
     try:
@@ -1019,19 +1782,24 @@ def api_delete_user():
             return jsonify({'success': False, 'message': 'Username, admin password, and confirmation are required'}), 400
             
         # Simple admin password check - in production, use a more secure method
-        if admin_password != "admin123":  # Replace with actual admin password or better auth
-            return jsonify({'success': False, 'message': 'Invalid admin credentials'}), 401
+        denied = admin_denied(data)
+        if denied:
+            return denied
             
         # Confirmation check
         if confirmation.lower() != f"delete {username}":
             return jsonify({'success': False, 'message': 'Confirmation text does not match "delete {username}"'}), 400
         
-        # Use the Bank class to delete the user
-        from bank import Bank
-        
-        result = Bank.delete_user(username)
+        if shards.enabled:
+            result = shards.delete_account(username)
+        else:
+            # Use the Bank class to delete the user
+            from bank import Bank
+
+            result = Bank.delete_user(username)
         
         if result:
+            account_cache.invalidate(username)
             return jsonify({
                 'success': True,
                 'message': f'User {username} has been successfully deleted'
@@ -1103,11 +1871,11 @@ def api_complete_withdrawal():
             })
 
         # Find user by account number
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT username, balance FROM customers WHERE account_number = ?", (account_number,))
-        user = cursor.fetchone()
-        conn.close()
+        user = account_cache.get(account_number=account_number)
+        if user is None:
+            conn = get_db_connection(account_number=account_number)
+            user = ledger.load_account(conn.cursor(), account_number=account_number)
+            conn.close()
 
         if not user:
             return jsonify({
@@ -0,0 +1,588 @@
+#!/usr/bin/env python3
+"""
+Async Server for Banking System
+asyncio (aiohttp) serving path for the money and blockchain endpoints
+
+Serves the same routes with the same JSON bodies and status codes as app.py:
+
+    POST /api/balance, /api/deposit, /api/withdraw, /api/transfer,
+         /api/add_money, /api/complete-withdrawal
+    GET  /api/withdrawal-notifications/<id>, /api/blockchain/status,
+         /api/blockchain/ngo-balance/<account_number>, /metrics
+
+Requests waiting on chain RPC (transaction receipts) or on their group commit
+are suspended coroutines rather than blocked threads, so thousands can be in
+flight at once. Balance updates run the same mutations as app.py through the
+group commit writer; SQLite reads go through async_db.py. Withdrawal
+notifications to the website are queued and delivered by the webhook
+dispatcher, as with app.py.
+
+Put it next to the Flask app behind the reverse proxy and route these paths
+to it; everything else (signup, passbooks, exports, admin) stays on app.py.
+The two are then separate processes writing the same accounts, so run both
+with a short account cache TTL (this server defaults BANK_ACCOUNT_CACHE_TTL
+to 1 second, as serve.py does with several workers).
+
+Usage:
+    pip install -r requirements-server.txt       # aiohttp
+    python async_app.py                          # listens on BANK_ASYNC_BIND (0.0.0.0:5051)
+    python async_app.py --bind 127.0.0.1:6000
+"""
+
+import argparse
+import asyncio
+import os
+import time
+from datetime import datetime
+
+# Another process (the Flask app) writes the same accounts; read before the cache is created
+os.environ.setdefault('BANK_ACCOUNT_CACHE_TTL', '1')
+
+try:
+    from aiohttp import web
+except ImportError:
+    web = None
+
+# Importing the Flask app sets up the databases and starts the background services
+from app import (account_db_path, add_money_mutation, deposit_mutation, stop_background_services,
+                 transfer_mutation, withdraw_mutation)
+import ledger
+from account_cache import account_cache
+from admission import admission
+from async_db import database
+from blockchain_integration import AsyncBlockchainIntegration
+from group_commit import MutationRejected, WriteWatch
+from idempotency import IDEMPOTENCY_HEADER, IDEMPOTENCY_KEY_MAX_LENGTH, idempotency
+from metrics import metrics, observe_request
+from sharding import shards
+
+# Configuration
+ASYNC_BIND = os.environ.get('BANK_ASYNC_BIND', '0.0.0.0:5051')
+
+# Endpoints under admission control (see admission.py), by path
+GUARDED_ENDPOINTS = {
+    '/api/deposit': 'deposit',
+    '/api/withdraw': 'withdraw',
+    '/api/transfer': 'transfer',
+    '/api/add_money': 'add_money'
+}
+
+# Endpoints replaying stored responses for a repeated Idempotency-Key (see idempotency.py)
+IDEMPOTENT_ENDPOINTS = {
+    '/api/transfer': 'transfer',
+    '/api/add_money': 'add_money'
+}
+
+# Global instance (bound to the server's event loop when it connects)
+async_blockchain = AsyncBlockchainIntegration()
+
+
+def error_response(e):
+    """Reply for an exception raised while handling a request, as app.py gives it"""
+    if isinstance(e, MutationRejected):
+        return web.json_response({'success': False, 'message': e.message, **e.details}, status=e.status_code)
+    return web.json_response({'success': False, 'message': str(e)}, status=500)
+
+
+def blockchain_summary(result):
+    """The 'blockchain' member of a money endpoint's reply"""
+    recorded = bool(result and result['success'])
+    return {
+        'recorded': recorded,
+        'tx_hash': result.get('tx_hash') if recorded else None,
+        'blockchain_tx_id': result.get('blockchain_tx_id') if recorded else None,
+        'error': result.get('error') if result and not recorded else None
+    }
+
+
+async def shard_for(**account):
+    """Shard of an account (None when unsharded); a directory miss reads bank.db"""
+    if not shards.enabled:
+        return None
+    return await database.run(shards.shard_for, **account)
+
+
+async def load_account(username=None, account_number=None):
+    """Account from the write-through cache, or read from SQLite on a miss"""
+    account = account_cache.get(username=username, account_number=account_number)
+    if account is not None:
+        return account
+    db_path = await database.run(account_db_path, username, account_number)
+    return await database.read(
+        lambda conn: ledger.load_account(conn.cursor(), username=username, account_number=account_number,
+                                         cache=not conn.replica),
+        db_path
+    )
+
+
+async def api_balance(request):
+    try:
+        data = await request.json()
+        username = data.get('username')
+
+        if not username:
+            return web.json_response({'success': False, 'message': 'Username is required'}, status=400)
+
+        account = await load_account(username=username)
+        if not account:
+            return web.json_response({'success': False, 'message': 'User not found'}, status=404)
+
+        return web.json_response({
+            'success': True,
+            'balance': account['balance']
+        })
+
+    except Exception as e:
+        return error_response(e)
+
+
+async def api_deposit(request):
+    try:
+        data = await request.json()
+        username = data.get('username')
+        amount = int(data.get('amount'))
+        account_number = data.get('account_number')
+        donor_id = data.get('donor_id')
+        cause = data.get('cause')
+
+        if not all([username, amount, account_number]) or amount <= 0:
+            return web.json_response({'success': False, 'message': 'Invalid input data'}, status=400)
+
+        donor_id_value = str(donor_id) if donor_id else None
+
+        shard = await shard_for(username=username)
+        new_balance = await database.write(shards.writer(shard),
+                                           deposit_mutation(username, account_number, amount, donor_id_value, cause))
+
+        blockchain_result = await async_blockchain.record_donation_on_blockchain(
+            ngo_account=account_number,
+            donor_id=donor_id_value or f"deposit_{account_number}",
+            cause=cause or "Cash Deposit",
+            amount=amount
+        )
+
+        return web.json_response({
+            'success': True,
+            'message': f'₹{amount} deposited successfully!',
+            'new_balance': new_balance,
+            'blockchain': blockchain_summary(blockchain_result)
+        })
+
+    except Exception as e:
+        return error_response(e)
+
+
+async def api_withdraw(request):
+    try:
+        data = await request.json()
+        username = data.get('username')
+        amount = int(data.get('amount'))
+        account_number = data.get('account_number')
+        donor_id = data.get('donor_id')
+        cause = data.get('cause')
+
+        if not all([username, amount, account_number]) or amount <= 0:
+            return web.json_response({'success': False, 'message': 'Invalid input data'}, status=400)
+
+        donor_id_value = str(donor_id) if donor_id else None
+
+        bank_transaction_id = f"BANK_WD_{int(datetime.now().timestamp())}_{username}_{amount}"
+        notification_payload = {
+            'account_number': account_number,
+            'amount': amount,
+            'transaction_id': bank_transaction_id,
+            'bank_reference': f"REF_{username}_{int(datetime.now().timestamp())}",
+            'cause': cause or "Cash Withdrawal",
+            'description': f"Cash withdrawal of ₹{amount} by {username} from account {account_number}",
+            'withdrawal_type': 'CASH_WITHDRAWAL'
+        }
+
+        shard = await shard_for(username=username)
+        new_balance, notification_id = await database.write(
+            shards.writer(shard),
+            withdraw_mutation(username, account_number, amount, donor_id_value, cause, notification_payload, shard)
+        )
+        print(f"🔔 Withdrawal notification {notification_id} queued for website ({bank_transaction_id})")
+
+        return web.json_response({
+            'success': True,
+            'message': f'₹{amount} withdrawn successfully! NGO has been notified to upload documentation.',
+            'new_balance': new_balance,
+            'withdrawal_details': {
+                'bank_transaction_id': bank_transaction_id,
+                'notification_sent': False,
+                'notification_queued': True,
+                'notification_id': notification_id,
+                'website_response': None,
+                'ngo_deadline_info': None
+            },
+            'next_steps': "NGO must upload supporting documents within the specified time limit for blockchain recording"
+        })
+
+    except Exception as e:
+        return error_response(e)
+
+
+async def api_withdrawal_notification(request):
+    try:
+        notification_id = int(request.match_info['notification_id'])
+        shard, local_id = shards.split_notification_id(notification_id)
+        notification = await database.run(shards.dispatcher(shard).get_notification, local_id)
+        if not notification:
+            return web.json_response({'success': False, 'message': 'Notification not found'}, status=404)
+        notification['id'] = notification_id
+
+        website_response = notification['website_response']
+        return web.json_response({
+            'success': True,
+            'notification': notification,
+            'ngo_deadline_info': website_response.get('data') if isinstance(website_response, dict) and website_response.get('success') else None
+        })
+    except Exception as e:
+        return error_response(e)
+
+
+async def api_transfer(request):
+    try:
+        data = await request.json()
+        sender_username = data.get('username')
+        receiver_account = int(data.get('receiver_account'))
+        amount = int(data.get('amount'))
+        sender_account = data.get('account_number')
+        donor_id = data.get('donor_id')
+        cause = data.get('cause')
+
+        if not all([sender_username, receiver_account, amount, sender_account]) or amount <= 0:
+            return web.json_response({'success': False, 'message': 'Invalid input data'}, status=400)
+
+        sender_donor_id = str(donor_id) if donor_id else None
+
+        sender = await database.run(shards.lookup, username=sender_username) if shards.enabled else None
+        receiver = await database.run(shards.lookup, account_number=receiver_account) if shards.enabled else None
+        if sender and receiver and sender[2] != receiver[2]:
+            if receiver_account == int(sender_account):
+                raise MutationRejected('Cannot transfer to your own account')
+            # Two-phase commit across shards blocks on both databases: run it on a database thread
+            new_sender_balance = await database.run(shards.transfer, (sender_username, sender_account, sender[2]),
+                                                    receiver, amount, sender_donor_id, cause)
+        else:
+            new_sender_balance = await database.write(
+                shards.writer(sender[2] if sender else None),
+                transfer_mutation(sender_username, sender_account, receiver_account, amount, sender_donor_id, cause)
+            )
+
+        # Both sides are sent at once; the node orders them by arrival
+        spending_result, donation_result = await asyncio.gather(
+            async_blockchain.record_spending_on_blockchain(
+                ngo_account=sender_account,
+                receiver_id=f"transfer_to_{receiver_account}",
+                cause=cause or "Fund Transfer (Outgoing)",
+                amount=amount
+            ),
+            async_blockchain.record_donation_on_blockchain(
+                ngo_account=receiver_account,
+                donor_id=sender_donor_id or f"transfer_from_{sender_account}",
+                cause=cause or "Fund Transfer (Incoming)",
+                amount=amount
+            )
+        )
+        recorded = spending_result.get('success', False) and donation_result.get('success', False)
+
+        return web.json_response({
+            'success': True,
+            'message': f'₹{amount} transferred successfully to account {receiver_account}!',
+            'new_balance': new_sender_balance,
+            'blockchain': {
+                'recorded': recorded,
+                'tx_hash': donation_result.get('tx_hash') if recorded else None,
+                'blockchain_tx_id': donation_result.get('blockchain_tx_id') if recorded else None,
+                'spending_tx': {
+                    'tx_hash': spending_result.get('tx_hash'),
+                    'blockchain_tx_id': spending_result.get('blockchain_tx_id'),
+                    'success': spending_result.get('success', False)
+                },
+                'donation_tx': {
+                    'tx_hash': donation_result.get('tx_hash'),
+                    'blockchain_tx_id': donation_result.get('blockchain_tx_id'),
+                    'success': donation_result.get('success', False)
+                },
+                'error': None if recorded else spending_result.get('error') or donation_result.get('error')
+            }
+        })
+
+    except Exception as e:
+        return error_response(e)
+
+
+async def api_add_money(request):
+    try:
+        data = await request.json()
+        if not data:
+            return web.json_response({'success': False, 'message': 'No JSON data provided'}, status=400)
+
+        account_number = data.get('account_number')
+        amount = data.get('amount')
+        donor_id = data.get('donor_id')
+        cause = data.get('cause')
+
+        if not account_number or not amount:
+            return web.json_response({'success': False, 'message': 'Account number and amount are required'}, status=400)
+
+        if amount <= 0:
+            return web.json_response({'success': False, 'message': 'Amount must be greater than zero'}, status=400)
+
+        donor_id_value = str(donor_id) if donor_id else None
+
+        shard = await shard_for(account_number=account_number)
+        new_balance = await database.write(shards.writer(shard),
+                                           add_money_mutation(account_number, amount, donor_id_value, cause))
+
+        blockchain_result = await async_blockchain.record_donation_on_blockchain(
+            ngo_account=str(account_number),
+            donor_id=donor_id_value or "ANONYMOUS",
+            cause=cause or "general",
+            amount=amount
+        )
+
+        return web.json_response({
+            'success': True,
+            'message': f'₹{amount} added successfully to account {account_number}!',
+            'new_balance': new_balance,
+            'blockchain': blockchain_summary(blockchain_result)
+        })
+
+    except Exception as e:
+        return error_response(e)
+
+
+async def api_blockchain_status(request):
+    try:
+        return web.json_response({
+            'success': True,
+            'blockchain_status': await async_blockchain.get_blockchain_status()
+        })
+    except Exception as e:
+        return web.json_response({
+            'success': False,
+            'error': str(e),
+            'blockchain_status': {'connected': False, 'error': str(e)}
+        }, status=500)
+
+
+async def api_ngo_blockchain_balance(request):
+    account_number = request.match_info['account_number']
+    try:
+        balance = await async_blockchain.get_ngo_balance_from_blockchain(account_number)
+        if balance is None:
+            return web.json_response({
+                'success': False,
+                'message': 'Failed to fetch balance from blockchain'
+            }, status=500)
+        return web.json_response({
+            'success': True,
+            'account_number': account_number,
+            'blockchain_balance': balance,
+            'ngo_id': f"NGO_{account_number}"
+        })
+    except Exception as e:
+        return web.json_response({'success': False, 'error': str(e)}, status=500)
+
+
+async def api_complete_withdrawal(request):
+    try:
+        data = await request.json()
+        if not data:
+            return web.json_response({'success': False, 'error': 'No data provided'})
+
+        account_number = data.get('account_number')
+        amount = data.get('amount')
+        bank_transaction_id = data.get('bank_transaction_id')
+        document_url = data.get('document_url')
+        document_hash = data.get('document_hash')
+        cause = data.get('cause', 'Cash Withdrawal')
+
+        if not all([account_number, amount, bank_transaction_id]):
+            return web.json_response({
+                'success': False,
+                'error': 'Account number, amount, and bank transaction ID are required'
+            })
+
+        user = await load_account(account_number=account_number)
+        if not user:
+            return web.json_response({
+                'success': False,
+                'error': f'No user found with account number: {account_number}'
+            })
+
+        blockchain_result = await async_blockchain.record_spending_on_blockchain(
+            ngo_account=account_number,
+            receiver_id=f"withdrawal_{bank_transaction_id}",
+            cause=cause,
+            amount=amount
+        )
+
+        return web.json_response({
+            'success': True,
+            'message': f'₹{amount} withdrawal completed and recorded on blockchain!',
+            'data': {
+                'username': user['username'],
+                'account_number': account_number,
+                'amount': amount,
+                'bank_transaction_id': bank_transaction_id,
+                'document_url': document_url,
+                'document_hash': document_hash,
+                'blockchain': blockchain_summary(blockchain_result)
+            }
+        })
+
+    except Exception as e:
+        return web.json_response({
+            'success': False,
+            'error': f'Failed to complete withdrawal: {str(e)}'
+        })
+
+
+async def prometheus_metrics(request):
+    # Gauges count queued rows in SQLite; keep that off the event loop
+    return web.Response(body=(await database.run(metrics.render)).encode(),
+                        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+if web is not None:
+    @web.middleware
+    async def request_metrics(request, handler):
+        """Count and time every request, like instrument_flask in app.py"""
+        started = time.perf_counter()
+        resource = request.match_info.route.resource
+        route = resource.canonical if resource is not None else 'unmatched'
+        status = 500
+        try:
+            response = await handler(request)
+            status = response.status
+            return response
+        except web.HTTPException as e:
+            status = e.status
+            raise
+        finally:
+            observe_request(route, request.method, status, time.perf_counter() - started)
+
+    @web.middleware
+    async def cors(request, handler):
+        """Allow every origin, like CORS(app) in app.py"""
+        if request.method == 'OPTIONS':
+            response = web.Response()
+            response.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS'
+            response.headers['Access-Control-Allow-Headers'] = request.headers.get('Access-Control-Request-Headers', '*')
+        else:
+            response = await handler(request)
+        response.headers['Access-Control-Allow-Origin'] = '*'
+        return response
+
+    @web.middleware
+    async def idempotency_keys(request, handler):
+        """Idempotency-Key handling of app.py's idempotency.keyed, on the same table"""
+        endpoint = IDEMPOTENT_ENDPOINTS.get(request.path)
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if endpoint is None or request.method != 'POST' or not key:
+            return await handler(request)
+        if len(key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+            return web.json_response({
+                'success': False,
+                'message': f'{IDEMPOTENCY_HEADER} must be at most {IDEMPOTENCY_KEY_MAX_LENGTH} characters'
+            }, status=400)
+
+        request_hash = idempotency.request_hash(endpoint, await request.read())
+        row = (await database.run(idempotency.lookup, endpoint, key)
+               or await database.write(idempotency.writer, idempotency.claim_mutation(endpoint, key, request_hash)))
+        if row:
+            status_code, body, headers = idempotency.replay(row, request_hash)
+            return web.Response(text=body, status=status_code, headers=headers, content_type='application/json')
+
+        with WriteWatch() as writes:
+            try:
+                response = await handler(request)
+            except BaseException:
+                # Also on cancellation (client gone), where nothing more may be awaited
+                idempotency.abandon(endpoint, key, writes)
+                raise
+        if idempotency.never_ran(response.status, writes):
+            await database.write(idempotency.writer, idempotency.release_mutation(endpoint, key))
+        else:
+            await database.write(idempotency.writer,
+                                 idempotency.complete_mutation(endpoint, key, response.status, response.text))
+        return response
+
+    @web.middleware
+    async def admission_control(request, handler):
+        """
+        Concurrency limits of the money endpoints, shared with app.py's admission.guard
+
+        A slot is taken without waiting: blocking for one would stall the event
+        loop, so over the limit the request is shed with 429 right away.
+        """
+        endpoint = GUARDED_ENDPOINTS.get(request.path)
+        if endpoint is None or request.method != 'POST' or not admission.enabled:
+            return await handler(request)
+        limit, retry_after = admission.admit(endpoint, timeout=0)
+        if limit is None:
+            return web.json_response({
+                'success': False,
+                'message': f'Server busy, please retry in {retry_after}s',
+                'retry_after': retry_after
+            }, status=429, headers={'Retry-After': str(retry_after)})
+        started = time.perf_counter()
+        try:
+            return await handler(request)
+        finally:
+            limit.release(time.perf_counter() - started)
+
+
+async def on_startup(application):
+    print("🔗 Initializing blockchain connection...")
+    if not await async_blockchain.connect():
+        print("⚠️ Blockchain connection failed - running without blockchain integration")
+
+
+async def on_cleanup(application):
+    # Commit queued writes and drain the delivery queues without blocking the loop
+    await asyncio.get_running_loop().run_in_executor(None, stop_background_services)
+    database.close()
+    await async_blockchain.disconnect()
+
+
+async def create_app():
+    """aiohttp application; also usable as gunicorn's async_app:create_app with aiohttp.GunicornWebWorker"""
+    if web is None:
+        raise RuntimeError("async_app.py needs aiohttp (pip install -r requirements-server.txt)")
+    application = web.Application(middlewares=[request_metrics, cors, idempotency_keys, admission_control])
+    application.add_routes([
+        web.post('/api/balance', api_balance),
+        web.post('/api/deposit', api_deposit),
+        web.post('/api/withdraw', api_withdraw),
+        web.get('/api/withdrawal-notifications/{notification_id:\\d+}', api_withdrawal_notification),
+        web.post('/api/transfer', api_transfer),
+        web.post('/api/add_money', api_add_money),
+        web.get('/api/blockchain/status', api_blockchain_status),
+        web.get('/api/blockchain/ngo-balance/{account_number}', api_ngo_blockchain_balance),
+        web.post('/api/complete-withdrawal', api_complete_withdrawal),
+        web.get('/metrics', prometheus_metrics)
+    ])
+    application.on_startup.append(on_startup)
+    application.on_cleanup.append(on_cleanup)
+    return application
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve the money and blockchain endpoints with asyncio')
+    parser.add_argument('--bind', default=ASYNC_BIND, help='host:port to listen on')
+    args = parser.parse_args()
+
+    if web is None:
+        raise SystemExit("async_app.py needs aiohttp (pip install -r requirements-server.txt)")
+    host, _, port = args.bind.rpartition(':')
+    print(f"Starting async Banking Simulation Server on {args.bind}")
+    web.run_app(create_app(), host=host or '0.0.0.0', port=int(port), print=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Async Database Access for Banking System
+Awaitable SQLite reads and writes for the asyncio server (async_app.py)
+
+Writes are handed to the group commit writer and awaited through its future,
+so a request waiting for its group to commit holds no thread at all. SQLite
+has no non-blocking API, so reads run on a small thread pool the size of the
+read connection pool: any number of waiting requests share those threads
+instead of each holding one.
+"""
+
+import asyncio
+import contextvars
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from group_commit import MUTATION_TIMEOUT
+from read_routing import READ_POOL_SIZE, reads
+
+# Configuration
+ASYNC_DB_THREADS = int(os.environ.get('BANK_ASYNC_DB_THREADS', str(READ_POOL_SIZE)))  # threads running SQLite reads
+
+
+class AsyncDatabase:
+    def __init__(self, threads=ASYNC_DB_THREADS):
+        self.threads = threads
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        """Thread pool, created lazily so it is never shared across a fork"""
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.threads, thread_name_prefix='async-db')
+            return self._executor
+
+    async def run(self, fn, *args, **kwargs):
+        """Run blocking `fn(*args, **kwargs)` (a SQLite call) on the database threads"""
+        loop = asyncio.get_running_loop()
+        # Carry the task's context along, so a WriteWatch (group_commit.py) sees writes made there
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(self._get_executor(), lambda: context.run(fn, *args, **kwargs))
+
+    async def read(self, fn, db_path=None):
+        """
+        Run `fn(conn)` on a pooled read-only connection (see read_routing.py)
+
+        `conn.replica` tells whether the rows may be behind the account cache.
+        """
+        def work():
+            conn = reads.connect(db_path)
+            try:
+                return fn(conn)
+            finally:
+                conn.close()
+
+        return await self.run(work)
+
+    async def write(self, writer, mutation, timeout=MUTATION_TIMEOUT):
+        """
+        Queue `mutation(txn)` on a group commit writer and await its committed result
+
+        Re-raises MutationRejected like GroupCommitWriter.execute(). A mutation
+        whose request times out before its group starts is not applied; one
+        whose group has started is awaited to its outcome.
+        """
+        future = writer.submit(mutation)
+        try:
+            # Shielded: on timeout the future is withdrawn below, not left to a cancel callback
+            return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), timeout)
+        except asyncio.TimeoutError:
+            if future.cancel():
+                raise
+            return await asyncio.wrap_future(future)
+
+    def close(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+
+
+# Global instance
+database = AsyncDatabase()
@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+"""
+Online Backups for Banking System
+Consistent snapshots of bank.db taken while the app keeps writing
+
+Backups use SQLite's online backup API a few megabytes at a time, with a
+short pause between steps. The copy is read inside one read transaction, so in
+WAL mode it is a point-in-time snapshot and deposits and transfers carry on
+while it runs. Each snapshot is written to a .partial file, checked and only
+then renamed into place; the oldest ones are pruned beyond the retention count.
+
+With BANK_SHARDS > 1 a snapshot also copies every shard file (sharding.py) as
+bank-<time>.shard<i>.db next to it. The shards are copied before bank.db, so the
+coordinator log in the copy knows every cross-shard transfer a shard copy holds;
+a restore hands transfers finished after the snapshot began back to recovery,
+which replays whatever part a shard copy missed.
+
+Archive databases (see ledger_archive.py) are not included. They only gain
+rows, and a restored bank.db ignores archive rows from runs it never committed.
+
+Usage:
+    python backup_database.py backup
+    python backup_database.py list
+    python backup_database.py restore backups/bank-20250101-020000.db
+    python backup_database.py schedule --interval-hours 6 --keep 28
+"""
+
+import argparse
+import os
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+# Configuration
+DB_PATH = os.path.join(os.path.dirname(__file__), 'bank.db')
+BACKUP_DIR = os.environ.get('BANK_BACKUP_DIR', os.path.join(os.path.dirname(__file__), 'backups'))
+BACKUP_INTERVAL_HOURS = float(os.environ.get('BANK_BACKUP_INTERVAL_HOURS', '24'))  # 0 disables the scheduler
+BACKUP_KEEP = int(os.environ.get('BANK_BACKUP_KEEP', '7'))  # snapshots kept
+BACKUP_STEP_PAGES = 1024  # pages copied per step (4 MB with 4 KB pages)
+BACKUP_STEP_SLEEP = 0.02  # seconds between steps, so the app gets the disk too
+BACKUP_SYNC_STEPS = 16  # fsync the copy every this many steps rather than all at the end
+
+BACKUP_PREFIX = 'bank-'
+
+
+def _snapshot_name(label=None):
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    return f"{BACKUP_PREFIX}{stamp}{'-' + label if label else ''}.db"
+
+
+def _shard_snapshot(path, shard):
+    """File holding shard `shard`'s copy in the snapshot at `path`"""
+    return f"{path[:-len('.db')]}.shard{shard}.db"
+
+
+def _is_shard_snapshot(name):
+    return re.search(r'\.shard\d+\.db$', name) is not None
+
+
+def _snapshot_started(path):
+    """When the snapshot at `path` began, in the ledger's timedate format, from its name"""
+    stamp = re.match(re.escape(BACKUP_PREFIX) + r'(\d{8}-\d{6})', os.path.basename(path))
+    if stamp is None:
+        raise ValueError(f"{path} is not named like a snapshot ({BACKUP_PREFIX}<date>-<time>.db)")
+    return str(datetime.strptime(stamp.group(1), "%Y%m%d-%H%M%S"))
+
+
+def backup_database(db_path=DB_PATH, backup_dir=BACKUP_DIR, label=None,
+                    pages=BACKUP_STEP_PAGES, sleep=BACKUP_STEP_SLEEP, verify=True, shard_paths=()):
+    """
+    Take an online snapshot of the database
+
+    Args:
+        label (str): Optional suffix for the file name, e.g. 'pre-restore'
+        pages (int): Pages copied per step
+        sleep (float): Seconds to pause between steps
+        verify (bool): Run PRAGMA quick_check on the copy before keeping it
+        shard_paths (list): Shard files to copy along with it, before bank.db
+
+    Returns:
+        dict: Path, size in bytes, pages copied and seconds taken
+    """
+    started = time.perf_counter()
+    os.makedirs(backup_dir, exist_ok=True)
+    path = os.path.join(backup_dir, _snapshot_name(label))
+    copies = [(shard_path, _shard_snapshot(path, shard)) for shard, shard_path in enumerate(shard_paths)]
+    copies.append((db_path, path))
+
+    total_pages = 0
+    done = []
+    try:
+        for source_path, target_path in copies:
+            total_pages += _copy(source_path, target_path, pages, sleep, verify)
+            done.append(target_path)
+    except Exception:
+        for target_path in done:
+            os.remove(target_path)
+        raise
+
+    return {
+        'path': path,
+        'bytes': sum(os.path.getsize(target_path) for target_path in done),
+        'pages': total_pages,
+        'seconds': round(time.perf_counter() - started, 3)
+    }
+
+
+def _copy(db_path, path, pages, sleep, verify):
+    """Copy one database into `path` through a .partial file; returns the pages copied"""
+    partial = path + '.partial'
+
+    source = sqlite3.connect(db_path, timeout=30)
+    target = sqlite3.connect(partial)
+    # The copy is fsynced once at the end; journaling it page by page only competes with the app's writes
+    target.execute("PRAGMA journal_mode=OFF")
+    target.execute("PRAGMA synchronous=OFF")
+    try:
+        # Pin one WAL snapshot for the whole copy; without it every commit by
+        # the app would restart the backup from the first page
+        source.execute("BEGIN")
+        source.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+
+        progress = {'steps': 0}
+        spool = open(partial, 'rb')
+
+        def on_step(status, remaining, total):
+            progress['total'] = total
+            progress['steps'] += 1
+            # Flushing as we go avoids one huge write-back that would stall the app's commits
+            if progress['steps'] % BACKUP_SYNC_STEPS == 0:
+                os.fsync(spool.fileno())
+            # backup()'s own sleep only applies when a step finds the database locked
+            if remaining:
+                time.sleep(sleep)
+
+        try:
+            source.backup(target, pages=pages, progress=on_step)
+        finally:
+            spool.close()
+        source.rollback()
+
+        if verify:
+            result = target.execute("PRAGMA quick_check").fetchone()[0]
+            if result != 'ok':
+                raise sqlite3.DatabaseError(f"backup failed verification: {result}")
+        # A snapshot is a single file; do not leave it in WAL mode
+        target.execute("PRAGMA journal_mode=DELETE")
+    except Exception:
+        target.close()
+        source.close()
+        os.remove(partial)
+        raise
+    target.close()
+    source.close()
+
+    with open(partial, 'rb') as snapshot:
+        os.fsync(snapshot.fileno())
+    os.replace(partial, path)
+    return progress.get('total', 0)
+
+
+def list_backups(backup_dir=BACKUP_DIR):
+    """Snapshots in `backup_dir`, newest first, as dicts with path, bytes and created"""
+    if not os.path.isdir(backup_dir):
+        return []
+    backups = []
+    for name in os.listdir(backup_dir):
+        if name.startswith(BACKUP_PREFIX) and name.endswith('.db') and not _is_shard_snapshot(name):
+            path = os.path.join(backup_dir, name)
+            stat = os.stat(path)
+            backups.append({
+                'path': path,
+                'bytes': stat.st_size,
+                'created': datetime.fromtimestamp(stat.st_mtime).strftime("%Y-%m-%d %H:%M:%S")
+            })
+    backups.sort(key=lambda backup: backup['path'], reverse=True)  # names sort by time
+    return backups
+
+
+def prune_backups(keep=BACKUP_KEEP, backup_dir=BACKUP_DIR):
+    """Delete all but the newest `keep` snapshots (with their shard copies); returns the deleted paths"""
+    removed = []
+    for backup in list_backups(backup_dir)[keep:]:
+        shard = 0
+        while os.path.exists(_shard_snapshot(backup['path'], shard)):
+            os.remove(_shard_snapshot(backup['path'], shard))
+            shard += 1
+        os.remove(backup['path'])
+        removed.append(backup['path'])
+    return removed
+
+
+def restore_database(backup_path, db_path=DB_PATH, backup_dir=BACKUP_DIR, pages=BACKUP_STEP_PAGES, shard_paths=()):
+    """
+    Replace the live database's contents with a snapshot
+
+    The current database is snapshotted first (label 'pre-restore'). Stop the
+    app before restoring: its caches would still hold the replaced data. With
+    `shard_paths` the snapshot's shard copies are restored too, and cross-shard
+    transfers finished after it began are logged COMMITTED again, so the app's
+    recovery on start replays any part a shard copy is missing.
+
+    Returns:
+        dict: The restored snapshot and the safety snapshot taken beforehand
+    """
+    copies = [(_shard_snapshot(backup_path, shard), shard_path) for shard, shard_path in enumerate(shard_paths)]
+    copies.append((backup_path, db_path))
+    for snapshot_path, _ in copies:
+        if not os.path.exists(snapshot_path):
+            raise FileNotFoundError(f"{snapshot_path} is missing; the snapshot does not cover every shard")
+    started = _snapshot_started(backup_path) if shard_paths else None
+
+    snapshots = [sqlite3.connect(snapshot_path) for snapshot_path, _ in copies]
+    try:
+        for snapshot, (snapshot_path, _) in zip(snapshots, copies):
+            result = snapshot.execute("PRAGMA quick_check").fetchone()[0]
+            if result != 'ok':
+                raise sqlite3.DatabaseError(f"{snapshot_path} failed verification: {result}")
+
+        safety = (backup_database(db_path, backup_dir, label='pre-restore', shard_paths=shard_paths)
+                  if all(os.path.exists(live_path) for _, live_path in copies) else None)
+
+        for snapshot, (_, live_path) in zip(snapshots, copies):
+            # Copy through the backup API so the live file's WAL and locks are respected
+            target = sqlite3.connect(live_path, timeout=30)
+            try:
+                snapshot.backup(target, pages=pages)
+                target.execute("PRAGMA journal_mode=WAL")
+                if started and live_path == db_path:
+                    # A shard copy may predate the last parts of these; replaying skips parts already applied
+                    target.execute("UPDATE shard_transfers SET state = 'COMMITTED' "
+                                   "WHERE state = 'DONE' AND updated_at >= ?", (started,))
+                    target.commit()
+            finally:
+                target.close()
+    finally:
+        for snapshot in snapshots:
+            snapshot.close()
+
+    return {'restored': backup_path, 'safety_backup': safety['path'] if safety else None}
+
+
+class BackupScheduler:
+    """Takes a snapshot every `interval_hours` in a background thread and prunes old ones"""
+
+    def __init__(self, db_path=DB_PATH, backup_dir=BACKUP_DIR, interval_hours=BACKUP_INTERVAL_HOURS,
+                 keep=BACKUP_KEEP, shard_paths=()):
+        self.db_path = db_path
+        self.shard_paths = list(shard_paths)  # the shard files when sharded (set by the app)
+        self.backup_dir = backup_dir
+        self.interval_hours = interval_hours
+        self.keep = keep
+        self.last_backup = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def run_once(self):
+        """Take one snapshot and apply retention"""
+        result = backup_database(self.db_path, self.backup_dir, shard_paths=self.shard_paths)
+        removed = prune_backups(self.keep, self.backup_dir)
+        self.last_backup = result
+        print(f"💾 Backup {os.path.basename(result['path'])} ({result['bytes'] // 1024} KB) "
+              f"in {result['seconds']}s, {len(removed)} old backup(s) pruned")
+        return result
+
+    def start(self):
+        """Start the backup thread (no-op if disabled or already running)"""
+        if self.interval_hours <= 0 or (self._thread and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='backup-scheduler', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=60):
+        """Stop the backup thread, letting a snapshot in progress finish"""
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval_hours * 3600):
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"❌ Backup error: {e}")
+
+
+# Global instance
+backup_scheduler = BackupScheduler()
+
+
+def _shard_paths():
+    """The shard files when BANK_SHARDS > 1 (see sharding.py), else none"""
+    from sharding import shards
+    return shards.paths() if shards.enabled else []
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Online backups of the bank database')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    backup = commands.add_parser('backup', help='Take a snapshot now')
+    backup.add_argument('--label', help='Suffix for the snapshot file name')
+    backup.add_argument('--keep', type=int, default=BACKUP_KEEP, help='Snapshots to keep afterwards')
+
+    commands.add_parser('list', help='List snapshots, newest first')
+
+    restore = commands.add_parser('restore', help='Replace bank.db with a snapshot (stop the app first)')
+    restore.add_argument('snapshot', help='Snapshot file to restore')
+
+    schedule = commands.add_parser('schedule', help='Keep taking snapshots in the foreground')
+    schedule.add_argument('--interval-hours', type=float, default=BACKUP_INTERVAL_HOURS or 24)
+    schedule.add_argument('--keep', type=int, default=BACKUP_KEEP)
+    args = parser.parse_args()
+
+    if args.command == 'backup':
+        result = backup_database(label=args.label, shard_paths=_shard_paths())
+        removed = prune_backups(args.keep)
+        print(f"✅ Backed up {result['pages']} pages to {result['path']} in {result['seconds']}s"
+              f"{f', pruned {len(removed)} old backup(s)' if removed else ''}")
+
+    elif args.command == 'list':
+        backups = list_backups()
+        if not backups:
+            print("No backups found.")
+        for backup in backups:
+            print(f"{backup['created']}  {backup['bytes'] // 1024:>10} KB  {backup['path']}")
+
+    elif args.command == 'restore':
+        confirmation = input(f"Replace {DB_PATH} with {args.snapshot}? Stop the app first. (type 'yes' to confirm): ")
+        if confirmation.lower() != 'yes':
+            print("Restore cancelled.")
+            return
+        result = restore_database(args.snapshot, shard_paths=_shard_paths())
+        print(f"✅ Restored {result['restored']}")
+        if result['safety_backup']:
+            print(f"   previous database saved as {result['safety_backup']}")
+
+    else:
+        scheduler = BackupScheduler(interval_hours=args.interval_hours, keep=args.keep, shard_paths=_shard_paths())
+        print(f"💾 Backing up every {args.interval_hours}h, keeping {args.keep}. Ctrl+C to stop.")
+        try:
+            while True:
+                scheduler.run_once()
+                time.sleep(args.interval_hours * 3600)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,7 @@
 # Bank Services
 from database import *
+import ledger
+import ledger_archive
 import datetime
 import hashlib
 
@@ -16,13 +18,8 @@ class Bank:
         return str(data)
 
     def create_transaction_table(self):
-        db_query(f"CREATE TABLE IF NOT EXISTS {self.__username}_transaction "
-                 f"( timedate VARCHAR(30),"
-                 f"account_number INTEGER,"
-                 f"transaction_type VARCHAR(30),"
-                 f"amount INTEGER,"
-                 f"donor_id VARCHAR(64),"
-                 f"cause VARCHAR(50) )")
+        ledger.create_ledger(cursor, self.__username)
+        mydb.commit()
 
     def balanceequiry(self):
         temp = db_query(
@@ -123,10 +120,13 @@ class Bank:
     def delete_transaction_table(self):
         """Delete the transaction table for this user"""
         try:
-            # Check if the table exists first
-            table_exists = db_query(f"SELECT name FROM sqlite_master WHERE type='table' AND name='{self.__username}_transaction'")
-            if table_exists:
-                db_query(f"DROP TABLE IF EXISTS {self.__username}_transaction")
+            # Drop the ledger if the user has one
+            if ledger.drop_ledger(cursor, self.__username):
+                # A re-created account must not inherit ETags of the dropped ledger
+                ledger.bump_version(cursor, self.__username)
+                ledger.drop_donor_entries(cursor, self.__username)
+                ledger_archive.drop_archives(cursor, self.__username)
+                mydb.commit()
                 print(f"Transaction table for {self.__username} has been deleted")
                 return True
             else:
@@ -7,13 +7,33 @@ Handles recording donations on the blockchain smart contract
 import json
 import time
 import requests
-from web3 import Web3
+from web3 import AsyncHTTPProvider, AsyncWeb3, Web3
+
+from metrics import GAS_BUCKETS, metrics
 
 # Configuration
 GANACHE_URL = "http://127.0.0.1:7545"  # Ganache RPC URL
 CONTRACT_ADDRESS = "0x9fC0c4B491bC255f1d1486aD586d404b425afD8F"  # From contract-address.json
 CHAIN_ID = 1337  # Ganache chain ID
 
+SEND_SECONDS = metrics.histogram('bank_chain_send_seconds', 'Time to submit a contract transaction', ['operation'])
+RECEIPT_SECONDS = metrics.histogram('bank_chain_receipt_seconds', 'Time waited for the mined receipt after submitting',
+                                    ['operation'])
+GAS_USED = metrics.histogram('bank_chain_gas_used', 'Gas used per mined transaction', ['operation'],
+                             buckets=GAS_BUCKETS)
+TRANSACTIONS = metrics.counter('bank_chain_transactions_total',
+                               'Contract transactions by outcome (recorded, reverted, error)', ['operation', 'outcome'])
+
+
+def observe_receipt(operation, seconds, tx_receipt):
+    """Record receipt latency, gas and outcome of a mined transaction"""
+    RECEIPT_SECONDS.observe(seconds, operation)
+    if tx_receipt.status == 1:
+        GAS_USED.observe(tx_receipt.gasUsed, operation)
+        TRANSACTIONS.inc(operation, 'recorded')
+    else:
+        TRANSACTIONS.inc(operation, 'reverted')
+
 # Contract ABI (updated from contract-abi.js)
 CONTRACT_ABI = [
     {
@@ -189,6 +209,7 @@ class BlockchainIntegration:
             print(f"   Amount: ₹{amount}")
             
             # For Ganache (unlocked accounts), we can send transaction directly
+            sending = time.perf_counter()
             tx_hash = self.contract.functions.recordDonation(
                 ngo_id,
                 donor_id,
@@ -200,10 +221,13 @@ class BlockchainIntegration:
                 'gas': 500000
             })
             
+            SEND_SECONDS.observe(time.perf_counter() - sending, 'donation')
             print(f"📤 Transaction sent: {tx_hash.hex()}")
             
             # Wait for transaction receipt
+            waiting = time.perf_counter()
             tx_receipt = self.web3.eth.wait_for_transaction_receipt(tx_hash, timeout=30)
+            observe_receipt('donation', time.perf_counter() - waiting, tx_receipt)
             
             if tx_receipt.status == 1:
                 # Parse logs to get the blockchain transaction ID
@@ -236,6 +260,7 @@ class BlockchainIntegration:
                 }
                 
         except Exception as e:
+            TRANSACTIONS.inc('donation', 'error')
             print(f"❌ Error recording donation on blockchain: {e}")
             return {
                 'success': False,
@@ -279,6 +304,7 @@ class BlockchainIntegration:
             print(f"   Amount: ₹{amount}")
             
             # Record spending on blockchain using recordSpending function
+            sending = time.perf_counter()
             tx_hash = self.contract.functions.recordSpending(
                 ngo_id,
                 receiver_id,
@@ -291,10 +317,13 @@ class BlockchainIntegration:
                 'gas': 500000
             })
             
+            SEND_SECONDS.observe(time.perf_counter() - sending, 'spending')
             print(f"📤 Spending transaction sent: {tx_hash.hex()}")
             
             # Wait for transaction receipt
+            waiting = time.perf_counter()
             tx_receipt = self.web3.eth.wait_for_transaction_receipt(tx_hash, timeout=30)
+            observe_receipt('spending', time.perf_counter() - waiting, tx_receipt)
             
             if tx_receipt.status == 1:
                 # Parse logs to get the blockchain transaction ID
@@ -327,6 +356,7 @@ class BlockchainIntegration:
                 }
                 
         except Exception as e:
+            TRANSACTIONS.inc('spending', 'error')
             print(f"❌ Error recording spending on blockchain: {e}")
             return {
                 'success': False,
@@ -335,6 +365,125 @@ class BlockchainIntegration:
                 'blockchain_tx_id': None
             }
 
+    def record_batch_on_blockchain(self, operations, on_sent=None):
+        """
+        Record many donations/spendings, sending every transaction before waiting for receipts
+
+        Args:
+            operations (list): Dicts with 'operation' ('donation' or 'spending'),
+                'ngo_account', 'counterparty_id' (donor or receiver), 'cause' and 'amount';
+                an optional 'reference' (unique per operation) seeds a spending's verification hash
+            on_sent (callable): fn(index, tx_hash) called as soon as operation `index`
+                has been sent, before any receipt is awaited
+
+        Returns:
+            list: One result dict per operation, in the same order
+        """
+        if not self.is_connected:
+            if not self.connect():
+                return [{
+                    'success': False,
+                    'error': 'Blockchain connection failed',
+                    'tx_hash': None,
+                    'blockchain_tx_id': None
+                } for _ in operations]
+
+        timestamp = int(time.time())
+        sent = []
+
+        # Send phase: submit every transaction so the node can mine them back to back
+        for index, op in enumerate(operations):
+            ngo_id = f"NGO_{op['ngo_account']}"
+            try:
+                if op['operation'] == 'spending':
+                    reference = op.get('reference') or f"{timestamp}_{index}"
+                    verification_hash = self.web3.keccak(text=f"spending_{op['ngo_account']}_{reference}")
+                    call = self.contract.functions.recordSpending(
+                        ngo_id,
+                        op['counterparty_id'],
+                        op['cause'] or "general_spending",
+                        op['amount'],
+                        timestamp,
+                        verification_hash
+                    )
+                else:
+                    call = self.contract.functions.recordDonation(
+                        ngo_id,
+                        op['counterparty_id'],
+                        op['cause'] or "general",
+                        op['amount'],
+                        timestamp
+                    )
+                sending = time.perf_counter()
+                tx_hash = call.transact({'from': self.account, 'gas': 500000})
+                SEND_SECONDS.observe(time.perf_counter() - sending, op['operation'])
+            except Exception as e:
+                TRANSACTIONS.inc(op['operation'], 'error')
+                sent.append((None, str(e)))
+                continue
+            sent.append((tx_hash, None))
+            if on_sent:
+                try:
+                    on_sent(index, tx_hash.hex())
+                except Exception as callback_error:
+                    print(f"⚠️ Could not note sent transaction {tx_hash.hex()}: {callback_error}")
+
+        print(f"📤 Batch of {len(operations)} transactions sent to blockchain")
+
+        # Receipt phase
+        results = []
+        for op, (tx_hash, send_error) in zip(operations, sent):
+            if tx_hash is None:
+                results.append({
+                    'success': False,
+                    'error': send_error,
+                    'tx_hash': None,
+                    'blockchain_tx_id': None
+                })
+                continue
+
+            try:
+                # Only the remaining wait: later transactions are mined while earlier receipts are awaited
+                waiting = time.perf_counter()
+                tx_receipt = self.web3.eth.wait_for_transaction_receipt(tx_hash, timeout=30)
+                observe_receipt(op['operation'], time.perf_counter() - waiting, tx_receipt)
+                if tx_receipt.status != 1:
+                    results.append({
+                        'success': False,
+                        'error': 'Transaction failed on blockchain',
+                        'tx_hash': tx_hash.hex(),
+                        'blockchain_tx_id': None
+                    })
+                    continue
+
+                blockchain_tx_id = None
+                if tx_receipt.logs:
+                    try:
+                        event = self.contract.events.FundsSpent() if op['operation'] == 'spending' else self.contract.events.DonationReceived()
+                        blockchain_tx_id = event.process_log(tx_receipt.logs[0])['args']['transactionId']
+                    except Exception as log_error:
+                        print(f"⚠️ Could not parse transaction ID from logs: {log_error}")
+
+                results.append({
+                    'success': True,
+                    'tx_hash': tx_hash.hex(),
+                    'blockchain_tx_id': blockchain_tx_id,
+                    'block_number': tx_receipt.blockNumber,
+                    'gas_used': tx_receipt.gasUsed
+                })
+            except Exception as e:
+                TRANSACTIONS.inc(op['operation'], 'error')
+                results.append({
+                    'success': False,
+                    'error': str(e),
+                    'tx_hash': tx_hash.hex(),
+                    'blockchain_tx_id': None
+                })
+
+        recorded = sum(1 for result in results if result['success'])
+        print(f"✅ Batch recorded on blockchain: {recorded}/{len(operations)} successful")
+        return results
+
     def get_ngo_balance_from_blockchain(self, ngo_account):
         """Get NGO balance from blockchain"""
         if not self.is_connected:
@@ -390,6 +539,168 @@ class BlockchainIntegration:
                 'error': str(e)
             }
 
+class AsyncBlockchainIntegration:
+    """
+    asyncio counterpart of BlockchainIntegration for async_app.py
+
+    Same contract, account and result dicts; waiting for a receipt suspends the
+    request instead of holding a thread. The HTTP session belongs to the event
+    loop that first connects, so use one instance per loop.
+    """
+
+    def __init__(self):
+        self.web3 = None
+        self.contract = None
+        self.account = None
+        self.is_connected = False
+
+    async def connect(self):
+        """Connect to Ganache blockchain"""
+        try:
+            # One provider (and its pooled HTTP session) for every attempt; disconnect() closes it
+            if self.web3 is None:
+                self.web3 = AsyncWeb3(AsyncHTTPProvider(GANACHE_URL))
+
+            if not await self.web3.is_connected():
+                raise Exception("Failed to connect to Ganache")
+
+            if not await self.web3.eth.accounts:
+                raise Exception("No accounts found in Ganache")
+
+            self.account = "0x35b6cdc6F2a0990d38d232eEe6007846B531d5a0"
+            self.contract = self.web3.eth.contract(
+                address=AsyncWeb3.to_checksum_address(CONTRACT_ADDRESS),
+                abi=CONTRACT_ABI
+            )
+
+            self.is_connected = True
+            print(f"✅ Connected to blockchain successfully (async)")
+            return True
+
+        except Exception as e:
+            print(f"❌ Blockchain connection failed: {e}")
+            self.is_connected = False
+            return False
+
+    async def disconnect(self):
+        """Close the HTTP session; call before the event loop shuts down"""
+        if self.web3 is not None:
+            await self.web3.provider.disconnect()
+        self.web3 = None
+        self.is_connected = False
+
+    async def _record(self, call, event, label):
+        """Send a contract call, await its receipt and build the result dict"""
+        if not self.is_connected:
+            if not await self.connect():
+                return {
+                    'success': False,
+                    'error': 'Blockchain connection failed',
+                    'tx_hash': None,
+                    'blockchain_tx_id': None
+                }
+
+        operation = label.lower()
+        try:
+            sending = time.perf_counter()
+            tx_hash = await call(self.contract.functions).transact({
+                'from': self.account,
+                'gas': 500000
+            })
+            SEND_SECONDS.observe(time.perf_counter() - sending, operation)
+            waiting = time.perf_counter()
+            tx_receipt = await self.web3.eth.wait_for_transaction_receipt(tx_hash, timeout=30)
+            observe_receipt(operation, time.perf_counter() - waiting, tx_receipt)
+
+            if tx_receipt.status != 1:
+                return {
+                    'success': False,
+                    'error': 'Transaction failed on blockchain',
+                    'tx_hash': tx_hash.hex(),
+                    'blockchain_tx_id': None
+                }
+
+            blockchain_tx_id = None
+            if tx_receipt.logs:
+                try:
+                    blockchain_tx_id = getattr(self.contract.events, event)().process_log(tx_receipt.logs[0])['args']['transactionId']
+                except Exception as log_error:
+                    print(f"⚠️ Could not parse transaction ID from logs: {log_error}")
+
+            print(f"✅ {label} recorded on blockchain: {tx_hash.hex()}")
+            return {
+                'success': True,
+                'tx_hash': tx_hash.hex(),
+                'blockchain_tx_id': blockchain_tx_id,
+                'block_number': tx_receipt.blockNumber,
+                'gas_used': tx_receipt.gasUsed
+            }
+
+        except Exception as e:
+            TRANSACTIONS.inc(operation, 'error')
+            print(f"❌ Error recording {operation} on blockchain: {e}")
+            return {
+                'success': False,
+                'error': str(e),
+                'tx_hash': None,
+                'blockchain_tx_id': None
+            }
+
+    async def record_donation_on_blockchain(self, ngo_account, donor_id, cause, amount):
+        """See BlockchainIntegration.record_donation_on_blockchain"""
+        timestamp = int(time.time())
+        return await self._record(
+            lambda functions: functions.recordDonation(f"NGO_{ngo_account}", donor_id, cause or "general",
+                                                       amount, timestamp),
+            'DonationReceived', 'Donation'
+        )
+
+    async def record_spending_on_blockchain(self, ngo_account, receiver_id, cause, amount):
+        """See BlockchainIntegration.record_spending_on_blockchain"""
+        timestamp = int(time.time())
+        verification_hash = AsyncWeb3.keccak(text=f"spending_{ngo_account}_{timestamp}")
+        return await self._record(
+            lambda functions: functions.recordSpending(f"NGO_{ngo_account}", receiver_id,
+                                                       cause or "general_spending", amount, timestamp,
+                                                       verification_hash),
+            'FundsSpent', 'Spending'
+        )
+
+    async def get_ngo_balance_from_blockchain(self, ngo_account):
+        """Get NGO balance from blockchain"""
+        if not self.is_connected:
+            if not await self.connect():
+                return None
+
+        try:
+            return await self.contract.functions.getNgoBalance(f"NGO_{ngo_account}").call()
+        except Exception as e:
+            print(f"❌ Error getting NGO balance from blockchain: {e}")
+            return None
+
+    async def get_blockchain_status(self):
+        """Get blockchain connection status and basic info"""
+        if not self.is_connected:
+            return {
+                'connected': False,
+                'error': 'Not connected to blockchain'
+            }
+
+        try:
+            return {
+                'connected': True,
+                'latest_block': await self.web3.eth.block_number,
+                'contract_address': CONTRACT_ADDRESS,
+                'account': self.account,
+                'total_donations_on_chain': await self.contract.functions.totalDonations().call(),
+                'chain_id': CHAIN_ID
+            }
+        except Exception as e:
+            return {
+                'connected': False,
+                'error': str(e)
+            }
+
 # Global instance
 blockchain = BlockchainIntegration()
 
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+"""
+Chain Outbox for Banking System
+Durable queue of blockchain recordings, sent to the contract in batches
+
+Operations go PENDING -> SENT (transaction submitted, tx_hash stored at once)
+-> RECORDED, or UNCONFIRMED when no receipt arrived. Only PENDING rows without
+a tx_hash are ever claimed, so an operation is sent at most once however long
+its batch waits for receipts; SENT rows left behind by a crash are settled by
+an operator against the chain, never resent.
+"""
+
+import os
+import random
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from blockchain_integration import blockchain
+from sql_trace import sql_trace
+
+# Configuration
+DB_PATH = os.path.join(os.path.dirname(__file__), 'bank.db')
+CHAIN_BATCH_SIZE = 100  # operations sent per round
+MAX_ATTEMPTS = 8  # after this the operation is parked as FAILED
+BACKOFF_BASE = 5  # seconds, doubled on every failed attempt
+BACKOFF_MAX = 600  # seconds
+POLL_INTERVAL = 5  # seconds between scans when nobody wakes us up
+LEASE_SECONDS = 120  # claimed rows are hidden from other workers this long; renewed after every send
+
+
+class ChainOutbox:
+    def __init__(self, db_path=DB_PATH):
+        self.db_path = db_path
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _connect(self):
+        conn = sql_trace.connect(self.db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @staticmethod
+    def init_outbox(cursor):
+        """Create the chain outbox table"""
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS chain_outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                batch_id VARCHAR(32) NOT NULL,
+                operation VARCHAR(20) NOT NULL,
+                ngo_account INTEGER NOT NULL,
+                counterparty_id VARCHAR(64) NOT NULL,
+                cause VARCHAR(50),
+                amount INTEGER NOT NULL,
+                status VARCHAR(20) NOT NULL DEFAULT 'PENDING',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                tx_hash VARCHAR(80),
+                blockchain_tx_id INTEGER,
+                last_error TEXT,
+                created_at VARCHAR(30) NOT NULL,
+                recorded_at VARCHAR(30)
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_chain_outbox_due ON chain_outbox (status, next_attempt_at)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_chain_outbox_batch ON chain_outbox (batch_id)")
+
+    @staticmethod
+    def enqueue_batch(cursor, operations, batch_id=None):
+        """
+        Queue blockchain operations inside the caller's transaction
+
+        Args:
+            cursor: Cursor of the transaction that applies the matching ledger changes
+            operations (list): Dicts with 'operation' ('donation' or 'spending'),
+                'ngo_account', 'counterparty_id', 'cause' and 'amount'
+            batch_id (str): Id to queue them under, so one batch can span the
+                outboxes of several shards; a new one by default
+
+        Returns:
+            str: Batch id shared by all queued operations
+        """
+        batch_id = batch_id or uuid.uuid4().hex
+        now = time.time()
+        created_at = str(datetime.now())
+        cursor.executemany("""
+            INSERT INTO chain_outbox (batch_id, operation, ngo_account, counterparty_id, cause, amount,
+                                      status, attempts, next_attempt_at, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, 'PENDING', 0, ?, ?)
+        """, [(batch_id, op['operation'], op['ngo_account'], op['counterparty_id'], op['cause'],
+               op['amount'], now, created_at) for op in operations])
+        return batch_id
+
+    def notify(self):
+        """Wake the outbox thread after a commit that queued operations"""
+        self._wakeup.set()
+
+    def get_batch(self, batch_id):
+        """Get the recording state of every operation in a batch"""
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT * FROM chain_outbox WHERE batch_id = ? ORDER BY id", (batch_id,))
+            rows = cursor.fetchall()
+        finally:
+            conn.close()
+
+        if not rows:
+            return None
+
+        operations = [{
+            'id': row['id'],
+            'operation': row['operation'],
+            'ngo_account': row['ngo_account'],
+            'counterparty_id': row['counterparty_id'],
+            'cause': row['cause'],
+            'amount': row['amount'],
+            'status': row['status'],
+            'attempts': row['attempts'],
+            'tx_hash': row['tx_hash'],
+            'blockchain_tx_id': row['blockchain_tx_id'],
+            'error': row['last_error'],
+            'recorded_at': row['recorded_at']
+        } for row in rows]
+        return self._summary(batch_id, operations)
+
+    @staticmethod
+    def _summary(batch_id, operations):
+        counts = {}
+        for op in operations:
+            counts[op['status']] = counts.get(op['status'], 0) + 1
+
+        return {
+            'batch_id': batch_id,
+            'total': len(operations),
+            'status_counts': counts,
+            'operations': operations
+        }
+
+    @classmethod
+    def merge_batches(cls, batch_id, batches):
+        """One view of a batch queued in several outboxes (get_batch() results, None where absent)"""
+        operations = [op for batch in batches if batch for op in batch['operations']]
+        return cls._summary(batch_id, operations) if operations else None
+
+    def queue_depth(self):
+        """Number of operations still waiting to be recorded"""
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT COUNT(*) FROM chain_outbox WHERE status = 'PENDING'")
+            return cursor.fetchone()[0]
+        finally:
+            conn.close()
+
+    def start(self):
+        """Start the background recording thread (no-op if already running)"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='chain-outbox', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=30):
+        """Stop the recording thread after the round in progress"""
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                recorded_any = self.record_due()
+            except Exception as e:
+                print(f"❌ Chain outbox error: {e}")
+                recorded_any = False
+
+            if not recorded_any:
+                self._wakeup.wait(POLL_INTERVAL)
+                self._wakeup.clear()
+
+    def _claim_due(self):
+        """Claim a batch of due operations, leasing them away from other workers"""
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.isolation_level = None
+            cursor = conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute("""
+                SELECT * FROM chain_outbox
+                WHERE status = 'PENDING' AND tx_hash IS NULL AND next_attempt_at <= ?
+                ORDER BY id
+                LIMIT ?
+            """, (now, CHAIN_BATCH_SIZE))
+            rows = cursor.fetchall()
+            if rows:
+                cursor.executemany("UPDATE chain_outbox SET next_attempt_at = ? WHERE id = ?",
+                                   [(now + LEASE_SECONDS, row['id']) for row in rows])
+            cursor.execute("COMMIT")
+            return rows
+        finally:
+            conn.close()
+
+    def _mark_sent(self, rows, index, tx_hash):
+        """Store the tx_hash of a sent operation and renew the lease on the rest of the batch"""
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("UPDATE chain_outbox SET status = 'SENT', tx_hash = ? WHERE id = ?",
+                           (tx_hash, rows[index]['id']))
+            unsent = [row['id'] for row in rows[index + 1:]]
+            if unsent:
+                cursor.execute(f"""
+                    UPDATE chain_outbox SET next_attempt_at = ?
+                    WHERE status = 'PENDING' AND id IN ({','.join('?' * len(unsent))})
+                """, [time.time() + LEASE_SECONDS] + unsent)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def record_due(self):
+        """
+        Record one batch of due operations on the blockchain
+
+        Returns:
+            bool: True if a batch was processed (more may be waiting)
+        """
+        rows = self._claim_due()
+        if not rows:
+            return False
+
+        print(f"🔗 Recording {len(rows)} queued operation(s) on blockchain")
+        results = blockchain.record_batch_on_blockchain([{
+            'operation': row['operation'],
+            'ngo_account': row['ngo_account'],
+            'counterparty_id': row['counterparty_id'],
+            'cause': row['cause'],
+            'amount': row['amount'],
+            'reference': f"outbox_{row['id']}"
+        } for row in rows], on_sent=lambda index, tx_hash: self._mark_sent(rows, index, tx_hash))
+
+        now = time.time()
+        recorded_at = str(datetime.now())
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            for row, result in zip(rows, results):
+                attempts = row['attempts'] + 1
+                if result['success']:
+                    cursor.execute("""
+                        UPDATE chain_outbox
+                        SET status = 'RECORDED', attempts = ?, tx_hash = ?, blockchain_tx_id = ?,
+                            last_error = NULL, recorded_at = ?
+                        WHERE id = ?
+                    """, (attempts, result['tx_hash'], result['blockchain_tx_id'], recorded_at, row['id']))
+                elif result['tx_hash'] and result.get('error') != 'Transaction failed on blockchain':
+                    # Sent but never confirmed: resending could record it twice
+                    cursor.execute("""
+                        UPDATE chain_outbox SET status = 'UNCONFIRMED', attempts = ?, tx_hash = ?, last_error = ?
+                        WHERE id = ?
+                    """, (attempts, result['tx_hash'], result['error'], row['id']))
+                    print(f"⚠️ Chain operation {row['id']} sent but unconfirmed: {result['error']}")
+                elif attempts >= MAX_ATTEMPTS:
+                    cursor.execute("""
+                        UPDATE chain_outbox SET status = 'FAILED', attempts = ?, tx_hash = NULL, last_error = ?
+                        WHERE id = ?
+                    """, (attempts, result['error'], row['id']))
+                    print(f"❌ Chain operation {row['id']} failed permanently: {result['error']}")
+                else:
+                    delay = min(BACKOFF_MAX, BACKOFF_BASE * (2 ** (attempts - 1))) * random.uniform(0.5, 1.0)
+                    # Not sent, or reverted (nothing recorded): safe to send again
+                    cursor.execute("""
+                        UPDATE chain_outbox SET status = 'PENDING', attempts = ?, tx_hash = NULL, last_error = ?,
+                            next_attempt_at = ?
+                        WHERE id = ?
+                    """, (attempts, result['error'], now + delay, row['id']))
+            conn.commit()
+        finally:
+            conn.close()
+
+        return True
+
+
+# Global instance
+chain_outbox = ChainOutbox()
@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+"""
+Donation Analytics for Banking System
+Platform-wide donation totals per cause, city and month, percentiles and top donors/NGOs
+
+Usage:
+    python donation_analytics.py
+    python donation_analytics.py --group-by cause,month --top 5 --start-month 2025-01 --json
+"""
+
+import argparse
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import ledger
+import ledger_archive
+from sql_trace import sql_trace
+
+# Configuration
+DB_PATH = os.path.join(os.path.dirname(__file__), 'bank.db')
+GROUPS = ('cause', 'city', 'month')
+PERCENTILES = (50, 90, 99)
+UNSPECIFIED = 'Unspecified'
+
+
+class _Dictionary:
+    """Append-only value <-> code mapping shared by all accounts, so codes never change"""
+
+    def __init__(self):
+        self.codes = {}
+        self.values = []
+
+    def code(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+
+def _percentile(sorted_values, p):
+    """Linear interpolation between closest ranks (numpy's default method)"""
+    position = (len(sorted_values) - 1) * p / 100
+    lower = math.floor(position)
+    upper = math.ceil(position)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+class DonationAnalytics:
+    """
+    Donations are the deposits and donations received in every account's ledger
+    that name a donor (ledger.is_donation); transfer receipts are not. Ledger columns are kept in memory per account as typed arrays
+    and reloaded only when the account's ledger version changes, so a report costs
+    one small version query plus the aggregation itself.
+    """
+
+    def __init__(self, db_path=DB_PATH):
+        self.db_path = db_path
+        self.db_paths = [db_path]  # every database holding accounts (the shard files when sharded)
+        self._accounts = {}  # username -> {'version', 'amount', 'cause', 'month', 'donor'}
+        self._causes = _Dictionary()
+        self._months = _Dictionary()
+        self._donors = _Dictionary()
+        self._lock = threading.Lock()
+
+    def _connect(self, db_path):
+        conn = sql_trace.connect(db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _load_account(self, conn, username, version):
+        columns = {'version': version, 'amount': array('q'), 'cause': array('i'),
+                   'month': array('i'), 'donor': array('i')}
+        try:
+            history = ledger_archive.ArchivedLedger(conn, username)
+        except sqlite3.OperationalError:
+            return columns  # Database without the archive catalog
+        try:
+            # Archived periods are part of the account's donation history
+            for part, transactions in history.views():
+                try:
+                    cursor = part.execute(f"SELECT timedate, transaction_type, amount, donor_id, cause FROM {transactions}")
+                except sqlite3.OperationalError:
+                    return columns  # Account without a transaction table
+
+                while True:
+                    rows = cursor.fetchmany(5000)
+                    if not rows:
+                        break
+                    for timedate, transaction_type, amount, donor_id, cause in rows:
+                        if not ledger.is_donation(transaction_type, donor_id):
+                            continue
+                        columns['amount'].append(int(amount or 0))
+                        columns['cause'].append(self._causes.code(cause if cause not in (None, '', 'None') else UNSPECIFIED))
+                        columns['month'].append(self._months.code(str(timedate)[:7]))
+                        columns['donor'].append(self._donors.code(str(donor_id)))
+        finally:
+            history.close()
+        return columns
+
+    def refresh(self):
+        """
+        Bring the in-memory columns up to date
+
+        Returns:
+            list: (username, account_number, city) of every account, in a stable order
+        """
+        accounts = []
+        for db_path in self.db_paths:
+            conn = self._connect(db_path)
+            try:
+                cursor = conn.cursor()
+                cursor.execute("SELECT username, account_number, city FROM customers ORDER BY username")
+                database_accounts = [(row['username'], row['account_number'], row['city']) for row in cursor.fetchall()]
+                try:
+                    cursor.execute("SELECT username, version FROM ledger_versions")
+                    versions = {row['username']: row['version'] for row in cursor.fetchall()}
+                except sqlite3.OperationalError:
+                    versions = {}
+
+                with self._lock:
+                    for username, _, _ in database_accounts:
+                        version = versions.get(username, 0)
+                        cached = self._accounts.get(username)
+                        if cached is None or cached['version'] != version:
+                            self._accounts[username] = self._load_account(conn, username, version)
+            finally:
+                conn.close()
+            accounts += database_accounts
+
+        with self._lock:
+            live = {username for username, _, _ in accounts}
+            for username in [name for name in self._accounts if name not in live]:
+                del self._accounts[username]
+        return sorted(accounts)
+
+    def _columns(self, accounts):
+        """Platform-wide columns: amount, cause, month, donor, ngo and city codes"""
+        cities = _Dictionary()
+        with self._lock:
+            parts = [self._accounts[username] for username, _, _ in accounts]
+            labels = {'cause': list(self._causes.values), 'month': list(self._months.values),
+                      'donor': list(self._donors.values), 'city': cities.values}
+        lengths = [len(part['amount']) for part in parts]
+        city_codes = [cities.code(city or UNSPECIFIED) for _, _, city in accounts]
+
+        if np is not None:
+            def concat(name, dtype):
+                chunks = [np.frombuffer(part[name], dtype=dtype) for part in parts if len(part[name])]
+                return np.concatenate(chunks) if chunks else np.empty(0, dtype=dtype)
+
+            ngo = np.repeat(np.arange(len(accounts), dtype=np.int32), lengths)
+            columns = {
+                'amount': concat('amount', np.int64),
+                'cause': concat('cause', np.int32),
+                'month': concat('month', np.int32),
+                'donor': concat('donor', np.int32),
+                'ngo': ngo,
+                'city': np.asarray(city_codes, dtype=np.int32)[ngo] if len(ngo) else np.empty(0, dtype=np.int32)
+            }
+        else:
+            columns = {name: [value for part in parts for value in part[name]]
+                       for name in ('amount', 'cause', 'month', 'donor')}
+            columns['ngo'] = [index for index, length in enumerate(lengths) for _ in range(length)]
+            columns['city'] = [city_codes[index] for index in columns['ngo']]
+
+        return columns, labels
+
+    @staticmethod
+    def _filter(columns, labels, cause=None, start_month=None, end_month=None):
+        if not (cause or start_month or end_month):
+            return columns
+
+        cause_ok = [cause is None or value.lower() == cause.lower() for value in labels['cause']]
+        month_ok = [(not start_month or value >= start_month) and (not end_month or value <= end_month)
+                    for value in labels['month']]
+
+        if np is not None:
+            mask = np.asarray(cause_ok, dtype=bool)[columns['cause']] & np.asarray(month_ok, dtype=bool)[columns['month']]
+            return {name: values[mask] for name, values in columns.items()}
+
+        keep = [index for index, (c, m) in enumerate(zip(columns['cause'], columns['month']))
+                if cause_ok[c] and month_ok[m]]
+        return {name: [values[index] for index in keep] for name, values in columns.items()}
+
+    @staticmethod
+    def _grouped(codes, amounts, size):
+        """Per-group (count, total, {percentile: value}) for codes 0..size-1"""
+        if np is not None:
+            counts = np.bincount(codes, minlength=size)
+            totals = np.bincount(codes, weights=amounts, minlength=size)
+            # Sort by group, then amount: each group becomes a contiguous sorted run
+            low = int(amounts.min()) if len(amounts) else 0
+            if len(amounts) and int(amounts.max()) - low < 1 << 40 and size < 1 << 22:
+                # One sort of packed (group, amount) keys is much faster than lexsort
+                keys = np.sort((codes.astype(np.int64) << 40) | (amounts - low))
+                ordered = ((keys & ((1 << 40) - 1)) + low).astype(np.float64)
+            else:
+                ordered = amounts[np.lexsort((amounts, codes))].astype(np.float64)
+            starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+            nonempty = counts > 0
+            quantiles = {}
+            for p in PERCENTILES:
+                position = starts + (counts - 1) * p / 100
+                lower = np.floor(position).astype(np.int64)
+                upper = np.ceil(position).astype(np.int64)
+                value = np.zeros(size)
+                value[nonempty] = (ordered[lower[nonempty]]
+                                   + (ordered[upper[nonempty]] - ordered[lower[nonempty]])
+                                   * (position[nonempty] - lower[nonempty]))
+                quantiles[p] = value
+            return [(int(counts[code]), int(round(totals[code])),
+                     {p: round(float(quantiles[p][code]), 2) for p in PERCENTILES})
+                    for code in range(size)]
+
+        groups = [[] for _ in range(size)]
+        for code, amount in zip(codes, amounts):
+            groups[code].append(amount)
+        result = []
+        for values in groups:
+            values.sort()
+            result.append((len(values), sum(values),
+                           {p: round(float(_percentile(values, p)), 2) if values else 0.0 for p in PERCENTILES}))
+        return result
+
+    @staticmethod
+    def _top(codes, amounts, size, top_n):
+        """(code, count, total) of the top_n codes by total; negative codes are skipped"""
+        if np is not None:
+            valid = codes >= 0
+            counts = np.bincount(codes[valid], minlength=size)
+            totals = np.bincount(codes[valid], weights=amounts[valid], minlength=size)
+            if size > top_n:
+                candidates = np.argpartition(-totals, top_n)[:top_n]
+            else:
+                candidates = np.arange(size)
+            best = candidates[np.argsort(-totals[candidates], kind='stable')]
+            return [(int(code), int(counts[code]), int(round(totals[code]))) for code in best if counts[code]]
+
+        counts = [0] * size
+        totals = [0] * size
+        for code, amount in zip(codes, amounts):
+            if code >= 0:
+                counts[code] += 1
+                totals[code] += amount
+        best = sorted((code for code in range(size) if counts[code]), key=lambda code: -totals[code])[:top_n]
+        return [(code, counts[code], totals[code]) for code in best]
+
+    def report(self, group_by=GROUPS, top_n=10, cause=None, start_month=None, end_month=None):
+        """
+        Build the platform-wide donation report
+
+        Args:
+            group_by (iterable): Any of 'cause', 'city', 'month'
+            top_n (int): Number of top donors and NGOs to return
+            cause (str): Only donations for this cause
+            start_month (str): Only donations from this month on (YYYY-MM)
+            end_month (str): Only donations up to this month (YYYY-MM)
+
+        Returns:
+            dict: totals, by_<group> lists, top_donors and top_ngos
+        """
+        started = time.perf_counter()
+        accounts = self.refresh()
+        columns, labels = self._columns(accounts)
+        columns = self._filter(columns, labels, cause, start_month, end_month)
+        amounts = columns['amount']
+
+        count = len(amounts)
+        if count:
+            ordered = np.sort(amounts) if np is not None else sorted(amounts)
+            overall = {f"p{p}": round(float(np.percentile(ordered, p) if np is not None else _percentile(ordered, p)), 2)
+                       for p in PERCENTILES}
+        else:
+            overall = {f"p{p}": 0.0 for p in PERCENTILES}
+
+        result = {
+            'totals': {
+                'donations': count,
+                'amount': int(amounts.sum()) if np is not None else sum(amounts),
+                'ngos': int(np.unique(columns['ngo']).size) if np is not None else len(set(columns['ngo'])),
+                **overall
+            }
+        }
+
+        for group in group_by:
+            names = labels[group]
+            rows = []
+            for code, (group_count, total, quantiles) in enumerate(self._grouped(columns[group], amounts, len(names))):
+                if group_count:
+                    rows.append({group: names[code], 'donations': group_count, 'amount': total,
+                                 **{f"p{p}": value for p, value in quantiles.items()}})
+            # Months read best in calendar order, everything else largest first
+            rows.sort(key=(lambda row: row['month']) if group == 'month' else (lambda row: -row['amount']))
+            result[f"by_{group}"] = rows
+
+        result['top_donors'] = [
+            {'donor_id': labels['donor'][code], 'donations': donor_count, 'amount': total}
+            for code, donor_count, total in self._top(columns['donor'], amounts, len(labels['donor']), top_n)
+        ]
+        result['top_ngos'] = [
+            {'username': accounts[code][0], 'account_number': accounts[code][1], 'donations': ngo_count, 'amount': total}
+            for code, ngo_count, total in self._top(columns['ngo'], amounts, len(accounts), top_n)
+        ]
+        result['engine'] = 'numpy' if np is not None else 'python'
+        result['seconds'] = round(time.perf_counter() - started, 4)
+        return result
+
+
+# Global instance
+donation_analytics = DonationAnalytics()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Platform-wide donation analytics')
+    parser.add_argument('--group-by', default=','.join(GROUPS), help='Comma separated: cause, city, month')
+    parser.add_argument('--top', type=int, default=10, help='Number of top donors and NGOs')
+    parser.add_argument('--cause', help='Only donations for this cause')
+    parser.add_argument('--start-month', help='Only donations from this month on (YYYY-MM)')
+    parser.add_argument('--end-month', help='Only donations up to this month (YYYY-MM)')
+    parser.add_argument('--json', action='store_true', help='Print the raw JSON report')
+    args = parser.parse_args()
+
+    group_by = [group.strip() for group in args.group_by.split(',') if group.strip()]
+    unknown = [group for group in group_by if group not in GROUPS]
+    if unknown:
+        parser.error(f"Unknown group(s): {', '.join(unknown)}")
+
+    result = donation_analytics.report(group_by, args.top, args.cause, args.start_month, args.end_month)
+    if args.json:
+        print(json.dumps(result, indent=2))
+        return
+
+    totals = result['totals']
+    print(f"📊 {totals['donations']} donations, {totals['amount']} total across {totals['ngos']} NGOs "
+          f"(p50 {totals['p50']:g}, p90 {totals['p90']:g}, p99 {totals['p99']:g}) "
+          f"in {result['seconds']}s [{result['engine']}]")
+    for group in group_by:
+        print(f"\nBy {group}:")
+        for row in result[f"by_{group}"]:
+            print(f"  {row[group]:<20} {row['donations']:>10} {row['amount']:>14}  p50 {row['p50']:g}")
+    print("\nTop donors:")
+    for row in result['top_donors']:
+        print(f"  {row['donor_id']:<20} {row['donations']:>10} {row['amount']:>14}")
+    print("\nTop NGOs:")
+    for row in result['top_ngos']:
+        print(f"  {row['username']:<20} {row['donations']:>10} {row['amount']:>14}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+"""
+Group Commit Writer for Banking System
+Applies balance and ledger mutations from many requests in one SQLite transaction
+"""
+
+import contextvars
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+from metrics import SIZE_BUCKETS, metrics
+from sql_trace import sql_trace
+
+# Configuration
+DB_PATH = os.path.join(os.path.dirname(__file__), 'bank.db')
+GROUP_COMMIT_WINDOW = float(os.environ.get('BANK_GROUP_COMMIT_WINDOW_MS', '2')) / 1000  # seconds to gather a group
+GROUP_COMMIT_MAX_BATCH = 256  # mutations per transaction
+MUTATION_TIMEOUT = 30  # seconds a request waits for its group to commit
+
+QUEUE_WAIT_SECONDS = metrics.histogram('bank_write_queue_wait_seconds',
+                                       'Time a mutation waits for its group commit to start', ['database'])
+WRITE_SECONDS = metrics.histogram('bank_sqlite_write_seconds',
+                                  'SQLite time of one group commit, BEGIN to COMMIT', ['database'])
+GROUP_SIZE = metrics.histogram('bank_group_commit_size', 'Mutations per group commit', ['database'],
+                               buckets=SIZE_BUCKETS)
+
+
+class MutationRejected(Exception):
+    """
+    Raised inside a mutation to fail only that request
+
+    Everything the mutation wrote is rolled back; the other mutations in the
+    group still commit.
+    """
+
+    def __init__(self, message, status_code=400, details=None):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+        self.details = details or {}
+
+
+class WriteWatch:
+    """
+    Mutations submitted from one thread or asyncio task while the watch is active
+
+    idempotency.py uses it to tell a failed request that never moved money
+    (its key can be released for a retry) from one that may have.
+    """
+
+    def __init__(self):
+        self.futures = []
+        self.direct_writes = False  # written outside the writer (cross-shard transfers)
+        self._token = None
+
+    def __enter__(self):
+        self._token = _watch.set(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        _watch.reset(self._token)
+
+    def nothing_committed(self):
+        """
+        Withdraw the watched mutations still queued; True only if none of them
+        can have committed (each was withdrawn before running or rolled back)
+        """
+        if self.direct_writes:
+            return False
+        for future in self.futures:
+            future.cancel()
+        return all(future.cancelled() or (future.done() and future.exception() is not None)
+                   for future in self.futures)
+
+
+_watch = contextvars.ContextVar('group_commit_watch', default=None)
+
+
+def note_direct_write():
+    """Tell the active WriteWatch (if any) that money is being moved without the writer"""
+    watch = _watch.get()
+    if watch is not None:
+        watch.direct_writes = True
+
+
+class WriteTransaction:
+    """Handle passed to each mutation: the shared cursor plus after-commit hooks"""
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self._after_commit = []
+
+    def after_commit(self, callback):
+        """Run `callback()` once the group has committed (skipped if this mutation is rolled back)"""
+        self._after_commit.append(callback)
+
+    def run_after_commit(self):
+        """Run the registered callbacks; called by whoever committed the transaction"""
+        for callback in self._after_commit:
+            try:
+                callback()
+            except Exception as callback_error:
+                print(f"⚠️ After-commit hook failed: {callback_error}")
+
+
+class GroupCommitWriter:
+    def __init__(self, db_path=DB_PATH, window=GROUP_COMMIT_WINDOW, max_batch=GROUP_COMMIT_MAX_BATCH):
+        self.db_path = db_path
+        self.window = window
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._thread = None
+        self._stopping = False
+        self._lock = threading.Lock()
+        self._label = os.path.basename(db_path)
+
+    def _connect(self):
+        conn = sql_trace.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def start(self):
+        """Start the writer thread (no-op if already running)"""
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name='group-commit-writer', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=30):
+        """Commit everything already submitted, then stop the writer thread"""
+        with self._lock:
+            if not self._thread:
+                return
+            self._stopping = True
+            self._queue.put(None)
+            self._thread.join(timeout)
+            self._thread = None
+
+    def queue_depth(self):
+        """Mutations waiting for the next group"""
+        return self._queue.qsize()
+
+    def submit(self, mutation):
+        """
+        Queue a mutation for the next group commit
+
+        Args:
+            mutation (callable): fn(txn) -> result, run on the writer thread with a
+                WriteTransaction; raise MutationRejected to fail just this request
+
+        Returns:
+            Future: Resolves to the mutation's result once its group has committed
+        """
+        if self._stopping:
+            raise RuntimeError('Group commit writer is shutting down')
+        self.start()
+        future = Future()
+        watch = _watch.get()
+        if watch is not None:
+            watch.futures.append(future)
+        self._queue.put((mutation, future, time.perf_counter()))
+        return future
+
+    def execute(self, mutation, timeout=MUTATION_TIMEOUT):
+        """
+        Submit a mutation and wait for its committed result (re-raises MutationRejected)
+
+        On timeout the mutation is withdrawn from the queue, so a request that
+        answered with an error never commits later. If its group has already
+        started it can no longer be withdrawn, and its outcome is awaited instead.
+        """
+        future = self.submit(mutation)
+        try:
+            return future.result(timeout)
+        except FutureTimeoutError:
+            if future.cancel():
+                raise
+            return future.result()
+
+    def _run(self):
+        conn = self._connect()
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    break
+                batch = [item]
+
+                # Gather whatever else arrives within the window
+                deadline = time.monotonic() + self.window
+                stop_after_batch = False
+                while len(batch) < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    try:
+                        item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        stop_after_batch = True
+                        break
+                    batch.append(item)
+
+                self._apply(conn, batch)
+                if stop_after_batch:
+                    break
+
+            # Drain anything submitted before stop() was called
+            while True:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is not None:
+                    self._apply(conn, [item])
+        finally:
+            conn.close()
+
+    def _apply(self, conn, batch):
+        cursor = conn.cursor()
+        outcomes = []
+        started = time.perf_counter()
+        for _, _, submitted in batch:
+            QUEUE_WAIT_SECONDS.observe(started - submitted, self._label)
+        GROUP_SIZE.observe(len(batch), self._label)
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            for mutation, future, _ in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                txn = WriteTransaction(cursor)
+                cursor.execute("SAVEPOINT mutation")
+                try:
+                    result = mutation(txn)
+                    cursor.execute("RELEASE SAVEPOINT mutation")
+                    outcomes.append((future, txn, result, None))
+                except Exception as e:
+                    # Undo only this request's writes; MutationRejected is an expected business failure
+                    cursor.execute("ROLLBACK TO SAVEPOINT mutation")
+                    cursor.execute("RELEASE SAVEPOINT mutation")
+                    outcomes.append((future, None, None, e))
+            cursor.execute("COMMIT")
+            WRITE_SECONDS.observe(time.perf_counter() - started, self._label)
+        except Exception as e:
+            print(f"❌ Group commit failed for {len(batch)} mutation(s): {e}")
+            if conn.in_transaction:
+                conn.rollback()
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for future, txn, result, error in outcomes:
+            if error is not None:
+                future.set_exception(error)
+                continue
+            txn.run_after_commit()
+            future.set_result(result)
+
+
+# Global instance
+writer = GroupCommitWriter()
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""
+Idempotency Keys for Banking System
+Replays the stored response of a request retried with the same Idempotency-Key
+
+A client sends an Idempotency-Key header (any unique string, e.g. a UUID) with
+add_money or transfer. The first request claims the key; its response is
+stored when it finishes, and a retry with the same key gets that response back
+with an Idempotent-Replayed header, without touching balances or the chain.
+
+- A retry while the first request is still running gets 409 with Retry-After.
+- Reusing a key with a different request body gets 422.
+- Keys expire after BANK_IDEMPOTENCY_TTL_HOURS; expired rows are purged as
+  new keys are claimed.
+
+Responses are stored whatever their status (an error is replayed as well),
+except 429 (a shed request never ran) and server errors none of whose writes
+committed (e.g. the write timed out in the queue). A request that fails with
+an exception (or, in async_app.py, is cancelled) releases its key only if
+none of its writes can have committed; otherwise, as after a crash, the key
+stays claimed until it expires and retries get 409 rather than risk a second
+credit.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from functools import wraps
+
+from flask import jsonify, make_response, request
+
+from group_commit import WriteWatch, writer
+from metrics import metrics
+from sql_trace import sql_trace
+
+# Configuration
+DB_PATH = os.path.join(os.path.dirname(__file__), 'bank.db')
+IDEMPOTENCY_TTL = float(os.environ.get('BANK_IDEMPOTENCY_TTL_HOURS', '24')) * 3600  # seconds a key is remembered
+IDEMPOTENCY_PURGE_INTERVAL = 60  # seconds between purges of expired keys
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+IN_PROGRESS_RETRY_AFTER = 2  # seconds
+
+REPLIES = metrics.counter('bank_idempotency_replies_total',
+                          'Requests answered from an existing Idempotency-Key (replayed, in_progress, mismatch)',
+                          ['outcome'])
+
+
+class IdempotencyStore:
+    def __init__(self, db_path=DB_PATH, ttl=IDEMPOTENCY_TTL, write_queue=None):
+        self.db_path = db_path
+        self.ttl = ttl
+        # Claims and results go through the group commit writer of bank.db
+        self.writer = write_queue or writer
+        self._next_purge = 0
+        self.replayed = 0
+        self.conflicts = 0
+
+    @staticmethod
+    def init_table(cursor):
+        """Create the idempotency key table"""
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS idempotency_keys (
+                endpoint VARCHAR(50) NOT NULL,
+                key VARCHAR(255) NOT NULL,
+                request_hash VARCHAR(64) NOT NULL,
+                status VARCHAR(20) NOT NULL,
+                response_status INTEGER,
+                response_body TEXT,
+                created_at REAL NOT NULL,
+                expires_at REAL NOT NULL,
+                PRIMARY KEY (endpoint, key)
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_idempotency_keys_expires ON idempotency_keys (expires_at)")
+
+    @staticmethod
+    def request_hash(endpoint, body):
+        """Fingerprint of a request body; JSON is canonicalized so key order and spacing don't matter"""
+        try:
+            body = json.dumps(json.loads(body), sort_keys=True, separators=(',', ':')).encode()
+        except ValueError:
+            pass
+        return hashlib.sha256(endpoint.encode() + b'|' + body).hexdigest()
+
+    def lookup(self, endpoint, key):
+        """Stored row of an unexpired key, or None"""
+        conn = sql_trace.connect(self.db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        try:
+            row = conn.execute("""
+                SELECT request_hash, status, response_status, response_body FROM idempotency_keys
+                WHERE endpoint = ? AND key = ? AND expires_at > ?
+            """, (endpoint, key, time.time())).fetchone()
+            return dict(row) if row else None
+        finally:
+            conn.close()
+
+    def claim_mutation(self, endpoint, key, request_hash):
+        """fn(txn) claiming the key; returns the existing row if someone else holds it, else None"""
+        def apply_claim(txn):
+            cursor = txn.cursor
+            now = time.time()
+            if now >= self._next_purge:
+                self._next_purge = now + IDEMPOTENCY_PURGE_INTERVAL
+                cursor.execute("DELETE FROM idempotency_keys WHERE expires_at <= ?", (now,))
+            cursor.execute("""
+                SELECT request_hash, status, response_status, response_body FROM idempotency_keys
+                WHERE endpoint = ? AND key = ? AND expires_at > ?
+            """, (endpoint, key, now))
+            row = cursor.fetchone()
+            if row:
+                return dict(row)
+            cursor.execute("""
+                INSERT OR REPLACE INTO idempotency_keys (endpoint, key, request_hash, status, created_at, expires_at)
+                VALUES (?, ?, ?, 'IN_PROGRESS', ?, ?)
+            """, (endpoint, key, request_hash, now, now + self.ttl))
+            return None
+        return apply_claim
+
+    def complete_mutation(self, endpoint, key, status_code, body):
+        """fn(txn) storing the response of a claimed key"""
+        def apply_complete(txn):
+            txn.cursor.execute("""
+                UPDATE idempotency_keys SET status = 'DONE', response_status = ?, response_body = ?
+                WHERE endpoint = ? AND key = ?
+            """, (status_code, body, endpoint, key))
+        return apply_complete
+
+    def release_mutation(self, endpoint, key):
+        """fn(txn) dropping a claim whose request never ran, so a retry runs it"""
+        def apply_release(txn):
+            txn.cursor.execute("DELETE FROM idempotency_keys WHERE endpoint = ? AND key = ? AND status = 'IN_PROGRESS'",
+                               (endpoint, key))
+        return apply_release
+
+    def replay(self, row, request_hash):
+        """
+        Reply for a request whose key is already taken
+
+        Returns:
+            tuple: (status_code, body, headers)
+        """
+        if row['request_hash'] != request_hash:
+            self.conflicts += 1
+            REPLIES.inc('mismatch')
+            return 422, json.dumps({
+                'success': False,
+                'message': f'{IDEMPOTENCY_HEADER} was already used with a different request'
+            }), {}
+        if row['status'] != 'DONE':
+            self.conflicts += 1
+            REPLIES.inc('in_progress')
+            return 409, json.dumps({
+                'success': False,
+                'message': f'A request with this {IDEMPOTENCY_HEADER} is still being processed'
+            }), {'Retry-After': str(IN_PROGRESS_RETRY_AFTER)}
+        self.replayed += 1
+        REPLIES.inc('replayed')
+        return row['response_status'], row['response_body'], {'Idempotent-Replayed': 'true'}
+
+    def keyed(self, endpoint):
+        """Decorate a Flask view so requests carrying an Idempotency-Key run at most once"""
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                key = request.headers.get(IDEMPOTENCY_HEADER)
+                if not key:
+                    return view(*args, **kwargs)
+                if len(key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+                    return jsonify({'success': False,
+                                    'message': f'{IDEMPOTENCY_HEADER} must be at most {IDEMPOTENCY_KEY_MAX_LENGTH} characters'}), 400
+
+                request_hash = self.request_hash(endpoint, request.get_data())
+                # Replays of finished requests are answered from a read, without the writer
+                row = self.lookup(endpoint, key) or self.writer.execute(self.claim_mutation(endpoint, key, request_hash))
+                if row:
+                    status_code, body, headers = self.replay(row, request_hash)
+                    response = make_response(body, status_code)
+                    response.headers.update(headers)
+                    response.mimetype = 'application/json'
+                    return response
+
+                with WriteWatch() as writes:
+                    try:
+                        response = make_response(view(*args, **kwargs))
+                    except Exception:
+                        self.abandon(endpoint, key, writes)
+                        raise
+                if self.never_ran(response.status_code, writes):
+                    self.writer.execute(self.release_mutation(endpoint, key))
+                else:
+                    self.writer.execute(self.complete_mutation(endpoint, key, response.status_code,
+                                                               response.get_data(as_text=True)))
+                return response
+            return wrapper
+        return decorator
+
+    @staticmethod
+    def never_ran(status_code, writes):
+        """True if a finished request provably moved no money: shed (429), or a server error none of whose writes committed"""
+        return status_code == 429 or (status_code >= 500 and writes.nothing_committed())
+
+    def abandon(self, endpoint, key, writes):
+        """
+        Settle the key of a request that ended without a response
+
+        Released for a retry only if none of the request's writes (a WriteWatch)
+        can have committed; otherwise it stays IN_PROGRESS until it expires.
+        """
+        if writes.nothing_committed():
+            self.writer.submit(self.release_mutation(endpoint, key))
+            return True
+        print(f"⚠️ {IDEMPOTENCY_HEADER} {key!r} on {endpoint} kept claimed: its request may have moved money")
+        return False
+
+    def stats(self):
+        return {'replayed': self.replayed, 'conflicts': self.conflicts}
+
+
+# Global instance
+idempotency = IdempotencyStore()
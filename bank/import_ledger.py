@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+"""
+Bulk Ledger Import for Banking System
+Replays deposits, withdrawals and fund transfers from a CSV or NDJSON file
+
+Each row has an `operation` (deposit, withdraw or transfer), `username`, `amount`
+and, for transfers, `to_account`; `donor_id`, `cause` and `timedate` are optional.
+Rows are checked like Bank.deposit/withdraw/fundtransfer would check them and
+applied in large transactions, one commit per batch. Nothing is recorded on the
+blockchain - this is for seeding and migrating history.
+
+Stop the app before importing, as for a restore: balances are written straight
+into customers, so the app's account cache (account_cache.py) would keep serving
+the old ones for up to BANK_ACCOUNT_CACHE_TTL seconds, and every batch holds the
+write lock while it runs. With BANK_SHARDS > 1 every shard file is imported into
+(see sharding.py); each batch locks all shards and commits them one after the other.
+
+Usage:
+    python import_ledger.py operations.csv
+    python import_ledger.py operations.ndjson --batch-size 100000 --rejects rejected.csv
+"""
+
+import argparse
+import csv
+import json
+import os
+import sqlite3
+import time
+
+import ledger
+
+# Configuration
+DB_PATH = os.path.join(os.path.dirname(__file__), 'bank.db')
+IMPORT_BATCH_SIZE = 50000  # rows per transaction
+
+OPERATIONS = ('deposit', 'withdraw', 'transfer')
+
+
+def read_operations(path, fmt='auto'):
+    """Yield (line_number, row dict) from a CSV (with header) or NDJSON file"""
+    if fmt == 'auto':
+        fmt = 'ndjson' if path.endswith(('.ndjson', '.jsonl', '.json')) else 'csv'
+
+    with open(path, newline='', encoding='utf-8') as source:
+        if fmt == 'csv':
+            for line_number, row in enumerate(csv.DictReader(source), start=2):
+                yield line_number, row
+        else:
+            for line_number, line in enumerate(source, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    row = json.loads(line)
+                except json.JSONDecodeError as e:
+                    row = {'_error': f'Invalid JSON: {e}'}
+                yield line_number, row if isinstance(row, dict) else {'_error': 'Not a JSON object'}
+
+
+def parse_operation(row):
+    """Check the shape of one row; returns (operation dict, None) or (None, reason)"""
+    if '_error' in row:
+        return None, row['_error']
+
+    operation = str(row.get('operation') or '').strip().lower()
+    if operation not in OPERATIONS:
+        return None, f"Unknown operation '{row.get('operation')}'"
+
+    username = str(row.get('username') or '').strip()
+    if not username:
+        return None, 'Username is required'
+
+    try:
+        amount = int(row.get('amount'))
+    except (TypeError, ValueError):
+        return None, 'Amount must be a whole number'
+    if amount <= 0:
+        return None, 'Amount must be positive'
+
+    to_account = None
+    if operation == 'transfer':
+        to_account = str(row.get('to_account') or '').strip()
+        if not to_account.isdigit():
+            return None, 'to_account must be an account number'
+        to_account = int(to_account)
+
+    return {
+        'operation': operation,
+        'username': username,
+        'amount': amount,
+        'to_account': to_account,
+        'donor_id': row.get('donor_id') or None,
+        'cause': row.get('cause') or None,
+        'timedate': row.get('timedate') or None
+    }, None
+
+
+class LedgerImporter:
+    def __init__(self, db_path=DB_PATH, batch_size=IMPORT_BATCH_SIZE, dry_run=False, db_paths=None):
+        self.db_path = db_path
+        self.db_paths = db_paths or [db_path]  # every database holding accounts (the shard files when sharded)
+        self.batch_size = batch_size
+        self.dry_run = dry_run
+        self.applied = 0
+        self.rejected = []  # (line_number, reason, row)
+
+    def _connect(self, db_path):
+        conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        # Still crash safe in WAL mode; only the last commits may be lost on power failure
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _apply_batch(self, cursors, batch):
+        """Validate and apply one batch of parsed operations inside the current transaction of every database"""
+        accounts = {}
+        receivers = {}
+        ledger_tables = {}
+        home = {}  # username -> cursor of the database holding the account
+        for cursor in cursors:
+            found = ledger.fetch_accounts(cursor, 'username', [op['username'] for _, op in batch])
+            accounts.update(found)
+            home.update(dict.fromkeys(found, cursor))
+            found = ledger.fetch_accounts(cursor, 'account_number',
+                                          [op['to_account'] for _, op in batch if op['to_account'] is not None])
+            receivers.update(found)
+            home.update({row['username']: cursor for row in found.values()})
+
+            cursor.execute("SELECT name, type FROM sqlite_master WHERE type IN ('table', 'view') AND name LIKE '%_transaction'")
+            ledger_tables.update({row['name']: row['type'] for row in cursor.fetchall()})
+
+        # Running balances so each row is checked against the rows before it
+        balances = {username: row['balance'] for username, row in accounts.items()}
+        balances.update({row['username']: row['balance'] for row in receivers.values()})
+        account_numbers = {username: row['account_number'] for username, row in accounts.items()}
+        touched = set()
+        entries = []
+
+        for line_number, op in batch:
+            username = op['username']
+            amount = op['amount']
+            if username not in accounts:
+                self.rejected.append((line_number, 'User not found', op))
+                continue
+            if f"{username}_transaction" not in ledger_tables:
+                self.rejected.append((line_number, 'User has no transaction table', op))
+                continue
+
+            account_number = account_numbers[username]
+            timedate = op['timedate']
+
+            if op['operation'] == 'deposit':
+                balances[username] += amount
+                touched.add(username)
+                entries.append(ledger.new_entry(username, account_number, 'Amount Deposit', amount,
+                                                op['donor_id'], op['cause'], timedate))
+
+            elif op['operation'] == 'withdraw':
+                if amount > balances[username]:
+                    self.rejected.append((line_number, 'Insufficient balance', op))
+                    continue
+                balances[username] -= amount
+                touched.add(username)
+                entries.append(ledger.new_entry(username, account_number, 'Amount Withdraw', amount,
+                                                op['donor_id'], op['cause'], timedate))
+
+            else:
+                receiver = receivers.get(op['to_account'])
+                if receiver is None:
+                    self.rejected.append((line_number, 'Receiver account not found', op))
+                    continue
+                receiver_username = receiver['username']
+                if receiver_username == username:
+                    self.rejected.append((line_number, 'Cannot transfer to your own account', op))
+                    continue
+                if f"{receiver_username}_transaction" not in ledger_tables:
+                    self.rejected.append((line_number, 'Receiver has no transaction table', op))
+                    continue
+                if amount > balances[username]:
+                    self.rejected.append((line_number, 'Insufficient balance', op))
+                    continue
+
+                balances[username] -= amount
+                balances[receiver_username] += amount
+                touched.update((username, receiver_username))
+                # Same records as Bank.fundtransfer: the sender's account is the receiver's donor_id
+                entries.append(ledger.new_entry(receiver_username, account_number,
+                                                f'Fund Transfer From {account_number}', amount,
+                                                account_number, op['cause'], timedate))
+                entries.append(ledger.new_entry(username, account_number,
+                                                f"Fund Transfer -> {op['to_account']}", amount,
+                                                op['donor_id'], op['cause'], timedate))
+
+            self.applied += 1
+
+        for cursor in cursors:
+            database_entries = [entry for entry in entries if home[entry['username']] is cursor]
+            # Ledgers still in the old plain-table layout are re-encoded before we write to them
+            for username in {entry['username'] for entry in database_entries}:
+                if ledger_tables.get(f"{username}_transaction") == 'table':
+                    ledger.encode_ledger(cursor, username)
+            ledger.insert_entries(cursor, database_entries)
+            cursor.executemany("UPDATE customers SET balance = ? WHERE username = ?",
+                               [(balances[username], username) for username in touched if home[username] is cursor])
+
+    def _flush(self, conns, batch):
+        cursors = [conn.cursor() for conn in conns]
+        try:
+            # Hold the write locks so balances read for validation cannot change underneath us
+            for cursor in cursors:
+                cursor.execute("BEGIN IMMEDIATE")
+            self._apply_batch(cursors, batch)
+        except Exception:
+            for conn in conns:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+            raise
+        for cursor in cursors:
+            cursor.execute("ROLLBACK" if self.dry_run else "COMMIT")
+
+    def run(self, path, fmt='auto', progress=True):
+        """
+        Import every operation in `path`
+
+        Returns:
+            dict: Rows read, applied and rejected, seconds taken and rows per second
+        """
+        started = time.perf_counter()
+        rows_read = 0
+        batch = []
+
+        conns = [self._connect(db_path) for db_path in self.db_paths]
+        try:
+            for line_number, row in read_operations(path, fmt):
+                rows_read += 1
+                op, reason = parse_operation(row)
+                if op is None:
+                    self.rejected.append((line_number, reason, row))
+                    continue
+
+                batch.append((line_number, op))
+                if len(batch) >= self.batch_size:
+                    self._flush(conns, batch)
+                    batch = []
+                    if progress:
+                        elapsed = time.perf_counter() - started
+                        print(f"⏳ {rows_read} rows read, {self.applied} applied, {len(self.rejected)} rejected "
+                              f"({rows_read / elapsed:,.0f} rows/s)")
+
+            if batch:
+                self._flush(conns, batch)
+        finally:
+            for conn in conns:
+                conn.close()
+
+        seconds = time.perf_counter() - started
+        return {
+            'rows': rows_read,
+            'applied': self.applied,
+            'rejected': len(self.rejected),
+            'seconds': round(seconds, 3),
+            'rows_per_second': round(rows_read / seconds) if seconds else rows_read,
+            'dry_run': self.dry_run
+        }
+
+    def write_rejects(self, path):
+        """Write rejected rows with their line number and reason as CSV"""
+        with open(path, 'w', newline='', encoding='utf-8') as target:
+            csv_writer = csv.writer(target)
+            csv_writer.writerow(['line', 'reason', 'row'])
+            for line_number, reason, row in self.rejected:
+                csv_writer.writerow([line_number, reason, json.dumps(row, default=str)])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Bulk import deposits, withdrawals and transfers into the ledger '
+                                                 '(stop the app first)')
+    parser.add_argument('input', help='CSV (with header) or NDJSON file of operations')
+    parser.add_argument('--format', default='auto', choices=['auto', 'csv', 'ndjson'])
+    parser.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE, help='Rows per transaction')
+    parser.add_argument('--rejects', help='Write rejected rows to this CSV file')
+    parser.add_argument('--dry-run', action='store_true', help='Validate everything, commit nothing')
+    args = parser.parse_args()
+
+    from sharding import shards  # every shard file when BANK_SHARDS > 1
+    importer = LedgerImporter(batch_size=args.batch_size, dry_run=args.dry_run, db_paths=shards.paths())
+    result = importer.run(args.input, args.format)
+
+    print(f"{'🔍 Validated' if args.dry_run else '✅ Imported'} {result['applied']} of {result['rows']} rows "
+          f"in {result['seconds']}s ({result['rows_per_second']:,} rows/s)")
+    if result['rejected']:
+        print(f"⚠️ {result['rejected']} rows rejected")
+        for line_number, reason, _ in importer.rejected[:10]:
+            print(f"   line {line_number}: {reason}")
+        if args.rejects:
+            importer.write_rejects(args.rejects)
+            print(f"   all rejected rows written to {args.rejects}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,574 @@
+#!/usr/bin/env python3
+"""
+Ledger Helpers for Banking System
+Set-based account lookups and ledger inserts shared by the batch endpoints
+"""
+
+import sqlite3
+from datetime import datetime
+
+from account_cache import account_cache
+from group_commit import MutationRejected
+
+# SQLite builds before 3.32 allow at most 999 bound parameters per statement
+MAX_SQL_VARIABLES = 900
+# UPDATE ... RETURNING needs SQLite 3.35+
+HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+
+def chunked(items, size=MAX_SQL_VARIABLES):
+    """Yield successive slices of at most `size` items"""
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def fetch_accounts(cursor, column, values, fields="username, account_number, balance"):
+    """
+    Look up many customers with one indexed IN query per chunk
+
+    Args:
+        cursor: Database cursor
+        column (str): 'username' or 'account_number'
+        values (iterable): Keys to look up (duplicates are ignored)
+        fields (str): Columns to select; must include `column`
+
+    Returns:
+        dict: key -> row for every key that exists
+    """
+    if column not in ('username', 'account_number'):
+        raise ValueError(f"Cannot look up customers by {column}")
+
+    accounts = {}
+    for chunk in chunked(set(values)):
+        placeholders = ", ".join("?" for _ in chunk)
+        cursor.execute(f"SELECT {fields} FROM customers WHERE {column} IN ({placeholders})", chunk)
+        for row in cursor.fetchall():
+            accounts[row[column]] = row
+    return accounts
+
+
+def new_entry(username, account_number, transaction_type, amount, donor_id=None, cause=None, timedate=None):
+    """Build a ledger entry for insert_entries"""
+    return {
+        'username': username,
+        'timedate': timedate or str(datetime.now()),
+        'account_number': account_number,
+        'transaction_type': transaction_type,
+        'amount': amount,
+        'donor_id': str(donor_id) if donor_id else None,
+        'cause': cause
+    }
+
+
+def split_descriptor(transaction_type):
+    """
+    Split a transaction type into its interned descriptor and counterparty account
+
+    'Fund Transfer -> 12345678' -> ('Fund Transfer -> ', 12345678),
+    'Amount Deposit' -> ('Amount Deposit', None). Mirrors _descriptor_sql.
+    """
+    if transaction_type is None:
+        return None, None
+    transaction_type = str(transaction_type)
+    descriptor = transaction_type.rstrip('0123456789')
+    digits = transaction_type[len(descriptor):]
+    # Leading zeros or huge numbers would not survive the round trip through an integer
+    if not digits or digits[0] == '0' or len(digits) > 18:
+        return transaction_type, None
+    return descriptor, int(digits)
+
+
+def insert_entries(cursor, entries):
+    """
+    Insert ledger entries with one executemany per user ledger table
+
+    Descriptors and causes are interned first; entries keep their relative
+    order within each table.
+    """
+    by_user = {}
+    descriptors = set()
+    causes = set()
+    for entry in entries:
+        descriptor, counterparty = split_descriptor(entry['transaction_type'])
+        if descriptor is not None:
+            descriptors.add(descriptor)
+        if entry['cause'] is not None:
+            causes.add(entry['cause'])
+        by_user.setdefault(entry['username'], []).append((
+            entry['timedate'],
+            entry['account_number'],
+            descriptor,
+            counterparty,
+            entry['amount'],
+            entry['donor_id'],
+            entry['cause']
+        ))
+
+    cursor.executemany("INSERT OR IGNORE INTO ledger_descriptors (name) VALUES (?)", [(name,) for name in descriptors])
+    cursor.executemany("INSERT OR IGNORE INTO ledger_causes (name) VALUES (?)", [(name,) for name in causes])
+    for username, rows in by_user.items():
+        cursor.executemany(f"""
+            INSERT INTO {username}_ledger
+                (timedate, account_number, descriptor_id, counterparty, amount, donor_id, cause_id)
+            VALUES (?, ?, (SELECT id FROM ledger_descriptors WHERE name = ?), ?, ?, ?,
+                    (SELECT id FROM ledger_causes WHERE name = ?))
+        """, rows)
+
+
+def transaction_direction(transaction_type):
+    """'credit' or 'debit' as shown in passbooks"""
+    if 'Deposit' in transaction_type or 'From' in transaction_type or 'Received' in transaction_type:
+        return 'credit'
+    return 'debit'
+
+
+def is_donation(transaction_type, donor_id):
+    """
+    True for a deposit or donation received that names its donor
+
+    Transfer receipts ('Fund Transfer From <account>') are credits but not
+    donations: the sender's account is only their donor_id.
+    """
+    if donor_id in (None, '', 'None'):  # the CLI writes a missing donor as 'None'
+        return False
+    return 'Deposit' in (transaction_type or '') or 'Received' in (transaction_type or '')
+
+
+def passbook_filters(start_date=None, end_date=None, transaction_type=None,
+                     cause=None, min_amount=None, max_amount=None, donor_id=None):
+    """
+    Build the WHERE clause shared by passbook pages, counts and exports
+
+    The clause is written against the {username}_ledger columns (see passbook_select)
+    so each filter can use one of create_ledger's indexes.
+
+    Returns:
+        tuple: (where_sql, params) where where_sql starts with "1=1"
+
+    Raises:
+        ValueError: If min_amount or max_amount is not a whole number
+    """
+    where_sql = "1=1"
+    params = []
+
+    # Add date filters if provided
+    if start_date:
+        where_sql += " AND timedate >= ?"
+        params.append(start_date)
+
+    if end_date:
+        where_sql += " AND timedate <= ?"
+        params.append(end_date)
+
+    # Add transaction type filter if provided; descriptors are few, so this is an id lookup
+    if transaction_type:
+        pattern = {'deposit': '%Deposit%', 'withdraw': '%Withdraw%', 'transfer': '%Transfer%'}.get(
+            transaction_type.lower())
+        if pattern:
+            where_sql += " AND descriptor_id IN (SELECT id FROM ledger_descriptors WHERE name LIKE ?)"
+            params.append(pattern)
+
+    # Cause names are interned, so this is an integer comparison on cause_id
+    if cause:
+        where_sql += " AND cause_id = (SELECT id FROM ledger_causes WHERE name = ?)"
+        params.append(cause)
+
+    for name, value, operator in (('min_amount', min_amount, '>='), ('max_amount', max_amount, '<=')):
+        if value is None or value == '':
+            continue
+        try:
+            amount = int(value)
+        except (TypeError, ValueError):
+            raise ValueError(f"{name} must be a whole number")
+        where_sql += f" AND amount {operator} ?"
+        params.append(amount)
+
+    if donor_id:
+        where_sql += " AND donor_id = ?"
+        params.append(str(donor_id))
+
+    return where_sql, params
+
+
+def passbook_select(username, source=None):
+    """
+    SELECT ... FROM {username}_ledger with the columns of the {username}_transaction view
+
+    `source` replaces the ledger table, e.g. with an attached archive's copy (see
+    ledger_archive.ArchivedLedger).
+    """
+    transaction_type, cause = _decoded_sql(f"{username}_ledger")
+    source = f"{source} AS {username}_ledger" if source and source != f"{username}_ledger" else f"{username}_ledger"
+    return (f"SELECT timedate, account_number, {transaction_type} AS transaction_type, amount, donor_id, "
+            f"{cause} AS cause FROM {source}")
+
+
+def _descriptor_sql(value):
+    """SQL for split_descriptor(value): (descriptor, counterparty) expressions"""
+    digits = f"substr({value}, length(rtrim({value}, '0123456789')) + 1)"
+    whole = f"({digits} = '' OR substr({digits}, 1, 1) = '0' OR length({digits}) > 18)"
+    return (f"(CASE WHEN {whole} THEN {value} ELSE rtrim({value}, '0123456789') END)",
+            f"(CASE WHEN {whole} THEN NULL ELSE CAST({digits} AS INTEGER) END)")
+
+
+def _decoded_sql(row):
+    """SQL for the transaction_type and cause of an encoded ledger row"""
+    return (f"(SELECT name FROM ledger_descriptors WHERE id = {row}.descriptor_id) || COALESCE({row}.counterparty, '')",
+            f"(SELECT name FROM ledger_causes WHERE id = {row}.cause_id)")
+
+
+def _ledger_object(cursor, name):
+    """'table', 'view' or None for a schema object"""
+    cursor.execute("SELECT type FROM sqlite_master WHERE name = ? AND type IN ('table', 'view')", (name,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def create_ledger(cursor, username):
+    """
+    Create (or complete) a user's ledger
+
+    Rows live in {username}_ledger with the transaction descriptor and cause as
+    ids into the shared ledger_descriptors/ledger_causes tables and the
+    counterparty account as its own integer column. {username}_transaction is a
+    view with the original columns, so existing reads and the CLI's INSERTs keep
+    working unchanged.
+    """
+    cursor.execute("CREATE TABLE IF NOT EXISTS ledger_descriptors (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)")
+    cursor.execute("CREATE TABLE IF NOT EXISTS ledger_causes (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)")
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {username}_ledger (
+            timedate VARCHAR(30),
+            account_number INTEGER,
+            descriptor_id INTEGER,
+            counterparty INTEGER,
+            amount INTEGER,
+            donor_id VARCHAR(64),
+            cause_id INTEGER
+        )
+    """)
+    # Latest-first reads and last-transaction lookups use this index; carrying amount lets a
+    # one-sided amount filter be checked without visiting the table for every row
+    cursor.execute(f"DROP INDEX IF EXISTS idx_{username}_ledger_timedate")
+    cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{username}_ledger_timedate_amount ON {username}_ledger (timedate, amount)")
+    # Passbook filters: cause (newest first, amount checked in the index), amount range, donor
+    cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{username}_ledger_cause ON {username}_ledger (cause_id, timedate, amount)")
+    cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{username}_ledger_amount ON {username}_ledger (amount)")
+    cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{username}_ledger_donor ON {username}_ledger (donor_id, timedate)")
+
+    # A single-table view, so the planner still uses the ledger's indexes through it
+    transaction_type, cause = _decoded_sql(f"{username}_ledger")
+    cursor.execute(f"""
+        CREATE VIEW IF NOT EXISTS {username}_transaction AS
+        SELECT timedate, account_number, {transaction_type} AS transaction_type,
+               amount, donor_id, {cause} AS cause
+        FROM {username}_ledger
+    """)
+    descriptor, counterparty = _descriptor_sql("NEW.transaction_type")
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {username}_transaction_insert
+        INSTEAD OF INSERT ON {username}_transaction
+        BEGIN
+            INSERT OR IGNORE INTO ledger_descriptors (name) SELECT {descriptor} WHERE NEW.transaction_type IS NOT NULL;
+            INSERT OR IGNORE INTO ledger_causes (name) SELECT NEW.cause WHERE NEW.cause IS NOT NULL;
+            INSERT INTO {username}_ledger
+                (timedate, account_number, descriptor_id, counterparty, amount, donor_id, cause_id)
+            VALUES (NEW.timedate, NEW.account_number,
+                    (SELECT id FROM ledger_descriptors WHERE name = {descriptor}), {counterparty},
+                    NEW.amount, NEW.donor_id,
+                    (SELECT id FROM ledger_causes WHERE name = NEW.cause));
+        END
+    """)
+
+    install_version_triggers(cursor, username)
+    install_donor_index(cursor, username)
+
+
+def encode_ledger(cursor, username):
+    """
+    Re-encode a pre-existing {username}_transaction table into create_ledger's layout
+
+    Rows are copied in their original order. Returns True if a table was converted,
+    False if the ledger is already encoded or does not exist.
+    """
+    if _ledger_object(cursor, f"{username}_transaction") != 'table':
+        return False
+
+    cursor.execute("CREATE TABLE IF NOT EXISTS ledger_descriptors (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)")
+    cursor.execute("CREATE TABLE IF NOT EXISTS ledger_causes (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)")
+    descriptor, counterparty = _descriptor_sql("t.transaction_type")
+    cursor.execute(f"""
+        INSERT OR IGNORE INTO ledger_descriptors (name)
+        SELECT DISTINCT {descriptor} FROM {username}_transaction AS t WHERE t.transaction_type IS NOT NULL
+    """)
+    cursor.execute(f"""
+        INSERT OR IGNORE INTO ledger_causes (name)
+        SELECT DISTINCT cause FROM {username}_transaction WHERE cause IS NOT NULL
+    """)
+
+    # Move the old table aside; the view takes its name and the old indexes and triggers go with it
+    cursor.execute(f"ALTER TABLE {username}_transaction RENAME TO {username}_transaction_legacy")
+    # Entry rowids change, so the user's donor index rows are rebuilt by the new triggers
+    drop_donor_entries(cursor, username)
+    create_ledger(cursor, username)
+    cursor.execute(f"""
+        INSERT INTO {username}_ledger
+            (timedate, account_number, descriptor_id, counterparty, amount, donor_id, cause_id)
+        SELECT t.timedate, t.account_number,
+               (SELECT id FROM ledger_descriptors WHERE name = {descriptor}), {counterparty},
+               t.amount, t.donor_id,
+               (SELECT id FROM ledger_causes WHERE name = t.cause)
+        FROM {username}_transaction_legacy AS t
+        ORDER BY t.rowid
+    """)
+    cursor.execute(f"DROP TABLE {username}_transaction_legacy")
+    return True
+
+
+def drop_ledger(cursor, username):
+    """Drop a user's ledger in either layout; returns True if there was one"""
+    dropped = False
+    kind = _ledger_object(cursor, f"{username}_transaction")
+    if kind == 'view':
+        cursor.execute(f"DROP VIEW {username}_transaction")
+        dropped = True
+    elif kind == 'table':
+        cursor.execute(f"DROP TABLE {username}_transaction")
+        dropped = True
+    if _ledger_object(cursor, f"{username}_ledger") == 'table':
+        cursor.execute(f"DROP TABLE {username}_ledger")
+        dropped = True
+    return dropped
+
+
+def install_version_triggers(cursor, username):
+    """
+    Keep ledger_versions[username] bumped on every change to the user's ledger
+
+    Triggers also catch writes made outside the API (CLI tools, imports), so a
+    cached read can never outlive the rows it was built from.
+    """
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS ledger_versions (
+            username TEXT PRIMARY KEY,
+            version INTEGER NOT NULL
+        )
+    """)
+    literal = username.replace("'", "''")
+    for event in ('INSERT', 'UPDATE', 'DELETE'):
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {username}_ledger_{event.lower()}_version
+            AFTER {event} ON {username}_ledger
+            BEGIN
+                INSERT INTO ledger_versions (username, version) VALUES ('{literal}', 1)
+                ON CONFLICT(username) DO UPDATE SET version = version + 1;
+            END
+        """)
+
+
+def bump_version(cursor, username):
+    """Bump a ledger version by hand, e.g. when the whole table is dropped (DROP fires no triggers)"""
+    cursor.execute("""
+        INSERT INTO ledger_versions (username, version) VALUES (?, 1)
+        ON CONFLICT(username) DO UPDATE SET version = version + 1
+    """, (username,))
+
+
+def get_version(cursor, username):
+    """Current ledger version of an account (0 if it never had a transaction)"""
+    cursor.execute("SELECT version FROM ledger_versions WHERE username = ?", (username,))
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+
+def install_donor_index(cursor, username):
+    """
+    Mirror the user's donations into the global donor_index table
+
+    donor_index holds one row per donation (see is_donation), keyed by
+    (username, entry_rowid), so everything a donor gave is one indexed lookup.
+    Triggers keep it in step with the ledger; rows already in the ledger are
+    copied over the first time the triggers are installed. Rows ledger_archive
+    moves out of the ledger stay indexed under negative entry_rowids, so
+    reused rowids never collide with them.
+    """
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS donor_index (
+            donor_id VARCHAR(64) NOT NULL,
+            username TEXT NOT NULL,
+            entry_rowid INTEGER NOT NULL,
+            timedate VARCHAR(30),
+            account_number INTEGER,
+            transaction_type VARCHAR(30),
+            amount INTEGER,
+            cause VARCHAR(50),
+            PRIMARY KEY (username, entry_rowid)
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_donor_index_donor ON donor_index (donor_id, timedate)")
+    # ledger_archive lists an account here while it deletes archived rows (inside its transaction)
+    cursor.execute("CREATE TABLE IF NOT EXISTS ledger_archiving (username TEXT PRIMARY KEY)")
+
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = ?",
+                   (f"{username}_ledger_index_donation",))
+    installed = cursor.fetchone() is not None
+    if not installed:
+        # The earlier triggers also indexed transfer receipts ('Fund Transfer From ...')
+        cursor.execute(f"DROP TRIGGER IF EXISTS {username}_ledger_insert_donor")
+        cursor.execute(f"DROP TRIGGER IF EXISTS {username}_ledger_update_donor")
+        cursor.execute("""
+            DELETE FROM donor_index
+            WHERE username = ? AND NOT (transaction_type LIKE '%Deposit%' OR transaction_type LIKE '%Received%')
+        """, (username,))
+
+    literal = username.replace("'", "''")
+
+    def donation(row):
+        # Same rule as is_donation(); the CLI writes a missing donor as 'None'
+        descriptor = f"(SELECT name FROM ledger_descriptors WHERE id = {row}.descriptor_id)"
+        return (f"{row}.donor_id IS NOT NULL AND {row}.donor_id NOT IN ('', 'None') AND "
+                f"({descriptor} LIKE '%Deposit%' OR {descriptor} LIKE '%Received%')")
+
+    def insert(row):
+        transaction_type, cause = _decoded_sql(row)
+        return f"""
+            INSERT OR REPLACE INTO donor_index
+                (donor_id, username, entry_rowid, timedate, account_number, transaction_type, amount, cause)
+            SELECT {row}.donor_id, '{literal}', {row}.rowid, {row}.timedate, {row}.account_number,
+                   {transaction_type}, {row}.amount, {cause}
+            WHERE {donation(row)};
+        """
+
+    delete = f"DELETE FROM donor_index WHERE username = '{literal}' AND entry_rowid = OLD.rowid;"
+    keep_archived = f"""
+        UPDATE donor_index
+        SET entry_rowid = (SELECT MIN(MIN(entry_rowid), 0) - 1 FROM donor_index WHERE username = '{literal}')
+        WHERE username = '{literal}' AND entry_rowid = OLD.rowid
+          AND EXISTS (SELECT 1 FROM ledger_archiving WHERE username = '{literal}');
+    """
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {username}_ledger_index_donation
+        AFTER INSERT ON {username}_ledger
+        BEGIN {insert('NEW')} END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {username}_ledger_reindex_donation
+        AFTER UPDATE ON {username}_ledger
+        BEGIN {delete} {insert('NEW')} END
+    """)
+    # Replaced by _unindex_donor, which keeps the entries of archived rows
+    cursor.execute(f"DROP TRIGGER IF EXISTS {username}_ledger_delete_donor")
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {username}_ledger_unindex_donor
+        AFTER DELETE ON {username}_ledger
+        BEGIN {keep_archived} {delete} END
+    """)
+
+    if not installed:
+        transaction_type, cause = _decoded_sql('t')
+        cursor.execute(f"""
+            INSERT OR REPLACE INTO donor_index
+                (donor_id, username, entry_rowid, timedate, account_number, transaction_type, amount, cause)
+            SELECT t.donor_id, ?, t.rowid, t.timedate, t.account_number, {transaction_type}, t.amount, {cause}
+            FROM {username}_ledger AS t WHERE {donation('t')}
+        """, (username,))
+
+
+def drop_donor_entries(cursor, username):
+    """Remove a user's rows from donor_index (DROP TABLE fires no triggers)"""
+    try:
+        cursor.execute("DELETE FROM donor_index WHERE username = ?", (username,))
+    except sqlite3.OperationalError:
+        pass  # No donor index yet, so nothing to remove
+
+
+def load_account(cursor, username=None, account_number=None, cache=True):
+    """Read an account from SQLite and cache it (unless read from a stale replica); None if it does not exist"""
+    seq = account_cache.snapshot()
+    if username is not None:
+        cursor.execute("SELECT username, name, account_number, balance FROM customers WHERE username = ?", (username,))
+    else:
+        cursor.execute("SELECT username, name, account_number, balance FROM customers WHERE account_number = ?",
+                       (account_number,))
+    row = cursor.fetchone()
+    if not row:
+        return None
+
+    account = {key: row[key] for key in ('username', 'name', 'account_number', 'balance')}
+    if cache:
+        account_cache.put(account, seq)
+    return account
+
+
+def resolve_account(cursor, username=None, account_number=None, cache=True):
+    """
+    Find an account by username or account number, from the cache when possible
+
+    The balance in the result is only a read model; money movements go through
+    credit/debit, which update SQLite relative to its current value.
+    """
+    return (account_cache.get(username=username, account_number=account_number)
+            or load_account(cursor, username=username, account_number=account_number, cache=cache))
+
+
+def _single(cursor):
+    """Fetch the only row of a RETURNING statement, running it to completion"""
+    rows = cursor.fetchall()
+    return rows[0] if rows else None
+
+
+def _committed_balances(txn, balances):
+    """Update cached balances once the group commit succeeds"""
+    txn.after_commit(lambda: account_cache.update_balances(balances))
+
+
+def credit(txn, username, amount):
+    """Add to a balance; returns the new balance"""
+    cursor = txn.cursor
+    if HAS_RETURNING:
+        cursor.execute("UPDATE customers SET balance = balance + ? WHERE username = ? RETURNING balance",
+                       (amount, username))
+        row = _single(cursor)
+    else:
+        cursor.execute("UPDATE customers SET balance = balance + ? WHERE username = ?", (amount, username))
+        row = None
+        if cursor.rowcount:
+            cursor.execute("SELECT balance FROM customers WHERE username = ?", (username,))
+            row = cursor.fetchone()
+    if not row:
+        raise MutationRejected('User not found', 404)
+
+    _committed_balances(txn, {username: row['balance']})
+    return row['balance']
+
+
+def debit(txn, username, amount):
+    """Take from a balance if it covers the amount; returns the new balance"""
+    cursor = txn.cursor
+    if HAS_RETURNING:
+        cursor.execute("""
+            UPDATE customers SET balance = balance - ?
+            WHERE username = ? AND balance >= ?
+            RETURNING balance
+        """, (amount, username, amount))
+        row = _single(cursor)
+    else:
+        cursor.execute("UPDATE customers SET balance = balance - ? WHERE username = ? AND balance >= ?",
+                       (amount, username, amount))
+        row = None
+        if cursor.rowcount:
+            cursor.execute("SELECT balance FROM customers WHERE username = ?", (username,))
+            row = cursor.fetchone()
+    if not row:
+        raise MutationRejected('Insufficient balance')
+
+    _committed_balances(txn, {username: row['balance']})
+    return row['balance']
+
+
+def apply_balances(txn, balances):
+    """Write final balances (username -> balance) in one executemany"""
+    txn.cursor.executemany("UPDATE customers SET balance = ? WHERE username = ?",
+                           [(balance, username) for username, balance in balances.items()])
+    _committed_balances(txn, dict(balances))
@@ -0,0 +1,459 @@
+#!/usr/bin/env python3
+"""
+Ledger Archiving for Banking System
+Moves old ledger rows out of bank.db into per-period archive databases
+
+Rows older than a cutoff are copied into archive/ledger_<period>.db (one file per
+year or month, shared by all accounts) and then deleted from the hot ledger, so
+bank.db only holds recent history. The ledger_archives catalog in bank.db records
+which periods each account has archived; reads open an archive only when the
+requested date range reaches it, each on a connection of its own (SQLite allows
+ten attached databases per connection, and a history can span more periods).
+
+Every archiving batch gets a run number. Archive rows carry the run that wrote
+them and the catalog records the last run committed in bank.db, so a reader never
+sees a row both in an archive and in the hot ledger, and rows left behind by an
+interrupted run are discarded the next time.
+
+Usage:
+    python ledger_archive.py                          # archive rows older than 365 days
+    python ledger_archive.py --older-than-days 90 --period month --vacuum
+    python ledger_archive.py --list
+"""
+
+import argparse
+import heapq
+import itertools
+import os
+import re
+import sqlite3
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import ledger
+from sql_trace import sql_trace
+
+# Configuration
+DB_PATH = os.path.join(os.path.dirname(__file__), 'bank.db')
+ARCHIVE_DIR = os.environ.get('BANK_ARCHIVE_DIR', os.path.join(os.path.dirname(__file__), 'archive'))
+ARCHIVE_AFTER_DAYS = int(os.environ.get('BANK_ARCHIVE_AFTER_DAYS', '365'))  # rows older than this leave bank.db
+# 'year' or 'month' per archive file; a read opens one connection per period it reaches
+ARCHIVE_PERIOD = os.environ.get('BANK_ARCHIVE_PERIOD', 'year')
+ARCHIVE_BATCH_ROWS = 50000  # rows moved per transaction
+
+# Length of the timedate prefix that names a period
+PERIOD_LENGTHS = {'year': 4, 'month': 7}
+
+LEDGER_COLUMNS = "timedate, account_number, descriptor_id, counterparty, amount, donor_id, cause_id"
+
+
+def init_catalog(cursor):
+    """Create the catalog of archived periods in the hot database"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS ledger_archives (
+            username TEXT NOT NULL,
+            period TEXT NOT NULL,
+            rows INTEGER NOT NULL,
+            first_timedate VARCHAR(30),
+            last_timedate VARCHAR(30),
+            run INTEGER NOT NULL,
+            PRIMARY KEY (username, period)
+        )
+    """)
+
+
+def archive_path(period):
+    return os.path.join(ARCHIVE_DIR, f"ledger_{period}.db")
+
+
+def _schema_name(period):
+    return "archive_" + re.sub(r'\W', '_', period)
+
+
+def _attach(conn, period):
+    """ATTACH a period's archive (once per connection); returns its schema name"""
+    schema = _schema_name(period)
+    attached = {row[1] for row in conn.execute("PRAGMA database_list")}
+    if schema not in attached:
+        conn.execute("ATTACH DATABASE ? AS " + schema, (archive_path(period),))
+    return schema
+
+
+def _create_archive_table(conn, schema, username):
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {schema}.{username}_ledger (
+            timedate VARCHAR(30),
+            account_number INTEGER,
+            descriptor_id INTEGER,
+            counterparty INTEGER,
+            amount INTEGER,
+            donor_id VARCHAR(64),
+            cause_id INTEGER,
+            archive_run INTEGER NOT NULL
+        )
+    """)
+    # The hot ledger's indexes, so passbook filters stay index searches on archived periods;
+    # archive_run is carried along so counts need not visit the table
+    for name, columns in (('timedate_amount', 'timedate, amount, archive_run'),
+                          ('cause', 'cause_id, timedate, amount, archive_run'),
+                          ('amount', 'amount, archive_run'), ('donor', 'donor_id, timedate')):
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {schema}.idx_{username}_ledger_{name} "
+                     f"ON {username}_ledger ({columns})")
+
+
+def _catalog(cursor, username, start_date=None, end_date=None):
+    """Catalog rows (period, run) of the user's archives that overlap the date range"""
+    query = "SELECT period, run FROM ledger_archives WHERE username = ?"
+    params = [username]
+    if start_date:
+        query += " AND last_timedate >= ?"
+        params.append(start_date)
+    if end_date:
+        query += " AND first_timedate <= ?"
+        params.append(end_date)
+    cursor.execute(query + " ORDER BY period", params)
+    return [(row[0], row[1]) for row in cursor.fetchall()]
+
+
+def _open_reader(path):
+    """Read-only connection to a hot database, for reading one archive attached to it"""
+    conn = sql_trace.connect(Path(path).absolute().as_uri() + '?mode=ro', uri=True, timeout=30,
+                             check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    # mode=ro covers the main file, query_only also covers the ATTACHed archive
+    conn.execute("PRAGMA query_only=ON")
+    return conn
+
+
+class ArchivedLedger:
+    """
+    A user's ledger over a date range: the hot ledger plus the archived periods it reaches
+
+    The catalog and the hot ledger are read in one snapshot on `conn`; a read
+    transaction is left open there and ends when the connection is closed. Every
+    archived period is read on a connection of its own with only that archive
+    attached, so a history may span any number of periods. Queries run on each
+    part and their results are merged; archive rows count only up to the run the
+    catalog has published. close() the reader when done.
+    """
+
+    def __init__(self, conn, username, start_date=None, end_date=None):
+        self.username = username
+        self._conn = conn
+        self._archives = []  # (connection, schema, run) per archived period in range
+        if not conn.in_transaction:
+            conn.execute("BEGIN")
+        periods = _catalog(conn.cursor(), username, start_date, end_date)
+        if not periods:
+            return
+        hot_path = next(row[2] for row in conn.execute("PRAGMA database_list").fetchall() if row[1] == 'main')
+        try:
+            for period, run in periods:
+                if not os.path.exists(archive_path(period)):
+                    raise sqlite3.OperationalError(f"archive file for {period} is missing")
+                archive = _open_reader(hot_path)
+                try:
+                    self._archives.append((archive, _attach(archive, period), run))
+                except Exception:
+                    archive.close()
+                    raise
+        except Exception:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Close the archive connections (`conn` stays open; it is the caller's)"""
+        for archive, _, _ in self._archives:
+            archive.close()
+        self._archives = []
+
+    def _parts(self):
+        """(connection, ledger table, condition on its rows) of the hot ledger and of each archive"""
+        yield self._conn, f"{self.username}_ledger", None
+        for archive, schema, run in self._archives:
+            yield archive, f"{schema}.{self.username}_ledger", f"archive_run <= {int(run)}"
+
+    @staticmethod
+    def _where(where_sql, condition):
+        return where_sql if condition is None else f"{condition} AND ({where_sql})"
+
+    def count(self, where_sql, params):
+        """
+        COUNT(*) of the ledger rows matching `where_sql` (see ledger.passbook_filters)
+
+        Each part is counted on its own, which SQLite answers from an index.
+        """
+        return sum(conn.execute(f"SELECT COUNT(*) FROM {table} AS {self.username}_ledger "
+                                f"WHERE {self._where(where_sql, condition)}", list(params)).fetchone()[0]
+                   for conn, table, condition in self._parts())
+
+    def rows(self, where_sql, params, limit=None, offset=0):
+        """
+        Ledger rows matching `where_sql` with the passbook columns, newest first
+
+        Without archives in range this is one query with LIMIT/OFFSET. Otherwise the
+        newest `offset + limit` rows of each part are merged, and rows are read
+        lazily, so an unlimited read streams.
+        """
+        if not self._archives:
+            query = f"{ledger.passbook_select(self.username)} WHERE {where_sql} ORDER BY timedate DESC"
+            if limit is None:
+                return self._conn.execute(query, list(params))
+            return self._conn.execute(query + " LIMIT ? OFFSET ?", list(params) + [limit, offset])
+
+        cursors = []
+        for conn, table, condition in self._parts():
+            query = (f"{ledger.passbook_select(self.username, table)} WHERE {self._where(where_sql, condition)} "
+                     f"ORDER BY timedate DESC")
+            if limit is not None:
+                query += f" LIMIT {int(offset + limit)}"
+            cursors.append(conn.execute(query, list(params)))
+        merged = heapq.merge(*cursors, key=lambda row: row[0] or '', reverse=True)
+        return itertools.islice(merged, offset, None if limit is None else offset + limit)
+
+    def views(self):
+        """(connection, FROM-clause SQL) of each part, with the columns of the {username}_transaction view"""
+        for conn, table, condition in self._parts():
+            if condition is None:
+                yield conn, f"{self.username}_transaction"
+            else:
+                yield conn, f"({ledger.passbook_select(self.username, table)} WHERE {condition})"
+
+
+def _archive_batch(conn, username, cutoff, period_length, batch_rows):
+    """Move up to `batch_rows` of the oldest rows before `cutoff`; returns rows moved"""
+    # The batch is the qualifying rows up to this rowid; later inserts get higher rowids
+    row = conn.execute(f"""
+        SELECT MAX(rowid) FROM (
+            SELECT rowid FROM {username}_ledger WHERE timedate < ? ORDER BY rowid LIMIT ?
+        )
+    """, (cutoff, batch_rows)).fetchone()
+    last_rowid = row[0]
+    if last_rowid is None:
+        return 0
+    batch_where = "timedate < ? AND rowid <= ?"
+    batch_params = (cutoff, last_rowid)
+
+    periods = conn.execute(f"""
+        SELECT substr(timedate, 1, {period_length}) AS period, COUNT(*), MIN(timedate), MAX(timedate)
+        FROM {username}_ledger WHERE {batch_where} GROUP BY period
+    """, batch_params).fetchall()
+    run = conn.execute("SELECT COALESCE(MAX(run), 0) + 1 FROM ledger_archives").fetchone()[0]
+
+    # Phase 1: copy into the archives, one commit per archive file
+    for period, _rows, _first, _last in periods:
+        schema = _attach(conn, period)
+        conn.execute(f"PRAGMA {schema}.journal_mode=WAL")
+        _create_archive_table(conn, schema, username)
+        committed = conn.execute("SELECT run FROM ledger_archives WHERE username = ? AND period = ?",
+                                 (username, period)).fetchone()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Rows of a run that never reached phase 2 are still in the hot ledger
+            conn.execute(f"DELETE FROM {schema}.{username}_ledger WHERE archive_run > ?",
+                         (committed[0] if committed else 0,))
+            conn.execute(f"""
+                INSERT INTO {schema}.{username}_ledger ({LEDGER_COLUMNS}, archive_run)
+                SELECT {LEDGER_COLUMNS}, ? FROM main.{username}_ledger
+                WHERE {batch_where} AND substr(timedate, 1, {period_length}) = ?
+                ORDER BY rowid
+            """, (run,) + batch_params + (period,))
+        except Exception:
+            conn.execute("ROLLBACK")
+            conn.execute(f"DETACH DATABASE {schema}")
+            raise
+        conn.execute("COMMIT")
+        # SQLite allows ten attached databases per connection, and a batch may span more periods
+        conn.execute(f"DETACH DATABASE {schema}")
+
+    # Phase 2: publish the run and drop the rows from the hot ledger in one transaction
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        # The rows stay the account's history: their donor_index entries are kept (see ledger.install_donor_index)
+        conn.execute("INSERT OR IGNORE INTO ledger_archiving (username) VALUES (?)", (username,))
+        cursor = conn.execute(f"DELETE FROM main.{username}_ledger WHERE {batch_where}", batch_params)
+        moved = cursor.rowcount
+        conn.execute("DELETE FROM ledger_archiving WHERE username = ?", (username,))
+        conn.executemany("""
+            INSERT INTO ledger_archives (username, period, rows, first_timedate, last_timedate, run)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (username, period) DO UPDATE SET
+                rows = rows + excluded.rows,
+                first_timedate = MIN(first_timedate, excluded.first_timedate),
+                last_timedate = MAX(last_timedate, excluded.last_timedate),
+                run = excluded.run
+        """, [(username, period, rows, first, last, run) for period, rows, first, last in periods])
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+    return moved
+
+
+def archive_ledgers(older_than_days=ARCHIVE_AFTER_DAYS, period=ARCHIVE_PERIOD, usernames=None,
+                    db_path=DB_PATH, batch_rows=ARCHIVE_BATCH_ROWS, vacuum=False, progress=True, db_paths=None):
+    """
+    Move ledger rows older than `older_than_days` into the period archives
+
+    `db_paths` lists the databases holding accounts (every shard when sharded)
+    and replaces `db_path`; each keeps the catalog of its own accounts.
+
+    Returns:
+        dict: Rows moved per account, the cutoff used and seconds taken
+    """
+    if period not in PERIOD_LENGTHS:
+        raise ValueError(f"period must be one of {', '.join(PERIOD_LENGTHS)}")
+    started = time.perf_counter()
+    cutoff = str(datetime.now() - timedelta(days=older_than_days))
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+
+    moved = {}
+    for path in db_paths or [db_path]:
+        conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            init_catalog(conn.cursor())
+            if usernames:
+                accounts = list(usernames)
+            else:
+                accounts = [row[0] for row in conn.execute("SELECT username FROM customers ORDER BY username")]
+
+            for username in accounts:
+                if not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                                    (f"{username}_ledger",)).fetchone():
+                    continue  # No ledger here, or one still in the old layout (migrated on app start)
+                total = 0
+                while True:
+                    count = _archive_batch(conn, username, cutoff, PERIOD_LENGTHS[period], batch_rows)
+                    total += count
+                    if count < batch_rows:
+                        break
+                if total:
+                    moved[username] = total
+                    if progress:
+                        print(f"📦 Archived {total} rows of {username}")
+
+            if vacuum:
+                # Gives the freed pages back to the file system; blocks writers while it runs
+                conn.execute("VACUUM")
+        finally:
+            conn.close()
+
+    return {
+        'cutoff': cutoff,
+        'rows': sum(moved.values()),
+        'accounts': moved,
+        'seconds': round(time.perf_counter() - started, 3)
+    }
+
+
+def drop_archives(cursor, username):
+    """Remove a user's archived rows and catalog entries (for account deletion)"""
+    try:
+        cursor.execute("SELECT period FROM ledger_archives WHERE username = ?", (username,))
+    except sqlite3.OperationalError:
+        return  # Nothing was ever archived
+    for (period,) in cursor.fetchall():
+        path = archive_path(period)
+        if os.path.exists(path):
+            archive = sqlite3.connect(path, timeout=30)
+            try:
+                archive.execute(f"DROP TABLE IF EXISTS {username}_ledger")
+                archive.commit()
+            finally:
+                archive.close()
+    cursor.execute("DELETE FROM ledger_archives WHERE username = ?", (username,))
+
+
+def move_archives(conn, username, schema):
+    """
+    Hand a user's archived periods over to the database attached as `schema` (see sharding.split_database)
+
+    Archive rows hold the descriptor and cause ids of the database that archived
+    them, so each period is re-encoded with the target's ids in the transaction
+    that moves its catalog row; an interrupted move resumes with the periods left.
+    `conn` must be in autocommit mode (isolation_level=None).
+
+    Returns:
+        int: Periods moved
+    """
+    periods = [row[0] for row in conn.execute("SELECT period FROM main.ledger_archives WHERE username = ?",
+                                              (username,)).fetchall()]
+    for period in periods:
+        archive = _attach(conn, period) if os.path.exists(archive_path(period)) else None
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if archive and conn.execute(f"SELECT 1 FROM {archive}.sqlite_master WHERE type = 'table' AND name = ?",
+                                            (f"{username}_ledger",)).fetchone():
+                    for table, column in (('ledger_descriptors', 'descriptor_id'), ('ledger_causes', 'cause_id')):
+                        conn.execute(f"""
+                            INSERT OR IGNORE INTO {schema}.{table} (name)
+                            SELECT name FROM main.{table} WHERE id IN (SELECT {column} FROM {archive}.{username}_ledger)
+                        """)
+                        conn.execute(f"""
+                            UPDATE {archive}.{username}_ledger SET {column} = (
+                                SELECT target.id FROM main.{table} AS source
+                                JOIN {schema}.{table} AS target ON target.name = source.name
+                                WHERE source.id = {column})
+                        """)
+                conn.execute(f"INSERT OR REPLACE INTO {schema}.ledger_archives "
+                             f"SELECT * FROM main.ledger_archives WHERE username = ? AND period = ?", (username, period))
+                conn.execute("DELETE FROM main.ledger_archives WHERE username = ? AND period = ?", (username, period))
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+        finally:
+            if archive:
+                conn.execute(f"DETACH DATABASE {archive}")
+    return len(periods)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Move old ledger rows from bank.db into archive databases')
+    parser.add_argument('--older-than-days', type=int, default=ARCHIVE_AFTER_DAYS,
+                        help='Archive rows older than this many days')
+    parser.add_argument('--period', default=ARCHIVE_PERIOD, choices=sorted(PERIOD_LENGTHS),
+                        help='One archive file per year or per month')
+    parser.add_argument('--users', help='Comma separated usernames (default: all accounts)')
+    parser.add_argument('--batch-size', type=int, default=ARCHIVE_BATCH_ROWS, help='Rows moved per transaction')
+    parser.add_argument('--vacuum', action='store_true', help='VACUUM bank.db afterwards to shrink the file')
+    parser.add_argument('--list', action='store_true', help='Show the archive catalog and exit')
+    args = parser.parse_args()
+
+    from sharding import shards  # every shard file when BANK_SHARDS > 1
+    if args.list:
+        rows = []
+        for path in shards.paths():
+            conn = sqlite3.connect(path)
+            try:
+                init_catalog(conn.cursor())
+                rows += conn.execute("""
+                    SELECT username, period, rows, first_timedate, last_timedate
+                    FROM ledger_archives ORDER BY username, period
+                """).fetchall()
+            finally:
+                conn.close()
+        rows.sort()
+        print(f"{'Username':<15} {'Period':<8} {'Rows':>10}  {'From':<26} {'To':<26}")
+        for username, period, rows, first, last in rows:
+            print(f"{username:<15} {period:<8} {rows:>10}  {first:<26} {last:<26}")
+        return
+
+    usernames = [name.strip() for name in args.users.split(',') if name.strip()] if args.users else None
+    result = archive_ledgers(args.older_than_days, args.period, usernames,
+                             batch_rows=args.batch_size, vacuum=args.vacuum, db_paths=shards.paths())
+    print(f"✅ Archived {result['rows']} rows from {len(result['accounts'])} accounts "
+          f"(before {result['cutoff']}) in {result['seconds']}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+"""
+Metrics for Banking System
+Counters and histograms in the Prometheus text format, served at /metrics
+
+Recording is a dict lookup and a bisect under a per-metric lock, about a
+microsecond; rendering happens only when Prometheus scrapes. Gauges (queue
+depths, pool sizes) are callbacks evaluated at scrape time, so they cost
+nothing in between.
+
+With several worker processes (serve.py) each one keeps its own numbers. Set
+BANK_METRICS_DIR and every process writes a snapshot of its counters and
+histograms there every BANK_METRICS_FLUSH_SECONDS; a scrape, whichever worker
+answers it, adds them all up. Gauges describe the answering process and the
+shared database.
+"""
+
+import bisect
+import glob
+import json
+import os
+import threading
+import time
+
+# Configuration
+METRICS_DIR = os.environ.get('BANK_METRICS_DIR', '')  # shared snapshot directory for multi-process servers
+METRICS_FLUSH_SECONDS = float(os.environ.get('BANK_METRICS_FLUSH_SECONDS', '5'))
+
+# Seconds; from a cached balance read (~100 µs) to a chain receipt (tens of seconds)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+GAS_BUCKETS = (25000, 50000, 100000, 150000, 200000, 300000, 500000)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _label_text(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(labels), value] for labels, value in self._values.items()]
+
+    def reset(self):
+        with self._lock:
+            self._values = {}
+
+    @staticmethod
+    def merge(into, value):
+        return (into or 0) + value
+
+    def render(self, values):
+        for labels, value in sorted(values.items()):
+            yield f"{self.name}{_label_text(self.labels, labels)} {_number(value)}"
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._values = {}  # labels -> [count per bucket (+Inf last), sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                series = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(labels), [list(counts), total]] for labels, (counts, total) in self._values.items()]
+
+    def reset(self):
+        with self._lock:
+            self._values = {}
+
+    @staticmethod
+    def merge(into, value):
+        if into is None:
+            return [list(value[0]), value[1]]
+        return [[a + b for a, b in zip(into[0], value[0])], into[1] + value[1]]
+
+    def render(self, values):
+        for labels, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = 'le="%s"' % _number(bound)
+                yield f"{self.name}_bucket{_label_text(self.labels, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{_label_text(self.labels, labels)} {_number(round(total, 6))}"
+            yield f"{self.name}_count{_label_text(self.labels, labels)} {cumulative}"
+
+
+class Gauge:
+    """Value read from `callback()` at scrape time: a number, or {labels tuple: number}"""
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, callback, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+        self.labels = tuple(labels)
+
+    def render(self):
+        try:
+            value = self.callback()
+        except Exception as e:
+            yield f"# {self.name} unavailable: {_escape(e)}"
+            return
+        values = value if isinstance(value, dict) else {(): value}
+        for labels, number in sorted(values.items()):
+            yield f"{self.name}{_label_text(self.labels, labels)} {_number(number)}"
+
+
+class MetricsRegistry:
+    def __init__(self, metrics_dir=METRICS_DIR, flush_seconds=METRICS_FLUSH_SECONDS):
+        self.metrics_dir = metrics_dir
+        self.flush_seconds = flush_seconds
+        self._metrics = {}
+        self._gauges = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _register(self, metric):
+        with self._lock:
+            # Modules may be imported twice (as __main__ and by name); keep the first
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, documentation, labels=()):
+        return self._register(Counter(name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, documentation, labels, buckets))
+
+    def gauge(self, name, documentation, callback, labels=()):
+        with self._lock:
+            self._gauges[name] = Gauge(name, documentation, callback, labels)
+
+    # --- Multi-process snapshots ----------------------------------------
+
+    def snapshot(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {metric.name: metric.snapshot() for metric in metrics}
+
+    def reset(self):
+        """Zero every counter and histogram, e.g. in a forked worker so the parent's counts are not reported twice"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            metric.reset()
+
+    def _snapshot_path(self, pid=None):
+        return os.path.join(self.metrics_dir, f"{pid or os.getpid()}.json")
+
+    def flush(self):
+        """Write this process's snapshot for the others to read (no-op without BANK_METRICS_DIR)"""
+        if not self.metrics_dir:
+            return
+        os.makedirs(self.metrics_dir, exist_ok=True)
+        path = self._snapshot_path()
+        with open(path + '.tmp', 'w') as snapshot:
+            json.dump(self.snapshot(), snapshot)
+        os.replace(path + '.tmp', path)
+
+    def clear_snapshots(self):
+        """Forget snapshots of earlier runs; call once before starting the workers"""
+        if self.metrics_dir:
+            for path in glob.glob(os.path.join(self.metrics_dir, '*.json')):
+                os.remove(path)
+
+    def _collect(self):
+        """Counters and histograms of every process, summed: {name: {labels: value}}"""
+        snapshots = {os.getpid(): self.snapshot()}
+        if self.metrics_dir:
+            for path in glob.glob(os.path.join(self.metrics_dir, '*.json')):
+                pid = int(os.path.basename(path)[:-len('.json')])
+                if pid in snapshots:
+                    continue
+                try:
+                    with open(path) as snapshot:
+                        snapshots[pid] = json.load(snapshot)
+                except (OSError, ValueError):
+                    continue  # being replaced right now
+
+        totals = {}
+        for snapshot in snapshots.values():
+            for name, series in snapshot.items():
+                metric = self._metrics.get(name)
+                if metric is None:
+                    continue
+                values = totals.setdefault(name, {})
+                for labels, value in series:
+                    labels = tuple(labels)
+                    values[labels] = metric.merge(values.get(labels), value)
+        return totals
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        totals = self._collect()
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda metric: metric.name)
+            gauges = sorted(self._gauges.values(), key=lambda gauge: gauge.name)
+        lines = []
+        for metric in metrics + gauges:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            if metric.kind == 'gauge':
+                lines.extend(metric.render())
+            else:
+                lines.extend(metric.render(totals.get(metric.name, {})))
+        return '\n'.join(lines) + '\n'
+
+    def start(self):
+        """Start flushing snapshots in the background (no-op without BANK_METRICS_DIR)"""
+        if not self.metrics_dir or (self._thread and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='metrics-flush', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(5)
+            self._thread = None
+        self.flush()  # counters of an exited worker still count
+
+    def _run(self):
+        while not self._stop.wait(self.flush_seconds):
+            try:
+                self.flush()
+            except OSError as e:
+                print(f"⚠️ Metrics snapshot failed: {e}")
+
+
+# Global instance
+metrics = MetricsRegistry()
+
+# Requests, recorded by the Flask app and async_app.py
+REQUESTS = metrics.counter('bank_http_requests_total', 'HTTP requests by route, method and status',
+                           ['route', 'method', 'status'])
+REQUEST_SECONDS = metrics.histogram('bank_http_request_duration_seconds', 'HTTP request latency by route',
+                                    ['route', 'method'])
+
+
+def observe_request(route, method, status, seconds):
+    REQUESTS.inc(route, method, str(status))
+    REQUEST_SECONDS.observe(seconds, route, method)
+
+
+def instrument_flask(app):
+    """Record count and latency of every request the Flask app answers"""
+    from flask import g, request
+
+    @app.before_request
+    def start_request_timer():
+        g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        started = g.get('metrics_started')
+        if started is not None:
+            route = request.url_rule.rule if request.url_rule else 'unmatched'
+            observe_request(route, request.method, response.status_code, time.perf_counter() - started)
+        return response
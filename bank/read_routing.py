@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+"""
+Read Routing for Banking System
+Pooled read-only connections for the read endpoints, optionally on a replica file
+
+Balance, transaction list, passbook and summary reads take a connection from a
+small pool of read-only connections (opened with mode=ro and query_only), so
+they never share a connection with writes, skip the cost of opening one per
+request and keep a warm page cache. In WAL mode they read a snapshot and do
+not wait for the group commit writer.
+
+With BANK_READ_REPLICA set, reads go to that file instead: a copy of bank.db
+refreshed every BANK_REPLICA_REFRESH_SECONDS with the online backup API, so
+even the shared WAL index is off the write path. Replica reads can be that many
+seconds stale; the balance endpoint still answers from the write-through
+account cache first. Until the first copy exists, reads use bank.db.
+"""
+
+import glob
+import os
+import queue
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from backup_database import backup_database
+from metrics import metrics
+from sql_trace import sql_trace
+
+# Configuration
+DB_PATH = os.path.join(os.path.dirname(__file__), 'bank.db')
+READ_POOL_SIZE = int(os.environ.get('BANK_READ_POOL_SIZE', '8'))  # idle read connections kept per database
+READ_REPLICA = os.environ.get('BANK_READ_REPLICA', '')  # replica file; empty reads bank.db directly
+REPLICA_REFRESH_SECONDS = float(os.environ.get('BANK_REPLICA_REFRESH_SECONDS', '5'))
+
+ACQUIRE_SECONDS = metrics.histogram('bank_read_pool_acquire_seconds',
+                                    'Time to get a read connection, reused from the pool or opened', ['outcome'])
+HOLD_SECONDS = metrics.histogram('bank_sqlite_read_seconds',
+                                 'Time a request holds a pooled read connection, i.e. runs its SQLite reads')
+
+
+class ReadConnection:
+    """A pooled read-only connection; close() hands it back to the pool"""
+
+    def __init__(self, router, path, conn, generation):
+        self._router = router
+        self.path = path
+        self.conn = conn
+        self.generation = generation
+        self.acquired = time.perf_counter()
+        # Replica rows may be behind the account cache, so they must not be cached
+        self.replica = path == router.replica_path
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+    def close(self):
+        if self.conn is not None:
+            self._router._release(self)
+            self.conn = None
+
+
+class ReadRouter:
+    def __init__(self, db_path=DB_PATH, replica_path=READ_REPLICA, pool_size=READ_POOL_SIZE,
+                 refresh_seconds=REPLICA_REFRESH_SECONDS):
+        self.db_path = db_path
+        self.replica_path = replica_path or None
+        self.pool_size = pool_size
+        self.refresh_seconds = refresh_seconds
+        self._pools = {}  # path -> LifoQueue of idle connections
+        self._inherited = []
+        self._generation = 0  # bumped whenever the replica file is replaced; retires its connections
+        self._replica_inode = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.opened = 0
+        self.reused = 0
+        self.last_refresh = None
+
+    def _open(self, path):
+        conn = sql_trace.connect(Path(path).absolute().as_uri() + '?mode=ro', uri=True, timeout=30,
+                                 check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        # Belt and braces: mode=ro covers the main file, query_only also covers ATTACHed archives
+        conn.execute("PRAGMA query_only=ON")
+        return conn
+
+    def _route(self, db_path):
+        """File to read for `db_path` (the replica stands in for bank.db once it exists)"""
+        if self.replica_path and os.path.abspath(db_path) == os.path.abspath(self.db_path):
+            try:
+                inode = os.stat(self.replica_path).st_ino
+            except FileNotFoundError:
+                return db_path
+            if inode != self._replica_inode:
+                self._replica_replaced(inode)
+            return self.replica_path
+        return db_path
+
+    def _replica_replaced(self, inode):
+        """A new copy was renamed into place (by this or another worker process)"""
+        with self._lock:
+            if inode == self._replica_inode:
+                return
+            self._replica_inode = inode
+            self._generation += 1
+            stale = self._pools.pop(self.replica_path, None)
+        # Idle readers still hold the old file; in-use ones are closed when handed back
+        while stale is not None and not stale.empty():
+            stale.get_nowait().conn.close()
+
+    def _current_generation(self, path):
+        return self._generation if path == self.replica_path else 0
+
+    def connect(self, db_path=None):
+        """Read-only connection to `db_path` (default bank.db) or its replica"""
+        started = time.perf_counter()
+        path = self._route(db_path or self.db_path)
+        with self._lock:
+            pool = self._pools.setdefault(path, queue.LifoQueue())
+            generation = self._current_generation(path)
+        while True:
+            try:
+                reader = pool.get_nowait()
+            except queue.Empty:
+                break
+            if reader.generation == generation:
+                self.reused += 1
+                ACQUIRE_SECONDS.observe(time.perf_counter() - started, 'reused')
+                return ReadConnection(self, path, reader.conn, generation)
+            reader.conn.close()  # opened on a replica file that has since been replaced
+        self.opened += 1
+        conn = self._open(path)
+        ACQUIRE_SECONDS.observe(time.perf_counter() - started, 'opened')
+        return ReadConnection(self, path, conn, generation)
+
+    def _release(self, reader):
+        conn = reader.conn
+        HOLD_SECONDS.observe(time.perf_counter() - reader.acquired)
+        try:
+            # Readers may leave a snapshot open (see ledger_archive.ArchivedLedger) and databases attached
+            if conn.in_transaction:
+                conn.rollback()
+            for row in conn.execute("PRAGMA database_list").fetchall():
+                if row[1] not in ('main', 'temp'):
+                    conn.execute(f"DETACH DATABASE {row[1]}")
+        except sqlite3.Error:
+            conn.close()
+            return
+        pool = self._pools.get(reader.path)
+        if (pool is None or reader.generation != self._current_generation(reader.path)
+                or pool.qsize() >= self.pool_size):
+            conn.close()
+            return
+        pool.put(ReadConnection(self, reader.path, conn, reader.generation))
+
+    def refresh_replica(self):
+        """Copy bank.db to the replica file and switch readers over to the new copy"""
+        directory = os.path.dirname(os.path.abspath(self.replica_path))
+        result = backup_database(self.db_path, directory, label='replica', verify=False)
+        os.replace(result['path'], self.replica_path)
+        self._replica_replaced(os.stat(self.replica_path).st_ino)
+        self.last_refresh = result
+        return result
+
+    def reset(self):
+        """Stop using pooled connections inherited over a fork; SQLite connections must not cross one"""
+        with self._lock:
+            # Parked rather than closed: closing a parent's connection in the child is unsafe too
+            self._inherited.append(self._pools)
+            self._pools = {}
+            self._replica_inode = None
+
+    def stats(self):
+        with self._lock:
+            idle = {path: pool.qsize() for path, pool in self._pools.items()}
+        return {
+            'replica': self.replica_path,
+            'idle': idle,
+            'opened': self.opened,
+            'reused': self.reused,
+            'last_refresh_seconds': self.last_refresh['seconds'] if self.last_refresh else None
+        }
+
+    def start(self):
+        """Start refreshing the replica in the background (no-op without a replica)"""
+        if not self.replica_path or self.refresh_seconds <= 0 or (self._thread and self._thread.is_alive()):
+            return
+        # Copies cut short when the app last stopped
+        for partial in glob.glob(os.path.join(os.path.dirname(os.path.abspath(self.replica_path)),
+                                              '*-replica.db.partial*')):
+            os.remove(partial)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='replica-refresh', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=30):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        # The first copy is made right away; reads use bank.db until it exists
+        while not self._stop.is_set():
+            try:
+                self.refresh_replica()
+            except Exception as e:
+                print(f"❌ Replica refresh error: {e}")
+            if self._stop.wait(self.refresh_seconds):
+                break
+
+
+# Global instance
+reads = ReadRouter()
+
+metrics.gauge('bank_read_pool_idle_connections', 'Idle pooled read connections in this process',
+              lambda: sum(reads.stats()['idle'].values()))
@@ -11,6 +11,8 @@ import sqlite3
 import time
 from datetime import datetime
 
+from backup_database import backup_database
+
 def reset_database():
     # Define database path
     original_db_path = "bank.db"
@@ -22,6 +24,12 @@ def reset_database():
     
     # Check if database file exists and try to delete it
     if os.path.exists(original_db_path):
+        try:
+            # Keep a snapshot of what is about to be deleted
+            snapshot = backup_database(original_db_path, label='pre-reset')
+            print(f"Existing database saved to '{snapshot['path']}'.")
+        except Exception as e:
+            print(f"Warning: Could not back up existing database: {e}")
         try:
             os.remove(original_db_path)
             print(f"Existing database '{original_db_path}' has been deleted.")
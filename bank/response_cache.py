@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Conditional Ledger Reads for Banking System
+ETags from per-account ledger versions, 304 replies and a small response cache
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from functools import wraps
+
+from flask import g, request, make_response
+
+import ledger
+from sql_trace import sql_trace
+
+# Configuration
+DB_PATH = os.path.join(os.path.dirname(__file__), 'bank.db')
+RESPONSE_CACHE_SIZE = int(os.environ.get('BANK_RESPONSE_CACHE_SIZE', '512'))  # rendered responses kept
+
+
+class LedgerResponseCache:
+    def __init__(self, db_path=DB_PATH, max_entries=RESPONSE_CACHE_SIZE):
+        self.db_path = db_path
+        # fn(username) -> database holding the account; set by the app when accounts are sharded
+        self.path_for = None
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # etag -> (body, status, headers)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.not_modified = 0
+        self.misses = 0
+
+    def _connect(self, username=None):
+        path = self.path_for(username) if self.path_for and username else self.db_path
+        conn = sql_trace.connect(path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def get_version(self, username):
+        conn = self._connect(username)
+        try:
+            return ledger.get_version(conn.cursor(), username)
+        except sqlite3.OperationalError:
+            # ledger_versions doesn't exist until the first account is migrated
+            return 0
+        finally:
+            conn.close()
+
+    @staticmethod
+    def make_etag(endpoint, username, version, params):
+        """Strong ETag for one representation: account version plus the exact query"""
+        query = json.dumps(params, sort_keys=True, default=str)
+        digest = hashlib.sha1(f"{endpoint}|{username}|{query}".encode()).hexdigest()[:16]
+        return f"{version}-{digest}"
+
+    def _get(self, etag):
+        with self._lock:
+            entry = self._entries.get(etag)
+            if entry is not None:
+                self._entries.move_to_end(etag)
+            return entry
+
+    def _put(self, etag, entry):
+        with self._lock:
+            self._entries[etag] = entry
+            self._entries.move_to_end(etag)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'not_modified': self.not_modified,
+                'misses': self.misses
+            }
+
+    @staticmethod
+    def bypass():
+        """Keep the current response out of the cache and unvalidated (e.g. it came from a stale replica)"""
+        g.response_cache_bypass = True
+
+    def conditional(self, endpoint):
+        """
+        Decorate a ledger read that takes {'username': ...} in its JSON body
+
+        The account's ledger version is read first (one primary-key lookup). A
+        matching If-None-Match gets 304, a cached rendering is replayed as is,
+        and only otherwise the view runs; its 200 responses are cached.
+        """
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                data = request.get_json(silent=True)
+                username = data.get('username') if isinstance(data, dict) else None
+                if not username:
+                    return view(*args, **kwargs)
+
+                version = self.get_version(username)
+                etag = self.make_etag(endpoint, username, version, data)
+
+                if etag in request.if_none_match:
+                    self.not_modified += 1
+                    response = make_response('', 304)
+                    response.set_etag(etag)
+                    return response
+
+                cached = self._get(etag)
+                if cached is not None:
+                    self.hits += 1
+                    body, status, headers = cached
+                    response = make_response(body, status)
+                    response.headers.update(headers)
+                    response.set_etag(etag)
+                    response.headers['Cache-Control'] = 'no-cache'
+                    return response
+
+                self.misses += 1
+                response = make_response(view(*args, **kwargs))
+                # The ETag vouches for the primary's version; a replica's rendering may be older
+                if response.status_code == 200 and not g.get('response_cache_bypass'):
+                    headers = {key: value for key, value in response.headers.items()
+                               if key in ('Content-Type', 'Content-Disposition')}
+                    self._put(etag, (response.get_data(), 200, headers))
+                    response.set_etag(etag)
+                    # Clients may keep the body but must revalidate before using it
+                    response.headers['Cache-Control'] = 'no-cache'
+                return response
+            return wrapper
+        return decorator
+
+
+# Global instance
+response_cache = LedgerResponseCache()
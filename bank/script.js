@@ -296,7 +296,7 @@ class BankingSystem {
         // Create a temporary form element
         const form = document.createElement('form');
         form.method = 'POST';
-        form.action = `${this.baseURL}/api/epassbook`;
+        form.action = `${this.baseURL}/epassbook/export`;
         form.target = '_blank'; // Open in new tab
         form.style.display = 'none';
         
@@ -654,7 +654,7 @@ class BankingSystem {
         // Create a form for the POST request
         const form = document.createElement('form');
         form.method = 'POST';
-        form.action = `${this.baseURL}/epassbook`;
+        form.action = `${this.baseURL}/epassbook/export`;
         form.style.display = 'none';
         
         // Add fields to the form
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+Production Server for Banking System
+Runs the Flask app under gunicorn with several worker processes
+
+The app is imported once in the master (database setup, migrations and
+cross-shard recovery run there), then forked into workers. Each worker
+reconnects the blockchain client, starts with empty caches and connection
+pools, and runs its own queue drainers; backups and replica refreshes run in
+one worker only. On SIGTERM workers finish their requests, commit queued
+writes and keep delivering due notifications for up to BANK_DRAIN_SECONDS.
+
+With more than one worker the account cache of one process does not see the
+writes of another, so its TTL defaults to 1 second here (BANK_ACCOUNT_CACHE_TTL),
+and workers share their request counts and latencies for /metrics through
+snapshot files in BANK_METRICS_DIR (default bank/.metrics).
+
+This file doubles as a gunicorn config file.
+
+Usage:
+    pip install -r requirements-server.txt           # gunicorn (POSIX only)
+    python serve.py                                  # one worker per core, 4 threads each
+    python serve.py --workers 8 --threads 4 --bind 0.0.0.0:5050
+    gunicorn -c serve.py app:app
+"""
+
+import argparse
+import fcntl
+import multiprocessing
+import os
+
+# Configuration (gunicorn settings)
+bind = os.environ.get('BANK_BIND', '0.0.0.0:5050')
+workers = int(os.environ.get('BANK_WORKERS', str(multiprocessing.cpu_count())))
+threads = int(os.environ.get('BANK_THREADS', '4'))  # request threads per worker
+worker_class = 'gthread'
+preload_app = os.environ.get('BANK_PRELOAD', '1') != '0'
+timeout = 60  # seconds a request may take before its worker is restarted
+graceful_timeout = 30  # seconds workers get to finish requests and drain on shutdown
+keepalive = 5
+
+LEADER_LOCK = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.background.lock')
+METRICS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.metrics')
+
+# Background threads are started per worker after the fork, not in the master
+os.environ.setdefault('BANK_DEFER_SERVICES', '1')
+if workers > 1:
+    os.environ.setdefault('BANK_ACCOUNT_CACHE_TTL', '1')
+    os.environ.setdefault('BANK_METRICS_DIR', METRICS_DIR)
+
+_leader_lock = None
+
+
+def _become_leader():
+    """Take the host-wide lock for once-per-host jobs; released when the process exits"""
+    global _leader_lock
+    lock = open(LEADER_LOCK, 'w')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock.close()
+        return False
+    _leader_lock = lock
+    return True
+
+
+def on_starting(server):
+    """Drop the metrics snapshots of the previous run before any worker writes one"""
+    from metrics import metrics
+
+    metrics.clear_snapshots()
+
+
+def post_fork(server, worker):
+    """Give the new worker its own clients, caches and background threads"""
+    import app
+    from account_cache import account_cache
+    from blockchain_integration import blockchain
+    from metrics import metrics
+    from read_routing import reads
+
+    account_cache.clear()
+    reads.reset()
+    # Whatever the master recorded while importing the app is not this worker's
+    metrics.reset()
+    # The master's web3 session (if any) is shared with every child; open a fresh one
+    blockchain.web3 = None
+    blockchain.is_connected = False
+    blockchain.connect()
+
+    leader = _become_leader()
+    app.start_background_services(leader=leader)
+    server.log.info(f"Worker {worker.pid} ready{' (runs backups and replica refresh)' if leader else ''}")
+
+
+def worker_exit(server, worker):
+    """Commit queued writes and drain the delivery queues before the worker goes away"""
+    import app
+
+    app.stop_background_services()
+    server.log.info(f"Worker {worker.pid} drained and stopped")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the bank app with gunicorn worker processes')
+    parser.add_argument('--bind', default=bind)
+    parser.add_argument('--workers', type=int, default=workers)
+    parser.add_argument('--threads', type=int, default=threads)
+    parser.add_argument('--no-preload', action='store_true', help='Import the app in every worker instead')
+    args = parser.parse_args()
+
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        raise SystemExit("serve.py needs gunicorn (pip install -r requirements-server.txt); on Windows run python app.py")
+
+    if args.workers > 1:
+        os.environ.setdefault('BANK_ACCOUNT_CACHE_TTL', '1')
+        os.environ.setdefault('BANK_METRICS_DIR', METRICS_DIR)
+
+    settings = {
+        'bind': args.bind,
+        'workers': args.workers,
+        'threads': args.threads,
+        'worker_class': worker_class,
+        'preload_app': not args.no_preload,
+        'timeout': timeout,
+        'graceful_timeout': graceful_timeout,
+        'keepalive': keepalive,
+        'on_starting': on_starting,
+        'post_fork': post_fork,
+        'worker_exit': worker_exit
+    }
+
+    class BankApplication(BaseApplication):
+        def load_config(self):
+            for key, value in settings.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            from app import app
+            return app
+
+    print(f"Starting Banking Simulation Server: {args.workers} worker(s) x {args.threads} thread(s) on {args.bind}")
+    BankApplication().run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,674 @@
+#!/usr/bin/env python3
+"""
+Account Sharding for Banking System
+Spreads accounts over several SQLite files so writes are not serialized on one lock
+
+With BANK_SHARDS=N (N > 1) every account lives in bank_shard<i>.db, chosen by a
+hash of its account number, and each shard has its own group commit writer.
+bank.db keeps the account directory (username -> account number -> shard) and
+the coordinator log for transfers between shards.
+
+A transfer between two accounts on the same shard is one transaction on that
+shard's writer. A transfer across shards uses two-phase commit:
+
+    1. log PREPARING in bank.db
+    2. BEGIN IMMEDIATE on every shard involved (in shard order, so two transfers
+       cannot deadlock), debit and credit, and record the xid in each shard's
+       shard_applied table - still uncommitted, all write locks held
+    3. log COMMITTED in bank.db - the commit point
+    4. COMMIT the shards, then log DONE
+
+A bulk payout (transfer_many) is one such transfer with several credits; its
+chain recordings are queued in the sender shard's outbox in the same shard
+transaction as the debit.
+
+If the process dies before step 3 SQLite rolls the shards back and recovery
+marks the transfer ABORTED. After step 3 recovery replays the part whose xid
+is missing from its shard_applied table from the payload stored in the log.
+A replayed debit is checked against the balance again, since the shard's
+lock was released in between: if the money has been spent meanwhile the
+debit is not applied (nor are credits still missing elsewhere), the transfer
+is logged BLOCKED with an alert, and every later recovery retries it until an
+operator tops the account up.
+
+With BANK_SHARDS unset (or 1) everything stays in bank.db and the router hands
+out the global writer, dispatcher and chain outbox, so the app behaves as before.
+
+Usage:
+    BANK_SHARDS=4 python sharding.py split      # move accounts from bank.db into 4 shards
+    BANK_SHARDS=4 python sharding.py status
+    BANK_SHARDS=4 python sharding.py recover
+    python sharding.py bench --shards 1,2,4
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import ledger
+import ledger_archive
+from account_cache import account_cache
+from chain_outbox import ChainOutbox, chain_outbox
+from group_commit import GroupCommitWriter, MutationRejected, WriteTransaction, note_direct_write, writer
+from sql_trace import sql_trace
+from webhook_dispatcher import dispatcher, WebhookDispatcher
+
+# Configuration
+DB_PATH = os.path.join(os.path.dirname(__file__), 'bank.db')
+BANK_SHARDS = int(os.environ.get('BANK_SHARDS', '1'))  # 1 keeps every account in bank.db
+SHARD_DIR = os.environ.get('BANK_SHARD_DIR', os.path.dirname(os.path.abspath(__file__)))
+
+
+class ShardRouter:
+    def __init__(self, count=BANK_SHARDS, db_path=DB_PATH, shard_dir=SHARD_DIR):
+        self.count = max(1, count)
+        self.enabled = self.count > 1
+        self.db_path = db_path
+        self.shard_dir = shard_dir
+        self._writers = {}
+        self._dispatchers = {}
+        self._outboxes = {}
+        self._by_username = {}  # username -> (account_number, shard)
+        self._by_account = {}  # account_number -> username
+        self._lock = threading.Lock()
+
+    # --- Placement -------------------------------------------------------
+
+    def shard_of(self, account_number):
+        """Shard an account number belongs to"""
+        if not self.enabled:
+            return 0
+        return zlib.crc32(str(int(account_number)).encode()) % self.count
+
+    def shard_path(self, shard):
+        if not self.enabled:
+            return self.db_path
+        return os.path.join(self.shard_dir, f"bank_shard{shard}.db")
+
+    def paths(self):
+        """Every database holding accounts"""
+        return [self.shard_path(shard) for shard in range(self.count)]
+
+    def _connect(self, path):
+        conn = sql_trace.connect(path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def connect(self, shard):
+        return self._connect(self.shard_path(shard))
+
+    def writer(self, shard):
+        """Group commit writer of a shard (the global writer when sharding is off or the shard is None)"""
+        if not self.enabled or shard is None:
+            return writer
+        with self._lock:
+            if shard not in self._writers:
+                self._writers[shard] = GroupCommitWriter(self.shard_path(shard))
+            return self._writers[shard]
+
+    def dispatcher(self, shard):
+        """Webhook dispatcher draining a shard's notification queue"""
+        if not self.enabled or shard is None:
+            return dispatcher
+        with self._lock:
+            if shard not in self._dispatchers:
+                self._dispatchers[shard] = WebhookDispatcher(self.shard_path(shard))
+            return self._dispatchers[shard]
+
+    def outbox(self, shard):
+        """Chain outbox of a shard, for recordings queued with that shard's ledger changes"""
+        if not self.enabled or shard is None:
+            return chain_outbox
+        with self._lock:
+            if shard not in self._outboxes:
+                self._outboxes[shard] = ChainOutbox(self.shard_path(shard))
+            return self._outboxes[shard]
+
+    def outboxes(self):
+        """Every chain outbox holding recordings of accounts"""
+        return [self.outbox(shard) for shard in range(self.count)] if self.enabled else [chain_outbox]
+
+    def notification_id(self, shard, local_id):
+        """Id handed to clients for a shard's notification; unique across shards"""
+        return local_id * self.count + shard if self.enabled else local_id
+
+    def split_notification_id(self, notification_id):
+        """(shard, local id) of an id from notification_id()"""
+        return (notification_id % self.count, notification_id // self.count) if self.enabled else (0, notification_id)
+
+    # --- Directory -------------------------------------------------------
+
+    def init_coordinator(self, cursor):
+        """Create the account directory and transfer log in bank.db"""
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS account_directory (
+                username TEXT PRIMARY KEY,
+                account_number INTEGER NOT NULL UNIQUE,
+                shard INTEGER NOT NULL
+            )
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS shard_transfers (
+                xid VARCHAR(32) PRIMARY KEY,
+                state VARCHAR(12) NOT NULL,
+                payload TEXT NOT NULL,
+                created_at VARCHAR(30) NOT NULL,
+                updated_at VARCHAR(30) NOT NULL
+            )
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_shard_transfers_state ON shard_transfers (state)")
+
+    @staticmethod
+    def init_participant(cursor):
+        """Create the table of applied cross-shard transfers in a shard"""
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS shard_applied (
+                xid VARCHAR(32) PRIMARY KEY,
+                applied_at VARCHAR(30) NOT NULL
+            )
+        """)
+
+    def lookup(self, username=None, account_number=None):
+        """(username, account_number, shard) of an account, or None if unknown"""
+        if not self.enabled or (username is None and not str(account_number).isdigit()):
+            return None
+        if username is None:
+            username = self._by_account.get(int(account_number))
+        if username is not None and username in self._by_username:
+            number, shard = self._by_username[username]
+            return username, number, shard
+
+        conn = self._connect(self.db_path)
+        try:
+            if username is not None:
+                row = conn.execute("SELECT * FROM account_directory WHERE username = ?", (username,)).fetchone()
+            else:
+                row = conn.execute("SELECT * FROM account_directory WHERE account_number = ?",
+                                   (int(account_number),)).fetchone()
+        finally:
+            conn.close()
+        if not row:
+            return None
+        with self._lock:
+            self._by_username[row['username']] = (row['account_number'], row['shard'])
+            self._by_account[row['account_number']] = row['username']
+        return row['username'], row['account_number'], row['shard']
+
+    def shard_for(self, username=None, account_number=None):
+        """Shard holding an account (0 when sharding is off), or None if it does not exist"""
+        if not self.enabled:
+            return 0
+        found = self.lookup(username, account_number)
+        return found[2] if found else None
+
+    def register(self, username, account_number):
+        """
+        Reserve a username and account number in the directory
+
+        Returns:
+            int: The account's shard, or None if the username or number is taken
+        """
+        shard = self.shard_of(account_number)
+        conn = self._connect(self.db_path)
+        try:
+            conn.execute("INSERT INTO account_directory (username, account_number, shard) VALUES (?, ?, ?)",
+                         (username, account_number, shard))
+            conn.commit()
+        except sqlite3.IntegrityError:
+            return None
+        finally:
+            conn.close()
+        return shard
+
+    def unregister(self, username):
+        conn = self._connect(self.db_path)
+        try:
+            conn.execute("DELETE FROM account_directory WHERE username = ?", (username,))
+            conn.commit()
+        finally:
+            conn.close()
+        with self._lock:
+            number, _ = self._by_username.pop(username, (None, None))
+            self._by_account.pop(number, None)
+
+    # --- Cross-shard transfers -------------------------------------------
+
+    def _log(self, xid, state, payload=None):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            # The decision must survive a power cut before the shards commit
+            conn.execute("PRAGMA synchronous=FULL")
+            now = str(datetime.now())
+            if payload is not None:
+                conn.execute("""
+                    INSERT INTO shard_transfers (xid, state, payload, created_at, updated_at)
+                    VALUES (?, ?, ?, ?, ?)
+                """, (xid, state, json.dumps(payload), now, now))
+            else:
+                conn.execute("UPDATE shard_transfers SET state = ?, updated_at = ? WHERE xid = ?", (state, now, xid))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _participant(self, shard):
+        conn = sql_trace.connect(self.shard_path(shard), timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @staticmethod
+    def _part(value):
+        """A shard's part of a logged transfer; logs written before bulk payouts hold a single side"""
+        return {'sides': [value]} if 'role' in value else value
+
+    def _apply_part(self, txn, xid, shard, part):
+        """
+        Apply a shard's part of a transfer inside an open shard transaction
+
+        Returns:
+            dict: New balance of each debited account (raises MutationRejected on a short balance)
+        """
+        cursor = txn.cursor
+        balances = {}
+        entries = []
+        for side in part['sides']:
+            if side['role'] == 'debit':
+                balances[side['username']] = ledger.debit(txn, side['username'], side['amount'])
+            else:
+                ledger.credit(txn, side['username'], side['amount'])
+            entries.extend(side['entries'] if 'entries' in side else [side['entry']])
+        ledger.insert_entries(cursor, entries)
+        if part.get('chain'):
+            ChainOutbox.enqueue_batch(cursor, part['chain']['operations'], part['chain']['batch_id'])
+            txn.after_commit(self.outbox(shard).notify)
+        cursor.execute("INSERT INTO shard_applied (xid, applied_at) VALUES (?, ?)", (xid, str(datetime.now())))
+        return balances
+
+    def transfer(self, sender, receiver, amount, sender_donor_id=None, cause=None):
+        """
+        Move money between accounts on different shards with two-phase commit
+
+        Args:
+            sender (tuple): (username, account_number, shard) from lookup()
+            receiver (tuple): (username, account_number, shard) from lookup()
+
+        Returns:
+            int: The sender's new balance (raises MutationRejected like the writer would)
+        """
+        current_time = str(datetime.now())
+        sender_entry = ledger.new_entry(sender[0], sender[1], f'Fund Transfer -> {receiver[1]}',
+                                        amount, sender_donor_id, cause, current_time)
+        # The receiver sees the sender's account number as the donor, as on one shard
+        receiver_entry = ledger.new_entry(receiver[0], receiver[1], f'Fund Transfer From {sender[1]}',
+                                          amount, sender[1], cause, current_time)
+        new_balance, _ = self.transfer_many(sender, [(receiver, amount, sender_entry, receiver_entry)])
+        return new_balance
+
+    def transfer_many(self, sender, payouts, chain_operations=None):
+        """
+        Pay accounts on any shards from one account with a single two-phase commit
+
+        Args:
+            sender (tuple): (username, account_number, shard) from lookup()
+            payouts (list): (receiver, amount, sender_entry, receiver_entry) per credit, with the
+                receiver from lookup() and the entries from ledger.new_entry()
+            chain_operations (list): Recordings queued in the sender shard's outbox with the debit
+
+        Returns:
+            tuple: The sender's new balance and the chain batch id (None without operations);
+                raises MutationRejected like the writer would
+        """
+        note_direct_write()
+        xid = uuid.uuid4().hex
+        parts = {
+            sender[2]: {'sides': [{
+                'role': 'debit', 'username': sender[0], 'amount': sum(payout[1] for payout in payouts),
+                'entries': [payout[2] for payout in payouts]
+            }]}
+        }
+        for receiver, amount, _, receiver_entry in payouts:
+            parts.setdefault(receiver[2], {'sides': []})['sides'].append(
+                {'role': 'credit', 'username': receiver[0], 'amount': amount, 'entries': [receiver_entry]})
+        batch_id = None
+        if chain_operations:
+            batch_id = uuid.uuid4().hex
+            parts[sender[2]]['chain'] = {'batch_id': batch_id, 'operations': chain_operations}
+        payload = {str(shard): part for shard, part in parts.items()}
+        self._log(xid, 'PREPARING', payload)
+
+        # Phase 1: prepare on every shard, taking the write locks in shard order
+        connections = {}
+        transactions = {}
+        new_balance = None
+        try:
+            for shard in sorted(parts):
+                conn = self._participant(shard)
+                connections[shard] = conn
+                conn.execute("BEGIN IMMEDIATE")
+                txn = WriteTransaction(conn.cursor())
+                transactions[shard] = txn
+                new_balance = self._apply_part(txn, xid, shard, parts[shard]).get(sender[0], new_balance)
+        except Exception:
+            for conn in connections.values():
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                conn.close()
+            self._log(xid, 'ABORTED')
+            raise
+
+        # Phase 2: the logged decision is the commit point
+        try:
+            self._log(xid, 'COMMITTED')
+        except Exception:
+            for conn in connections.values():
+                conn.execute("ROLLBACK")
+                conn.close()
+            self._log(xid, 'ABORTED')
+            raise
+
+        failed = False
+        for shard in sorted(parts):
+            conn = connections[shard]
+            try:
+                conn.execute("COMMIT")
+                transactions[shard].run_after_commit()
+            except sqlite3.Error as e:
+                print(f"⚠️ Shard {shard} failed to commit transfer {xid}: {e}; replaying")
+                failed = True
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+            finally:
+                conn.close()
+
+        if failed:
+            self._finish(xid, payload)
+        else:
+            self._log(xid, 'DONE')
+        return new_balance, batch_id
+
+    def _finish(self, xid, payload):
+        """
+        Apply every part of a COMMITTED transfer its shard has not applied yet
+
+        Returns:
+            bool: True once the transfer is DONE; False if a debit no longer fits
+                the balance and the transfer is BLOCKED for an operator
+        """
+        parts = {int(shard): self._part(value) for shard, value in payload.items()}
+        blocked = False
+        # Debits first, so credits whose debit cannot be replayed are held back with it
+        for shard in sorted(parts, key=lambda shard: all(side['role'] != 'debit' for side in parts[shard]['sides'])):
+            if blocked:
+                break
+            part = parts[shard]
+            conn = self._participant(shard)
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                if conn.execute("SELECT 1 FROM shard_applied WHERE xid = ?", (xid,)).fetchone():
+                    conn.execute("ROLLBACK")
+                    continue
+                txn = WriteTransaction(conn.cursor())
+                self._apply_part(txn, xid, shard, part)
+                conn.execute("COMMIT")
+                txn.run_after_commit()
+                print(f"🔁 Replayed {'/'.join(side['role'] for side in part['sides'])} of transfer {xid} "
+                      f"on shard {shard}")
+            except MutationRejected as e:
+                # The shard's lock was released before the replay and the balance was spent meanwhile
+                conn.execute("ROLLBACK")
+                blocked = True
+                debit = next(side for side in part['sides'] if side['role'] == 'debit')
+                print(f"🚨 Transfer {xid}: cannot replay debit of ₹{debit['amount']} from {debit['username']} "
+                      f"on shard {shard} ({e.message}); logged BLOCKED, needs an operator")
+            except Exception:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                raise
+            finally:
+                conn.close()
+        self._log(xid, 'BLOCKED' if blocked else 'DONE')
+        return not blocked
+
+    def recover(self):
+        """
+        Settle transfers interrupted by a crash; run before serving requests
+
+        Returns:
+            dict: Number of transfers aborted, completed and still blocked
+        """
+        if not self.enabled:
+            return {'aborted': 0, 'completed': 0, 'blocked': 0}
+        conn = self._connect(self.db_path)
+        try:
+            rows = conn.execute("""
+                SELECT xid, state, payload FROM shard_transfers WHERE state IN ('PREPARING', 'COMMITTED', 'BLOCKED')
+            """).fetchall()
+        finally:
+            conn.close()
+
+        aborted = completed = blocked = 0
+        for row in rows:
+            if row['state'] == 'PREPARING':
+                # No decision was logged, so neither shard committed
+                self._log(row['xid'], 'ABORTED')
+                aborted += 1
+            elif self._finish(row['xid'], json.loads(row['payload'])):
+                completed += 1
+            else:
+                blocked += 1
+        return {'aborted': aborted, 'completed': completed, 'blocked': blocked}
+
+    # --- Lifecycle -------------------------------------------------------
+
+    def start(self):
+        """Start the shards' notification dispatchers and chain outboxes (writers start on first use)"""
+        if self.enabled:
+            for shard in range(self.count):
+                self.dispatcher(shard).start()
+                self.outbox(shard).start()
+
+    def stop(self):
+        for shard_writer in list(self._writers.values()):
+            shard_writer.stop()
+        for shard_dispatcher in list(self._dispatchers.values()):
+            shard_dispatcher.stop()
+        for shard_outbox in list(self._outboxes.values()):
+            shard_outbox.stop()
+
+    def delete_account(self, username):
+        """Drop an account and its ledger from its shard and the directory; returns True if it existed"""
+        found = self.lookup(username=username)
+        if not found:
+            return False
+        import ledger_archive
+
+        conn = self.connect(found[2])
+        try:
+            cursor = conn.cursor()
+            if ledger.drop_ledger(cursor, username):
+                # A re-created account must not inherit ETags of the dropped ledger
+                ledger.bump_version(cursor, username)
+                ledger.drop_donor_entries(cursor, username)
+                ledger_archive.drop_archives(cursor, username)
+            cursor.execute("DELETE FROM customers WHERE username = ?", (username,))
+            conn.commit()
+        finally:
+            conn.close()
+        self.unregister(username)
+        account_cache.invalidate(username)
+        return True
+
+
+# Global instance
+shards = ShardRouter()
+
+
+def split_database(router):
+    """
+    Move every account of bank.db into its shard
+
+    Each account is copied (customer row and ledger, through the shard's
+    transaction view) and only then removed from bank.db, one account per
+    transaction, so the split can be re-run after an interruption. The catalog
+    rows of archived ledgers move afterwards (ledger_archive.move_archives). The
+    shard schemas must exist already (the app creates them on start).
+    """
+    conn = sqlite3.connect(router.db_path, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    moved = 0
+    try:
+        customers = conn.execute("SELECT * FROM customers").fetchall()
+        for customer in customers:
+            username = customer['username']
+            shard = router.shard_of(customer['account_number'])
+            schema = f"shard{shard}"
+            conn.execute(f"ATTACH DATABASE ? AS {schema}", (router.shard_path(shard),))
+            try:
+                has_ledger = ledger._ledger_object(conn.cursor(), f"{username}_transaction")
+                if has_ledger:
+                    # Before BEGIN: the transaction below holds the shard's write lock
+                    shard_conn = router.connect(shard)
+                    ledger.create_ledger(shard_conn.cursor(), username)
+                    shard_conn.commit()
+                    shard_conn.close()
+                conn.execute("BEGIN IMMEDIATE")
+                columns = ", ".join(customer.keys())
+                conn.execute(f"INSERT INTO {schema}.customers ({columns}) SELECT {columns} FROM main.customers "
+                             f"WHERE username = ?", (username,))
+                if has_ledger:
+                    # The shard's view trigger re-encodes descriptors and causes with its own ids
+                    conn.execute(f"""
+                        INSERT INTO {schema}.{username}_transaction
+                            (timedate, account_number, transaction_type, amount, donor_id, cause)
+                        SELECT timedate, account_number, transaction_type, amount, donor_id, cause
+                        FROM main.{username}_transaction ORDER BY rowid
+                    """)
+                    ledger.drop_ledger(conn.cursor(), username)
+                    ledger.drop_donor_entries(conn.cursor(), username)
+                conn.execute("DELETE FROM main.customers WHERE username = ?", (username,))
+                conn.execute("""
+                    INSERT OR REPLACE INTO account_directory (username, account_number, shard) VALUES (?, ?, ?)
+                """, (username, customer['account_number'], shard))
+                conn.execute("COMMIT")
+                moved += 1
+            except Exception:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                raise
+            finally:
+                conn.execute(f"DETACH DATABASE {schema}")
+
+        # Archived periods follow their accounts; until then they are left out of reads, never mis-decoded
+        for row in conn.execute("""
+            SELECT DISTINCT ledger_archives.username, account_directory.shard FROM ledger_archives
+            JOIN account_directory USING (username)
+            WHERE ledger_archives.username NOT IN (SELECT username FROM customers)
+        """).fetchall():
+            schema = f"shard{row['shard']}"
+            conn.execute(f"ATTACH DATABASE ? AS {schema}", (router.shard_path(row['shard']),))
+            try:
+                ledger_archive.move_archives(conn, row['username'], schema)
+            finally:
+                conn.execute(f"DETACH DATABASE {schema}")
+    finally:
+        conn.close()
+    return moved
+
+
+def benchmark(shard_counts, accounts=64, operations=20000, threads=64):
+    """Deposits per second through the shard writers for each shard count, on throwaway databases"""
+    results = {}
+    for count in shard_counts:
+        workdir = tempfile.mkdtemp(prefix='bank_shards_')
+        try:
+            router = ShardRouter(count, os.path.join(workdir, 'bank.db'), workdir)
+            users = []
+            for number in range(accounts):
+                account_number = 10000000 + number
+                shard = router.shard_of(account_number)
+                conn = sqlite3.connect(router.shard_path(shard))
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS customers (username TEXT NOT NULL, password TEXT NOT NULL,
+                        name TEXT NOT NULL, age INTEGER NOT NULL, city TEXT NOT NULL, balance INTEGER NOT NULL,
+                        account_number INTEGER NOT NULL, status INTEGER NOT NULL)
+                """)
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_customers_username ON customers (username)")
+                conn.execute("INSERT INTO customers VALUES (?, '', '', 30, '', 0, ?, 1)", (f"u{number}", account_number))
+                ledger.create_ledger(conn.cursor(), f"u{number}")
+                conn.commit()
+                conn.close()
+                users.append((f"u{number}", account_number, shard))
+            # Writers of their own: with one shard the router would hand out the app's writer
+            writers = [GroupCommitWriter(router.shard_path(shard)) for shard in range(count)]
+
+            def deposit(i):
+                username, account_number, shard = users[i % len(users)]
+
+                def apply(txn):
+                    ledger.credit(txn, username, 1)
+                    ledger.insert_entries(txn.cursor, [ledger.new_entry(username, account_number, 'Amount Deposit', 1)])
+                writers[shard].execute(apply)
+
+            started = time.perf_counter()
+            with ThreadPoolExecutor(threads) as pool:
+                list(pool.map(deposit, range(operations)))
+            results[count] = round(operations / (time.perf_counter() - started))
+            for shard_writer in writers:
+                shard_writer.stop()
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sharded account storage')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('split', help='Move the accounts of bank.db into BANK_SHARDS shard files')
+    commands.add_parser('status', help='Accounts per shard and unsettled transfers')
+    commands.add_parser('recover', help='Settle interrupted cross-shard transfers')
+    bench = commands.add_parser('bench', help='Measure deposit throughput for several shard counts')
+    bench.add_argument('--shards', default='1,2,4', help='Comma separated shard counts')
+    bench.add_argument('--operations', type=int, default=20000)
+    args = parser.parse_args()
+
+    if args.command == 'bench':
+        counts = [int(count) for count in args.shards.split(',')]
+        for count, rate in benchmark(counts, operations=args.operations).items():
+            print(f"{count} shard(s): {rate:,} deposits/s")
+        return
+
+    if not shards.enabled:
+        print("Set BANK_SHARDS to the number of shards (2 or more) first.")
+        return
+
+    if args.command == 'split':
+        import app  # noqa: F401  (importing the app creates bank.db's and the shards' schemas)
+        print(f"✅ Moved {split_database(shards)} accounts into {shards.count} shards")
+    elif args.command == 'recover':
+        result = shards.recover()
+        print(f"✅ {result['completed']} transfer(s) completed, {result['aborted']} aborted, "
+              f"{result['blocked']} blocked")
+    else:
+        conn = sqlite3.connect(shards.db_path)
+        try:
+            for shard, accounts in conn.execute(
+                    "SELECT shard, COUNT(*) FROM account_directory GROUP BY shard ORDER BY shard"):
+                print(f"shard {shard}: {accounts} accounts ({shards.shard_path(shard)})")
+            for state, transfers in conn.execute(
+                    "SELECT state, COUNT(*) FROM shard_transfers GROUP BY state ORDER BY state"):
+                print(f"transfers {state}: {transfers}")
+        finally:
+            conn.close()
+
+
+if __name__ == "__main__":
+    main()
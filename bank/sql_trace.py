@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+"""
+SQL Trace for Banking System
+Per-statement timing, query fingerprints and a slow-query log for SQLite
+
+Off by default. With BANK_SQL_TRACE=1 the connections of the app (requests,
+read pool, group commit writers, shards and the queues) are opened through
+sql_trace.connect, and every statement they run is timed from execute() to
+its last fetched row. The progress handler counts SQLite VM steps at the same
+time, which tells a statement doing a lot of work (a full scan) from one that
+only waited for a lock.
+
+Statements are grouped by fingerprint: literals become ?, IN lists and VALUES
+rows collapse, and per-user tables (alice_transaction, bob_ledger) become
+{user}_transaction and {user}_ledger. The top fingerprints by total time are
+kept in memory (at most BANK_SQL_TRACE_MAX_FINGERPRINTS). A statement slower
+than BANK_SQL_SLOW_MS is printed and kept in the slow-query log together with
+its EXPLAIN QUERY PLAN. Parameters are never recorded.
+
+Aggregates are per process; /api/admin/sql-trace shows those of the process
+that answers.
+"""
+
+import itertools
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from functools import lru_cache
+
+from metrics import metrics
+
+# Configuration
+SQL_TRACE_ENABLED = os.environ.get('BANK_SQL_TRACE', '0') == '1'
+SQL_SLOW_THRESHOLD = float(os.environ.get('BANK_SQL_SLOW_MS', '100')) / 1000  # seconds
+SQL_TRACE_MAX_FINGERPRINTS = int(os.environ.get('BANK_SQL_TRACE_MAX_FINGERPRINTS', '500'))
+SLOW_LOG_SIZE = 200  # slow statements kept for the admin endpoint
+PROGRESS_INTERVAL = 1000  # SQLite VM instructions per progress callback
+EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE', 'WITH')
+
+STATEMENT_SECONDS = metrics.histogram('bank_sqlite_statement_seconds',
+                                      'Traced SQLite statement time, execute to last row (BANK_SQL_TRACE=1)',
+                                      ['statement'])
+SLOW_STATEMENTS = metrics.counter('bank_sqlite_slow_statements_total',
+                                  'Traced statements slower than BANK_SQL_SLOW_MS', ['statement'])
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?\b")
+_USER_TABLE = re.compile(
+    r"\b(FROM|JOIN|INTO|UPDATE|TABLE(?:\s+IF\s+(?:NOT\s+)?EXISTS)?|RENAME\s+TO)(\s+)[\"`\[]?\w+?_(transaction_legacy|transaction|ledger)\b[\"`\]]?",
+    re.IGNORECASE)
+_PARAMETER_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_VALUES_ROWS = re.compile(r"(\(\?, \.\.\.\)|\(\?\))(?:\s*,\s*\1)+")
+_SPACE = re.compile(r"\s+")
+
+
+@lru_cache(maxsize=4096)
+def fingerprint(sql):
+    """Normalized form of a statement, shared by all its variants"""
+    text = _SPACE.sub(' ', sql).strip().rstrip(';')
+    text = _USER_TABLE.sub(lambda m: f"{m.group(1)}{m.group(2)}{{user}}_{m.group(3).lower()}", text)
+    text = _STRING.sub('?', text)
+    text = _NUMBER.sub('?', text)
+    text = _PARAMETER_LIST.sub('(?, ...)', text)
+    return _VALUES_ROWS.sub(r'\1, ...', text)
+
+
+def statement_kind(sql):
+    """First keyword, for metric labels: SELECT, INSERT, ... or OTHER"""
+    verb = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else ''
+    return verb if verb in EXPLAINABLE + ('BEGIN', 'COMMIT', 'CREATE', 'PRAGMA') else 'OTHER'
+
+
+class TracedCursor(sqlite3.Cursor):
+    """Cursor timing each statement until its rows are fetched (or the cursor moves on)"""
+
+    _pending = None
+
+    def _start(self, sql, parameters, many=False):
+        self._finish()
+        self._pending = {'sql': sql, 'parameters': parameters, 'many': many, 'seconds': 0.0, 'steps': 0, 'rows': 0}
+
+    def _timed(self, call, *args):
+        pending = self._pending
+        steps = self.connection.steps
+        started = time.perf_counter()
+        try:
+            return call(*args)
+        finally:
+            if pending is not None:
+                pending['seconds'] += time.perf_counter() - started
+                pending['steps'] += self.connection.steps - steps
+
+    def _finish(self):
+        pending, self._pending = self._pending, None
+        if pending is not None:
+            rows = pending['rows'] + max(self.rowcount, 0)
+            sql_trace.record(self.connection, pending['sql'], pending['parameters'], pending['many'],
+                             pending['seconds'], pending['steps'], rows)
+
+    def execute(self, sql, parameters=()):
+        self._start(sql, parameters)
+        return self._timed(super().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        # Keep the first parameter set for EXPLAIN QUERY PLAN
+        seq_of_parameters = iter(seq_of_parameters)
+        first = next(seq_of_parameters, None)
+        if first is not None:
+            seq_of_parameters = itertools.chain([first], seq_of_parameters)
+        self._start(sql, first, many=True)
+        return self._timed(super().executemany, sql, seq_of_parameters)
+
+    def fetchone(self):
+        row = self._timed(super().fetchone)
+        if row is None:
+            self._finish()
+        elif self._pending is not None:
+            self._pending['rows'] += 1
+        return row
+
+    def fetchmany(self, size=None):
+        rows = self._timed(super().fetchmany, self.arraysize if size is None else size)
+        if not rows:
+            self._finish()
+        elif self._pending is not None:
+            self._pending['rows'] += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._timed(super().fetchall)
+        if self._pending is not None:
+            self._pending['rows'] += len(rows)
+        self._finish()
+        return rows
+
+    def __next__(self):
+        row = self.fetchone()
+        if row is None:
+            raise StopIteration
+        return row
+
+    def close(self):
+        self._finish()
+        super().close()
+
+    def __del__(self):
+        try:
+            self._finish()
+        except Exception:
+            pass
+
+
+class TracedConnection(sqlite3.Connection):
+    """Connection whose cursors are TracedCursors; counts VM steps through the progress handler"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.steps = 0
+        self.set_progress_handler(self._progress, PROGRESS_INTERVAL)
+
+    def _progress(self):
+        self.steps += PROGRESS_INTERVAL
+        return 0
+
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
+    # sqlite3.Connection.execute would bypass cursor()
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+class SQLTracer:
+    def __init__(self, enabled=SQL_TRACE_ENABLED, slow_threshold=SQL_SLOW_THRESHOLD,
+                 max_fingerprints=SQL_TRACE_MAX_FINGERPRINTS):
+        self.enabled = enabled
+        self.slow_threshold = slow_threshold
+        self.max_fingerprints = max_fingerprints
+        self._statements = {}  # fingerprint -> aggregate
+        self._slow = deque(maxlen=SLOW_LOG_SIZE)
+        self._lock = threading.Lock()
+        self.evicted = 0
+
+    def connect(self, database, **kwargs):
+        """sqlite3.connect, returning a traced connection when tracing is on"""
+        if self.enabled:
+            kwargs['factory'] = TracedConnection
+        return sqlite3.connect(database, **kwargs)
+
+    def record(self, conn, sql, parameters, many, seconds, steps, rows):
+        """Add one finished statement to its fingerprint; log it if slow"""
+        key = fingerprint(sql)
+        kind = statement_kind(sql)
+        STATEMENT_SECONDS.observe(seconds, kind)
+        with self._lock:
+            entry = self._statements.get(key)
+            if entry is None:
+                if len(self._statements) >= self.max_fingerprints:
+                    # Make room by forgetting the cheapest fingerprint
+                    cheapest = min(self._statements, key=lambda name: self._statements[name]['total_seconds'])
+                    del self._statements[cheapest]
+                    self.evicted += 1
+                entry = self._statements[key] = {'calls': 0, 'total_seconds': 0.0, 'max_seconds': 0.0,
+                                                 'steps': 0, 'rows': 0, 'slow': 0}
+            entry['calls'] += 1
+            entry['total_seconds'] += seconds
+            entry['max_seconds'] = max(entry['max_seconds'], seconds)
+            entry['steps'] += steps
+            entry['rows'] += rows
+            if seconds >= self.slow_threshold:
+                entry['slow'] += 1
+
+        if seconds >= self.slow_threshold:
+            SLOW_STATEMENTS.inc(kind)
+            self._log_slow(conn, key, sql, parameters, many, seconds, steps, rows)
+
+    def _log_slow(self, conn, key, sql, parameters, many, seconds, steps, rows):
+        plan = self.explain(conn, sql, parameters) if statement_kind(sql) in EXPLAINABLE else None
+        database = os.path.basename(self._database_path(conn) or '') or None
+        self._slow.append({
+            'at': datetime.now().isoformat(timespec='seconds'),
+            'database': database,
+            'fingerprint': key,
+            'sql': _SPACE.sub(' ', sql).strip()[:1000],
+            'executemany': many,
+            'ms': round(seconds * 1000, 2),
+            'steps': steps,
+            'rows': rows,
+            'plan': plan
+        })
+        print(f"🐢 Slow SQL ({seconds * 1000:.0f} ms, ~{steps} steps, {rows} rows) on {database}: {key[:200]}")
+        for detail in plan or []:
+            print(f"   {detail}")
+
+    @staticmethod
+    def _database_path(conn):
+        try:
+            row = sqlite3.Connection.execute(conn, "PRAGMA database_list").fetchone()
+            return row[2] if row else None
+        except sqlite3.Error:
+            return None
+
+    @staticmethod
+    def explain(conn, sql, parameters=()):
+        """EXPLAIN QUERY PLAN of a statement as indented lines, or None if it cannot be explained"""
+        try:
+            # Through the base class, so explaining is not traced itself
+            rows = sqlite3.Connection.execute(conn, "EXPLAIN QUERY PLAN " + sql, parameters or ()).fetchall()
+        except (sqlite3.Error, ValueError):
+            return None
+        depth = {0: 0}
+        lines = []
+        for node_id, parent, _, detail in rows:
+            depth[node_id] = depth.get(parent, 0) + 1
+            lines.append('  ' * (depth[node_id] - 1) + detail)
+        return lines
+
+    def top(self, limit=20, order='total'):
+        """The `limit` heaviest fingerprints, by total, mean or max time, calls or steps"""
+        sort_keys = {
+            'total': lambda item: item[1]['total_seconds'],
+            'mean': lambda item: item[1]['total_seconds'] / item[1]['calls'],
+            'max': lambda item: item[1]['max_seconds'],
+            'calls': lambda item: item[1]['calls'],
+            'steps': lambda item: item[1]['steps']
+        }
+        if order not in sort_keys:
+            raise ValueError(f"order must be one of {', '.join(sort_keys)}")
+        with self._lock:
+            items = [(key, dict(entry)) for key, entry in self._statements.items()]
+        items.sort(key=sort_keys[order], reverse=True)
+        return [{
+            'fingerprint': key,
+            'calls': entry['calls'],
+            'total_ms': round(entry['total_seconds'] * 1000, 2),
+            'mean_ms': round(entry['total_seconds'] * 1000 / entry['calls'], 3),
+            'max_ms': round(entry['max_seconds'] * 1000, 2),
+            'steps': entry['steps'],
+            'rows': entry['rows'],
+            'slow': entry['slow']
+        } for key, entry in items[:limit]]
+
+    def slow_queries(self, limit=50):
+        """Most recent slow statements first"""
+        return list(self._slow)[::-1][:limit]
+
+    def reset(self):
+        with self._lock:
+            self._statements.clear()
+            self._slow.clear()
+            self.evicted = 0
+
+    def stats(self):
+        with self._lock:
+            fingerprints = len(self._statements)
+        return {
+            'enabled': self.enabled,
+            'slow_ms': round(self.slow_threshold * 1000, 1),
+            'fingerprints': fingerprints,
+            'evicted': self.evicted,
+            'pid': os.getpid()
+        }
+
+
+# Global instance
+sql_trace = SQLTracer()
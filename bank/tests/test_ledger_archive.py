@@ -0,0 +1,123 @@
+"""
+Tests for ledger_archive: archiving and reading a history that spans more
+archive periods than SQLite can attach to one connection
+"""
+
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import donation_analytics  # noqa: E402
+import ledger  # noqa: E402
+import ledger_archive  # noqa: E402
+import ledger_export  # noqa: E402
+
+USERNAME = 'alice'
+MONTHS = [f"2023-{month:02d}" for month in range(1, 13)] + ["2024-01", "2024-02"]
+
+
+class ArchiveManyPeriodsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.directory, 'bank.db')
+        self.archive_dir = ledger_archive.ARCHIVE_DIR
+        ledger_archive.ARCHIVE_DIR = os.path.join(self.directory, 'archive')
+
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute("CREATE TABLE customers (username TEXT, account_number INTEGER, city TEXT, balance INTEGER)")
+        cursor.execute("INSERT INTO customers VALUES (?, 11111111, 'Pune', 0)", (USERNAME,))
+        ledger_archive.init_catalog(cursor)
+        ledger.create_ledger(cursor, USERNAME)
+        for index, month in enumerate(MONTHS):
+            cursor.execute(f"INSERT INTO {USERNAME}_transaction VALUES (?, 11111111, 'Deposit', ?, ?, 'Education')",
+                           (f"{month}-15 10:00:00", 100 + index, f"donor{index % 3}"))
+            cursor.execute(f"INSERT INTO {USERNAME}_transaction VALUES (?, 11111111, 'Withdraw', 5, NULL, NULL)",
+                           (f"{month}-20 10:00:00",))
+        # A recent row that stays in the hot ledger
+        cursor.execute(f"INSERT INTO {USERNAME}_transaction VALUES (datetime('now'), 11111111, 'Deposit', 7, 'donor9', NULL)")
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        ledger_archive.ARCHIVE_DIR = self.archive_dir
+        shutil.rmtree(self.directory)
+
+    def _archive(self, batch_rows=ledger_archive.ARCHIVE_BATCH_ROWS):
+        return ledger_archive.archive_ledgers(older_than_days=30, period='month', db_path=self.db_path,
+                                              batch_rows=batch_rows, progress=False)
+
+    def test_archives_more_periods_than_attach_limit(self):
+        result = self._archive()
+        self.assertEqual(result['rows'], 2 * len(MONTHS))
+
+        conn = sqlite3.connect(self.db_path)
+        try:
+            periods = conn.execute("SELECT COUNT(*) FROM ledger_archives WHERE username = ?", (USERNAME,)).fetchone()[0]
+            self.assertEqual(periods, len(MONTHS))
+            self.assertEqual(conn.execute(f"SELECT COUNT(*) FROM {USERNAME}_ledger").fetchone()[0], 1)
+        finally:
+            conn.close()
+
+    def test_reads_merge_every_period(self):
+        self._archive(batch_rows=7)
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        try:
+            where_sql, params = ledger.passbook_filters()
+            with ledger_archive.ArchivedLedger(conn, USERNAME) as history:
+                self.assertEqual(history.count(where_sql, params), 2 * len(MONTHS) + 1)
+                everything = [row['timedate'] for row in history.rows(where_sql, params)]
+                self.assertEqual(everything, sorted(everything, reverse=True))
+                self.assertEqual(len(everything), 2 * len(MONTHS) + 1)
+
+                page = [row['timedate'] for row in history.rows(where_sql, params, limit=5, offset=10)]
+                self.assertEqual(page, everything[10:15])
+
+            # The date range picks the archives to open; the filter applies it to their rows
+            where_sql, params = ledger.passbook_filters('2023-03-01', '2023-12-31', 'Deposit')
+            with ledger_archive.ArchivedLedger(conn, USERNAME, '2023-03-01', '2023-12-31') as history:
+                self.assertEqual(history.count(where_sql, params), 10)
+        finally:
+            conn.close()
+
+    def test_donor_history_survives_archiving(self):
+        conn = sqlite3.connect(self.db_path)
+        before = conn.execute("SELECT donor_id, timedate, amount FROM donor_index ORDER BY timedate").fetchall()
+        conn.close()
+
+        self._archive(batch_rows=7)
+
+        conn = sqlite3.connect(self.db_path)
+        try:
+            after = conn.execute("SELECT donor_id, timedate, amount FROM donor_index ORDER BY timedate").fetchall()
+            self.assertEqual(after, before)
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM ledger_archiving").fetchone()[0], 0)
+
+            # A new row may reuse an archived rowid without replacing the archived entry
+            conn.execute(f"INSERT INTO {USERNAME}_transaction VALUES (datetime('now'), 11111111, 'Deposit', 8, 'donor8', NULL)")
+            conn.commit()
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM donor_index").fetchone()[0], len(before) + 1)
+        finally:
+            conn.close()
+
+    def test_export_and_analytics_include_archives(self):
+        self._archive()
+
+        output_path = os.path.join(self.directory, 'ledger.npz')
+        result = ledger_export.export_ledger(output_path, db_path=self.db_path, fmt='npz')
+        self.assertEqual(result['rows'], 2 * len(MONTHS) + 1)
+
+        analytics = donation_analytics.DonationAnalytics(self.db_path)
+        analytics.refresh()
+        self.assertEqual(len(analytics._accounts[USERNAME]['amount']), len(MONTHS) + 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
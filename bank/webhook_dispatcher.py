@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+"""
+Webhook Dispatcher for Banking System
+Delivers withdrawal notifications to the website backend from a durable queue
+"""
+
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from sql_trace import sql_trace
+
+# Configuration
+DB_PATH = os.path.join(os.path.dirname(__file__), 'bank.db')
+WEBHOOK_URL = os.environ.get('BANK_WEBHOOK_URL', 'http://localhost:5000/api/bank/withdrawal-notification')
+# Optional endpoint accepting {"notifications": [...]} and answering {"results": [...]} in the same order
+WEBHOOK_BATCH_URL = os.environ.get('BANK_WEBHOOK_BATCH_URL')
+WEBHOOK_TIMEOUT = 5  # seconds per HTTP call
+BATCH_SIZE = 50  # notifications claimed per round
+# Claimed rows are hidden from other workers this long; renewed before every single send
+LEASE_SECONDS = WEBHOOK_TIMEOUT * 6
+MAX_ATTEMPTS = 10  # after this the notification is parked as FAILED
+BACKOFF_BASE = 2  # seconds, doubled on every failed attempt
+BACKOFF_MAX = 300  # seconds
+POLL_INTERVAL = 5  # seconds between queue scans when nobody wakes us up
+POOL_SIZE = 4  # keep-alive connections to the website backend
+
+# Statuses the receiver uses for a notification it will never accept
+PERMANENT_FAILURE_CODES = {400, 404, 422}
+# The website answers 409 when it already has the transaction, i.e. an earlier attempt got through
+ALREADY_DELIVERED_CODES = {409}
+
+
+class WebhookDispatcher:
+    def __init__(self, db_path=DB_PATH):
+        self.db_path = db_path
+        self.session = None
+        self.batch_supported = bool(WEBHOOK_BATCH_URL)
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _connect(self):
+        conn = sql_trace.connect(self.db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _get_session(self):
+        """Pooled keep-alive session, created lazily so it is never shared across a fork"""
+        if self.session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers.update({'Content-Type': 'application/json'})
+            self.session = session
+        return self.session
+
+    @staticmethod
+    def init_queue(cursor):
+        """Create the notification queue table"""
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS webhook_queue (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                event_type VARCHAR(50) NOT NULL,
+                payload TEXT NOT NULL,
+                status VARCHAR(20) NOT NULL DEFAULT 'PENDING',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                last_error TEXT,
+                response TEXT,
+                created_at VARCHAR(30) NOT NULL,
+                delivered_at VARCHAR(30)
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_webhook_queue_due ON webhook_queue (status, next_attempt_at)")
+
+    @staticmethod
+    def enqueue(cursor, payload, event_type='withdrawal'):
+        """
+        Queue a notification inside the caller's transaction
+
+        The row becomes visible to the dispatcher only when the caller commits, so a
+        withdrawal and its notification are stored (or rolled back) together.
+
+        Returns:
+            int: Queue id of the notification
+        """
+        cursor.execute("""
+            INSERT INTO webhook_queue (event_type, payload, status, attempts, next_attempt_at, created_at)
+            VALUES (?, ?, 'PENDING', 0, ?, ?)
+        """, (event_type, json.dumps(payload), time.time(), str(datetime.now())))
+        return cursor.lastrowid
+
+    def notify(self):
+        """Wake the dispatcher thread after a commit that queued notifications"""
+        self._wakeup.set()
+
+    def get_notification(self, notification_id):
+        """Get the delivery state of a queued notification"""
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT * FROM webhook_queue WHERE id = ?", (notification_id,))
+            row = cursor.fetchone()
+        finally:
+            conn.close()
+
+        if not row:
+            return None
+
+        return {
+            'id': row['id'],
+            'event_type': row['event_type'],
+            'status': row['status'],
+            'attempts': row['attempts'],
+            'payload': json.loads(row['payload']),
+            'website_response': json.loads(row['response']) if row['response'] else None,
+            'last_error': row['last_error'],
+            'created_at': row['created_at'],
+            'delivered_at': row['delivered_at']
+        }
+
+    def queue_depth(self):
+        """Number of notifications still waiting for delivery"""
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT COUNT(*) FROM webhook_queue WHERE status = 'PENDING'")
+            return cursor.fetchone()[0]
+        finally:
+            conn.close()
+
+    def start(self):
+        """Start the background delivery thread (no-op if already running)"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='webhook-dispatcher', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=10):
+        """Stop the delivery thread after the round in progress"""
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                delivered_any = self.dispatch_due()
+            except Exception as e:
+                print(f"❌ Webhook dispatcher error: {e}")
+                delivered_any = False
+
+            # Keep draining while there is work, otherwise sleep until woken or the next poll
+            if not delivered_any:
+                self._wakeup.wait(POLL_INTERVAL)
+                self._wakeup.clear()
+
+    def _claim_due(self):
+        """
+        Claim a batch of due notifications
+
+        Claimed rows get their next attempt pushed past the delivery timeout, so a
+        second dispatcher (another worker process) does not send them concurrently.
+        """
+        now = time.time()
+        lease_until = now + LEASE_SECONDS
+        conn = self._connect()
+        try:
+            conn.isolation_level = None
+            cursor = conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute("""
+                SELECT id, payload, attempts FROM webhook_queue
+                WHERE status = 'PENDING' AND next_attempt_at <= ?
+                ORDER BY next_attempt_at
+                LIMIT ?
+            """, (now, BATCH_SIZE))
+            rows = cursor.fetchall()
+            if rows:
+                cursor.executemany("UPDATE webhook_queue SET next_attempt_at = ? WHERE id = ?",
+                                   [(lease_until, row['id']) for row in rows])
+            cursor.execute("COMMIT")
+            return rows
+        finally:
+            conn.close()
+
+    def _renew_lease(self, rows):
+        """Keep claimed rows leased until their results are recorded"""
+        ids = [row['id'] for row in rows]
+        conn = self._connect()
+        try:
+            conn.execute(f"""
+                UPDATE webhook_queue SET next_attempt_at = ?
+                WHERE status = 'PENDING' AND id IN ({','.join('?' * len(ids))})
+            """, [time.time() + LEASE_SECONDS] + ids)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def dispatch_due(self):
+        """
+        Deliver one batch of due notifications
+
+        Returns:
+            bool: True if a batch was processed (more may be waiting)
+        """
+        rows = self._claim_due()
+        if not rows:
+            return False
+
+        print(f"🔔 Dispatching {len(rows)} withdrawal notification(s) to website")
+        payloads = [json.loads(row['payload']) for row in rows]
+
+        results = None
+        if self.batch_supported:
+            results = self._send_batch(payloads)
+        if results is None:
+            results = []
+            for payload in payloads:
+                # One call at a time can take BATCH_SIZE timeouts, far past the claim's lease
+                self._renew_lease(rows)
+                results.append(self._send_one(payload))
+
+        self._record_results(rows, results)
+        return True
+
+    def _send_one(self, payload):
+        """POST a single notification; returns (outcome, response, error)"""
+        try:
+            response = self._get_session().post(WEBHOOK_URL, json=payload, timeout=WEBHOOK_TIMEOUT)
+        except requests.exceptions.RequestException as req_error:
+            return 'retry', None, f"Network error: {str(req_error)}"
+        return self._classify(response.status_code, self._json_or_text(response))
+
+    def _send_batch(self, payloads):
+        """
+        POST all notifications in one call to the batch endpoint
+
+        Returns None when the receiver does not support batches, so the caller
+        falls back to one call per notification.
+        """
+        try:
+            response = self._get_session().post(
+                WEBHOOK_BATCH_URL,
+                json={'notifications': payloads},
+                timeout=WEBHOOK_TIMEOUT * 2
+            )
+        except requests.exceptions.RequestException as req_error:
+            error = f"Network error: {str(req_error)}"
+            return [('retry', None, error)] * len(payloads)
+
+        if response.status_code in (404, 405, 501):
+            print(f"⚠️ Website does not support batched notifications ({response.status_code}), sending individually")
+            self.batch_supported = False
+            return None
+
+        body = self._json_or_text(response)
+        items = body.get('results') if isinstance(body, dict) else None
+        if response.status_code not in (200, 201, 207) or not isinstance(items, list) or len(items) != len(payloads):
+            error = f"Website returned {response.status_code} for batch"
+            return [('retry', None, error)] * len(payloads)
+
+        return [self._classify(item.get('status', 200 if item.get('success') else 500), item) for item in items]
+
+    @staticmethod
+    def _json_or_text(response):
+        try:
+            return response.json()
+        except ValueError:
+            return {'success': False, 'error': response.text}
+
+    @staticmethod
+    def _classify(status_code, body):
+        if status_code in (200, 201) or status_code in ALREADY_DELIVERED_CODES:
+            return 'delivered', body, None
+        error = f"Website returned {status_code}: {body}"
+        if status_code in PERMANENT_FAILURE_CODES:
+            return 'failed', body, error
+        return 'retry', body, error
+
+    def _record_results(self, rows, results):
+        now = time.time()
+        delivered_at = str(datetime.now())
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            for row, (outcome, body, error) in zip(rows, results):
+                attempts = row['attempts'] + 1
+                response_json = json.dumps(body) if body is not None else None
+
+                if outcome == 'delivered':
+                    cursor.execute("""
+                        UPDATE webhook_queue
+                        SET status = 'DELIVERED', attempts = ?, response = ?, last_error = NULL, delivered_at = ?
+                        WHERE id = ?
+                    """, (attempts, response_json, delivered_at, row['id']))
+                    print(f"✅ Withdrawal notification {row['id']} delivered to website")
+                elif outcome == 'failed' or attempts >= MAX_ATTEMPTS:
+                    cursor.execute("""
+                        UPDATE webhook_queue
+                        SET status = 'FAILED', attempts = ?, response = ?, last_error = ?
+                        WHERE id = ?
+                    """, (attempts, response_json, error, row['id']))
+                    print(f"❌ Withdrawal notification {row['id']} failed permanently: {error}")
+                else:
+                    delay = min(BACKOFF_MAX, BACKOFF_BASE * (2 ** (attempts - 1)))
+                    delay *= random.uniform(0.5, 1.0)  # jitter so retries from a backlog spread out
+                    cursor.execute("""
+                        UPDATE webhook_queue
+                        SET attempts = ?, response = ?, last_error = ?, next_attempt_at = ?
+                        WHERE id = ?
+                    """, (attempts, response_json, error, now + delay, row['id']))
+                    print(f"⚠️ Withdrawal notification {row['id']} will be retried in {delay:.1f}s: {error}")
+            conn.commit()
+        finally:
+            conn.close()
+
+
+# Global instance
+dispatcher = WebhookDispatcher()